@@ -20,11 +20,100 @@ def create_app(config=None):
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwt-dev-key-please-change')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 3600  # 1 hour
     
+    # Collaborative editing: how many recent operations to keep for rebasing late edits
+    app.config['DOCUMENT_HISTORY_LIMIT'] = int(os.environ.get('DOCUMENT_HISTORY_LIMIT', 500))
+    # Seconds between batched document flushes to the database (0 writes through on every edit)
+    app.config['WRITE_BEHIND_INTERVAL'] = float(os.environ.get('WRITE_BEHIND_INTERVAL', 2.0))
+    # Cursor-batch frames per room per second (0 sends every cursor move as it arrives)
+    app.config['CURSOR_BATCH_RATE'] = float(os.environ.get('CURSOR_BATCH_RATE', 20))
+    # Chat history: messages sent on join (at least 1), messages kept per room unless the owner
+    # overrides it (0 keeps everything), seconds between batched inserts, and the largest page
+    app.config['CHAT_SYNC_LIMIT'] = max(int(os.environ.get('CHAT_SYNC_LIMIT', 50)), 1)
+    app.config['CHAT_RETENTION'] = int(os.environ.get('CHAT_RETENTION', 1000))
+    app.config['CHAT_FLUSH_INTERVAL'] = float(os.environ.get('CHAT_FLUSH_INTERVAL', 1.0))
+    app.config['CHAT_HISTORY_PAGE_LIMIT'] = int(os.environ.get('CHAT_HISTORY_PAGE_LIMIT', 100))
+    # Socket.IO admission: connections per second and burst per client IP and per user (rate 0
+    # disables), connections authenticated at once (0 is unlimited), and the range of the retry
+    # delay suggested to refused clients, in seconds
+    app.config['ADMISSION_IP_RATE'] = float(os.environ.get('ADMISSION_IP_RATE', 2))
+    app.config['ADMISSION_IP_BURST'] = float(os.environ.get('ADMISSION_IP_BURST', 20))
+    app.config['ADMISSION_USER_RATE'] = float(os.environ.get('ADMISSION_USER_RATE', 1))
+    app.config['ADMISSION_USER_BURST'] = float(os.environ.get('ADMISSION_USER_BURST', 10))
+    app.config['ADMISSION_MAX_HANDSHAKES'] = int(os.environ.get('ADMISSION_MAX_HANDSHAKES', 32))
+    app.config['ADMISSION_RETRY_BASE'] = float(os.environ.get('ADMISSION_RETRY_BASE', 1.0))
+    app.config['ADMISSION_RETRY_MAX'] = float(os.environ.get('ADMISSION_RETRY_MAX', 30.0))
+    # Reverse proxies in front of the app (1 on Render); their X-Forwarded-For gives the client IP
+    app.config['TRUSTED_PROXY_COUNT'] = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+    # Per-socket event limits as event=rate/burst, in events per second
+    app.config['SOCKET_EVENT_LIMITS'] = os.environ.get(
+        'SOCKET_EVENT_LIMITS', 'code-change=20/40,code-op=30/60,chat-message=2/10,cursor-position=60/120')
+    # Seconds a dropped socket's session can be resumed with its resume token (0 disables resuming)
+    app.config['SESSION_RESUME_TTL'] = float(os.environ.get('SESSION_RESUME_TTL', 120))
+    # Presence: seconds without activity before a user shows as idle, seconds without any event or
+    # heartbeat before a socket is dropped as dead (0 disables each), and seconds between sweeps
+    app.config['PRESENCE_IDLE_AFTER'] = float(os.environ.get('PRESENCE_IDLE_AFTER', 60))
+    app.config['PRESENCE_EXPIRE_AFTER'] = float(os.environ.get('PRESENCE_EXPIRE_AFTER', 90))
+    app.config['PRESENCE_SWEEP_INTERVAL'] = float(os.environ.get('PRESENCE_SWEEP_INTERVAL', 5))
+    # Revision history: deltas between full snapshots, and thinning revisions older than
+    # REVISION_COMPACT_AGE seconds to one per REVISION_COMPACT_BUCKET seconds (age 0 keeps all)
+    app.config['REVISION_SNAPSHOT_INTERVAL'] = int(os.environ.get('REVISION_SNAPSHOT_INTERVAL', 50))
+    app.config['REVISION_COMPACT_AGE'] = float(os.environ.get('REVISION_COMPACT_AGE', 86400))
+    app.config['REVISION_COMPACT_BUCKET'] = float(os.environ.get('REVISION_COMPACT_BUCKET', 3600))
+    app.config['REVISION_COMPACT_INTERVAL'] = float(os.environ.get('REVISION_COMPACT_INTERVAL', 300))
+    # Largest document in characters; edits past it are refused with a document-too-large error
+    app.config['MAX_DOCUMENT_SIZE'] = int(os.environ.get('MAX_DOCUMENT_SIZE', 4 * 1024 * 1024))
+    # Largest Socket.IO message in bytes; a full-document code-change must fit, JSON escaping included
+    app.config['SOCKETIO_MAX_MESSAGE_SIZE'] = int(os.environ.get(
+        'SOCKETIO_MAX_MESSAGE_SIZE', max(1000000, 2 * app.config['MAX_DOCUMENT_SIZE'])))
+    # Documents of at least SYNC_CHUNK_THRESHOLD characters go to clients that ask for it as
+    # SYNC_CHUNK_SIZE-character chunks, resumable for SYNC_RESUME_TTL seconds (0 always sends inline)
+    app.config['SYNC_CHUNK_THRESHOLD'] = int(os.environ.get('SYNC_CHUNK_THRESHOLD', 256 * 1024))
+    app.config['SYNC_CHUNK_SIZE'] = max(int(os.environ.get('SYNC_CHUNK_SIZE', 64 * 1024)), 1)
+    app.config['SYNC_RESUME_TTL'] = float(os.environ.get('SYNC_RESUME_TTL', 120))
+    # Slow consumers: once this many packets wait in a socket's Engine.IO queue, further ones are held
+    # and coalesced (0 disables); past OUTBOX_MAX_FRAMES or OUTBOX_MAX_BYTES held, the socket's code
+    # operations are replaced by a resync directive, and it is disconnected if that is not enough
+    app.config['OUTBOX_HIGH_WATER'] = int(os.environ.get('OUTBOX_HIGH_WATER', 64))
+    app.config['OUTBOX_MAX_FRAMES'] = int(os.environ.get('OUTBOX_MAX_FRAMES', 512))
+    app.config['OUTBOX_MAX_BYTES'] = int(os.environ.get('OUTBOX_MAX_BYTES', 32 * 1024 * 1024))
+    app.config['OUTBOX_DRAIN_INTERVAL'] = float(os.environ.get('OUTBOX_DRAIN_INTERVAL', 0.05))
+    # Stored room code and revision snapshots of at least this many characters are zlib-compressed
+    app.config['STORAGE_COMPRESS_MIN_SIZE'] = int(os.environ.get('STORAGE_COMPRESS_MIN_SIZE', 4096))
+    app.config['STORAGE_COMPRESS_LEVEL'] = int(os.environ.get('STORAGE_COMPRESS_LEVEL', 6))
+    
     # JWT configuration
     app.config['JWT_TOKEN_LOCATION'] = ['headers']
     app.config['JWT_HEADER_NAME'] = 'Authorization'
     app.config['JWT_HEADER_TYPE'] = 'Bearer'
     
+    # Where users, rooms and memberships live: sqlite:///file (the default) or postgresql://...
+    app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL', '')
+    
+    # Connection pools: SQLite readers (or PostgreSQL connections) and seconds to wait for a free one
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 4))
+    app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5.0))
+    
+    # bcrypt worker threads and how many hashes may queue before logins get a 503 (0 workers hashes inline)
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+    
+    # Multi-worker mode: a message queue (e.g. redis://localhost:6379/0) relays broadcasts
+    # between workers and the socket registry is shared by all of them
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    app.config['SOCKET_REGISTRY_URL'] = os.environ.get('SOCKET_REGISTRY_URL', 'memory://')
+    
+    # Room affinity: the URL clients reach this worker at (unset disables it). Workers sharing a
+    # registry hash rooms onto the live ones and redirect sockets to each room's owner
+    app.config['WORKER_URL'] = os.environ.get('WORKER_URL')
+    app.config['WORKER_HEARTBEAT_INTERVAL'] = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL', 5.0))
+    app.config['WORKER_TTL'] = float(os.environ.get('WORKER_TTL', 15.0))
+    app.config['ROOM_RING_REPLICAS'] = int(os.environ.get('ROOM_RING_REPLICAS', 160))
+    
+    # JSON bodies at least this many bytes are gzip/brotli compressed when the client accepts it
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+    
     # Configure CORS with more permissive settings
     CORS(app)
     
@@ -47,8 +136,58 @@ def create_app(config=None):
         return response
     
     # Initialize extensions with app
+    from app.db import init_app as init_db_app
+    init_db_app(app)
+    from app.http_cache import init_app as init_http_cache
+    init_http_cache(app)
     jwt.init_app(app)
-    socketio.init_app(app, cors_allowed_origins="*")  # More permissive for development
+    from app.serializer import NegotiatedPacket, packet_codecs
+    socketio.init_app(
+        app,
+        cors_allowed_origins="*",  # More permissive for development
+        message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+        max_http_buffer_size=app.config['SOCKETIO_MAX_MESSAGE_SIZE'],
+        # JSON by default; clients that connect with a MessagePack parser get MessagePack
+        serializer=NegotiatedPacket
+    )
+    # Sent bytes are counted below the codecs and the outbox, as frames reach Engine.IO
+    from app.metrics import instrument_transport
+    instrument_transport(socketio.server)
+    packet_codecs.install(socketio.server)
+    from app.outbox import outbound_queues
+    outbound_queues.configure(
+        app.config['OUTBOX_HIGH_WATER'],
+        app.config['OUTBOX_MAX_FRAMES'],
+        app.config['OUTBOX_MAX_BYTES'],
+        app.config['OUTBOX_DRAIN_INTERVAL']
+    )
+    outbound_queues.install(socketio.server)
+    
+    from app.rooms.storage import text_codec
+    text_codec.configure(app.config['STORAGE_COMPRESS_MIN_SIZE'], app.config['STORAGE_COMPRESS_LEVEL'])
+    
+    # Keep bcrypt off the event loop
+    from app.auth.utils import password_pool
+    password_pool.configure(
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_MAX_PENDING'],
+        use_tpool=socketio.async_mode == 'eventlet'
+    )
+    
+    # Keep SQLite I/O off the event loop too
+    from app.executor import db_executor
+    db_executor.configure(use_tpool=socketio.async_mode == 'eventlet')
+    
+    from app.repository import create_backend, repository
+    repository.configure(create_backend(
+        app.config['DATABASE_URL'],
+        app.config['DB_POOL_SIZE'],
+        app.config['DB_POOL_TIMEOUT']
+    ))
+    
+    # Prometheus metrics on /api/metrics; routes are timed by hooks, socket handlers as they register
+    from app.metrics import init_app as init_metrics
+    init_metrics(app, socketio)
     
     # Register blueprints
     from app.auth.routes import auth_bp
@@ -58,17 +197,31 @@ def create_app(config=None):
     app.register_blueprint(rooms_bp, url_prefix='/api/rooms')
     
     # Register Swagger UI blueprint
-    from app.swagger import swaggerui_blueprint, generate_swagger_spec
+    from app.swagger import swaggerui_blueprint, swagger_document
+    from app.http_cache import conditional
     app.register_blueprint(swaggerui_blueprint, url_prefix='/api/docs')
     
     @app.route('/api/swagger.json')
     def swagger_spec():
-        return jsonify(generate_swagger_spec())
+        body, etag = swagger_document()
+        return conditional(app.response_class(body, mimetype='application/json'), etag=etag, private=False)
     
     # A simple route to check if the app is running
     @app.route('/api/health')
     def health_check():
-        return {'status': 'healthy'}
+        from app.auth.utils import password_pool
+        from app.db import get_pool
+        from app.executor import db_executor
+        from app.repository import repository
+        from app.rooms.persistence import write_behind
+        return {
+            'status': 'healthy',
+            'database': get_pool().stats(),
+            'database_executor': db_executor.stats(),
+            'repository': repository.stats(),
+            'password_hashing': password_pool.stats(),
+            'persistence': write_behind.stats()
+        }
     
     # Serve static files for testing
     @app.route('/static/<path:path>')
@@ -84,5 +237,47 @@ def create_app(config=None):
     # Initialize Socket.IO events
     from app.rooms.socket_events import init_socket_events
     init_socket_events(app)
+    
+    # Gauges read at scrape time, from the same stats /api/health reports
+    from app.chat.history import chat_history
+    from app.db import get_pool
+    from app.metrics import registry
+    from app.rooms.admission import admission
+    from app.rooms.affinity import affinity
+    from app.rooms.cursors import cursor_batcher
+    from app.rooms.persistence import write_behind
+    from app.rooms.resume import resume_tokens
+    from app.rooms.revisions import revisions
+    from app.rooms.presence import presence
+    from app.rooms.sessions import sessions
+    from app.rooms.state import room_states
+    from app.rooms.storage import text_codec
+    from app.rooms.sync import chunked_syncs
+    
+    def socketio_rooms():
+        rooms = socketio.server.manager.rooms.get('/', {})
+        # Every socket also sits in a room named after its sid, and in the None room
+        return len(rooms) - (1 if None in rooms else 0) - len(rooms.get(None, ()))
+    
+    registry.gauge('codecollab_sockets', 'Authenticated sockets in this process (the session index)', lambda: len(sessions))
+    registry.gauge('codecollab_registry_sockets', 'Sockets connected to any worker', lambda: sessions.registry.count())
+    registry.gauge('codecollab_socketio_rooms', 'Socket.IO rooms with members in this process', socketio_rooms)
+    registry.gauge('codecollab_cached_rooms', 'Room states held in memory', lambda: len(room_states))
+    registry.gauges_from_stats('codecollab_db_pool', 'SQLite connection pool', lambda: get_pool().stats())
+    registry.gauges_from_stats('codecollab_db_executor', 'Database work off the event loop', db_executor.stats)
+    registry.gauges_from_stats('codecollab_repository', 'User, room and membership store connections', repository.stats)
+    registry.gauges_from_stats('codecollab_password_hashing', 'bcrypt worker pool', password_pool.stats)
+    registry.gauges_from_stats('codecollab_write_behind', 'Batched document writes', write_behind.stats)
+    registry.gauges_from_stats('codecollab_cursor_batches', 'Cursor batching', cursor_batcher.stats)
+    registry.gauges_from_stats('codecollab_chat_history', 'Batched chat history writes', chat_history.stats)
+    registry.gauges_from_stats('codecollab_revisions', 'Document revision history', revisions.stats)
+    registry.gauges_from_stats('codecollab_storage', 'Compressed document storage', text_codec.stats)
+    registry.gauges_from_stats('codecollab_chunked_sync', 'Chunked document transfers', chunked_syncs.stats)
+    registry.gauges_from_stats('codecollab_presence', 'Live room presence', presence.stats)
+    registry.gauges_from_stats('codecollab_session_resume', 'Resumable socket sessions', resume_tokens.stats)
+    registry.gauges_from_stats('codecollab_admission', 'Socket.IO admission control', admission.stats)
+    registry.gauges_from_stats('codecollab_room_affinity', 'Room ownership across workers', affinity.stats)
+    registry.gauges_from_stats('codecollab_outbox', 'Held, coalesced and dropped outbound frames', outbound_queues.stats)
+    registry.gauges_from_stats('codecollab_serializer', 'MessagePack connections and bytes', packet_codecs.stats)
         
     return app
\ No newline at end of file
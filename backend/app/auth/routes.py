@@ -1,10 +1,16 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
-import bcrypt
-from app.db import get_db_connection
+from app.auth.utils import HashingPoolBusy, check_password, hash_password
+from app.repository import repository
 
 auth_bp = Blueprint('auth', __name__)
 
+def server_busy():
+    """Fast-fail response when the password hashing pool is saturated"""
+    response = jsonify({'msg': 'Server is busy, please try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -17,26 +23,18 @@ def register():
     email = data['email']
     password = data['password']
     
-    # Hash the password
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Hash the password in the worker pool
+    try:
+        password_hash = hash_password(password)
+    except HashingPoolBusy:
+        return server_busy()
     
     try:
-        # Check if username or email already exists
-        cursor.execute("SELECT * FROM users WHERE username = ? OR email = ?", (username, email))
-        if cursor.fetchone():
+        # Insert the new user unless the username or email is taken
+        user_id = repository.create_user(username, email, password_hash)
+        if user_id is None:
             return jsonify({'msg': 'Username or email already exists'}), 409
         
-        # Insert the new user
-        cursor.execute(
-            "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
-            (username, email, password_hash)
-        )
-        user_id = cursor.lastrowid
-        conn.commit()
-        
         # Create access token
         access_token = create_access_token(identity=str(user_id))
         
@@ -51,11 +49,7 @@ def register():
         }), 201
     
     except Exception as e:
-        conn.rollback()
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
@@ -68,21 +62,15 @@ def login():
     username = data['username']
     password = data['password']
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
         # Find user by username
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user_row = cursor.fetchone()
+        user = repository.find_user_by_username(username)
         
-        if not user_row:
+        if not user:
             return jsonify({'msg': 'Invalid username or password'}), 401
         
-        user = dict(user_row)
-        
-        # Verify password
-        if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        # Verify password in the worker pool
+        if not check_password(password, user['password_hash']):
             return jsonify({'msg': 'Invalid username or password'}), 401
         
         # Create access token
@@ -98,11 +86,11 @@ def login():
             'access_token': access_token
         }), 200
     
+    except HashingPoolBusy:
+        return server_busy()
+    
     except Exception as e:
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @auth_bp.route('/user', methods=['GET'])
 @jwt_required()
@@ -112,26 +100,11 @@ def get_current_user():
         # Get the user's identity from the JWT token
         user_id = get_jwt_identity()
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Execute the query with proper parameter binding for SQLite
-        cursor.execute("SELECT id, username, email, created_at FROM users WHERE id = ?", (user_id,))
-        
-        user_row = cursor.fetchone()
+        user = repository.get_profile(user_id)
         
-        if not user_row:
+        if not user:
             return jsonify({'msg': 'User not found'}), 404
         
-        # Instead of dict(user_row), create the dictionary manually
-        # Make sure this matches the order of columns in your SELECT statement
-        user = {
-            'id': user_row[0],
-            'username': user_row[1],
-            'email': user_row[2],
-            'created_at': user_row[3]
-        }
-        
         # Convert datetime objects to strings to make them JSON serializable
         if user['created_at']:
             user['created_at'] = str(user['created_at'])
@@ -140,8 +113,4 @@ def get_current_user():
         
     except Exception as e:
         current_app.logger.error(f"Error in get_current_user: {str(e)}")
-        return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
\ No newline at end of file
+        return jsonify({'msg': f'Error: {str(e)}'}), 500
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""Password hashing off the event loop.
+
+bcrypt takes ~250 ms per call and would freeze every socket in an eventlet
+worker. Hashing is therefore run in a bounded pool of real OS threads
+(bcrypt releases the GIL); callers wait cooperatively. When more than
+`max_pending` hashes are queued the pool refuses new work immediately so
+the route can answer 503 instead of piling up.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class HashingPoolBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class PasswordHashingPool:
+    """Bounded worker pool for bcrypt"""
+
+    def __init__(self, workers=2, max_pending=32, use_tpool=False):
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        self.executor = None
+        self.configure(workers, max_pending, use_tpool)
+
+    def configure(self, workers, max_pending, use_tpool=False):
+        """Set the pool size and queue limit.
+
+        `workers=0` hashes inline on the calling greenlet/thread. With
+        `use_tpool` the work goes through eventlet's native thread pool so
+        waiting greenlets keep the hub running.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_tpool = use_tpool
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+        self.slots = None
+
+        if workers > 0:
+            if use_tpool:
+                from eventlet import semaphore
+                self.slots = semaphore.Semaphore(workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def run(self, fn, *args):
+        """Run `fn` in the pool and wait for its result"""
+        if self.workers <= 0:
+            return fn(*args)
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HashingPoolBusy('Too many password checks in progress')
+            self.pending += 1
+
+        try:
+            if self.use_tpool:
+                from eventlet import tpool
+                with self.slots:
+                    return tpool.execute(fn, *args)
+            return self.executor.submit(fn, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+
+# Shared pool for the application, configured in create_app
+password_pool = PasswordHashingPool()
+
+
+def hash_password(password):
+    """Hash a password with a fresh salt"""
+    return password_pool.run(
+        lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    )
+
+
+def check_password(password, password_hash):
+    """Check a password against a stored bcrypt hash"""
+    return password_pool.run(
+        lambda: bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    )
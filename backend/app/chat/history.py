@@ -0,0 +1,174 @@
+"""Persistent chat history.
+
+Messages get a per-room sequence number and are broadcast immediately; the
+rows are appended to chat_messages in batches by a background flusher, off
+the broadcast path. Each flush also trims the rooms it wrote down to their
+retention limit, so the table stays bounded.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from app.executor import db_executor
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COLUMNS = 'seq, user_id, username, message, created_at'
+
+
+def message_from_row(row):
+    """A chat_messages row in the shape clients receive"""
+    return {
+        'seq': row['seq'],
+        'userId': row['user_id'],
+        'username': row['username'],
+        'message': row['message'],
+        'timestamp': row['created_at'],
+    }
+
+
+def load_messages(cursor, room_id, limit, before=None):
+    """Up to `limit` messages before sequence number `before` (or the latest), oldest first"""
+    if before is None:
+        cursor.execute(
+            f'SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE room_id = ? ORDER BY seq DESC LIMIT ?',
+            (room_id, limit)
+        )
+    else:
+        cursor.execute(
+            f'SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE room_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+            (room_id, before, limit)
+        )
+    return [message_from_row(row) for row in reversed(cursor.fetchall())]
+
+
+class ChatHistoryBuffer:
+    """Queues chat messages and inserts them in batched transactions"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.pending = []  # (room_id, message, retention)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.task = None
+
+        self.flushes = 0
+        self.messages_written = 0
+        self.messages_trimmed = 0
+        self.flush_errors = 0
+        self.last_flush_duration = 0.0
+
+    def configure(self, interval):
+        """Set the flush interval"""
+        self.interval = interval
+
+    def start(self, socketio):
+        """Start the periodic flusher and make sure queued messages are written at exit"""
+        if self.task is not None:
+            return
+        atexit.register(self.flush)
+        if self.interval > 0:
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Chat history flush failed')
+
+    def append(self, room_id, message, retention):
+        """Queue a message; `retention` is how many of the room's messages to keep (0 keeps all)"""
+        with self.lock:
+            self.pending.append((str(room_id), message, retention))
+
+        # An interval of 0 means write-through
+        if self.interval <= 0:
+            self.flush([room_id])
+
+    def is_pending(self, room_id):
+        """True if the room has messages waiting to be written"""
+        key = str(room_id)
+        with self.lock:
+            return any(entry[0] == key for entry in self.pending)
+
+    def discard(self, room_id):
+        """Drop queued messages for a room, e.g. because it was deleted"""
+        key = str(room_id)
+        with self.lock:
+            self.pending = [entry for entry in self.pending if entry[0] != key]
+
+    def flush(self, room_ids=None):
+        """Insert queued messages (all, or just those of `room_ids`) and trim their rooms"""
+        with self.lock:
+            if room_ids is None:
+                batch, self.pending = self.pending, []
+            else:
+                keys = {str(room_id) for room_id in room_ids}
+                batch = [entry for entry in self.pending if entry[0] in keys]
+                self.pending = [entry for entry in self.pending if entry[0] not in keys]
+
+        if not batch:
+            return 0
+
+        # Newest sequence number and retention per room, for trimming
+        newest = {}
+        for room_id, message, retention in batch:
+            newest[room_id] = (message['seq'], retention)
+        trims = [
+            (int(room_id), seq - retention)
+            for room_id, (seq, retention) in newest.items()
+            if retention and seq > retention
+        ]
+
+        started = time.monotonic()
+        with self.flush_lock:
+            try:
+                self.messages_trimmed += db_executor.write(lambda conn: self._write(conn, batch, trims))
+            except Exception:
+                self.flush_errors += 1
+                # Requeue in front of anything that arrived meanwhile, keeping sequence order
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+
+        self.flushes += 1
+        self.messages_written += len(batch)
+        self.last_flush_duration = time.monotonic() - started
+        return len(batch)
+
+    @staticmethod
+    def _write(conn, batch, trims):
+        """Insert a batch and trim rooms in the writer's transaction; returns the number of messages trimmed"""
+        conn.executemany(
+            'INSERT OR IGNORE INTO chat_messages (room_id, seq, user_id, username, message, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (int(room_id), message['seq'], message['userId'], message['username'],
+                 message['message'], message['timestamp'])
+                for room_id, message, _ in batch
+            ]
+        )
+        trimmed = 0
+        if trims:
+            trimmed = max(conn.executemany('DELETE FROM chat_messages WHERE room_id = ? AND seq <= ?', trims).rowcount, 0)
+        return trimmed
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            'pending_messages': pending,
+            'flush_interval_seconds': self.interval,
+            'flushes': self.flushes,
+            'messages_written': self.messages_written,
+            'messages_trimmed': self.messages_trimmed,
+            'flush_errors': self.flush_errors,
+            'last_flush_duration_seconds': self.last_flush_duration,
+        }
+
+
+# Shared buffer for the application, configured in init_socket_events
+chat_history = ChatHistoryBuffer()
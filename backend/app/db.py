@@ -1,67 +1,257 @@
 import os
+import queue
 import sqlite3
+import threading
+import time
 from flask import current_app, g
+from app.metrics import observe_query
 
-def get_db_connection():
-    """Get a SQLite database connection."""
-    if 'db_conn' not in g:
-        db_path = os.path.join(os.getcwd(), 'codecollab.db')
-        g.db_conn = sqlite3.connect(db_path)
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available within the pool timeout."""
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement execution time in the metrics."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_query(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_query(sql, started)
+
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection that goes back to its pool when closed."""
+
+    pool = None
+    checked_out = False
+    checkout = 0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
+    """Long-lived, tuned SQLite connections: one writer and several readers.
+
+    Every connection runs in WAL mode so readers never block the writer.
+    Reader connections are opened read-only (query_only), and the single
+    writer connection is handed to one caller at a time, so writes are
+    serialized in the pool instead of contending on SQLite's lock.
+    Connections stay open, which keeps their prepared statement caches warm.
+    """
+
+    PRAGMAS = (
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA mmap_size=268435456',  # 256 MB
+        'PRAGMA cache_size=-16000',  # 16 MB
+        'PRAGMA temp_store=MEMORY',
+    )
+
+    def __init__(self, path, size=4, timeout=5.0, cached_statements=256):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+
+        self.idle_readers = queue.LifoQueue()
+        self.open_readers = 0
+        self.thread_readers = 0
+        self.readers_lock = threading.Lock()
+        self.writer = None
+        self.writer_lock = threading.Semaphore(1)
+
+        self.checkouts = {'read': 0, 'write': 0}
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.checkout_counter = 0
+
+    def _connect(self, read_only):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=PooledConnection
+        )
         # Configure SQLite to return dictionaries instead of tuples
-        g.db_conn.row_factory = sqlite3.Row
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute('PRAGMA query_only=1')
+        conn.pool = self
+        return conn
+
+    def _record_wait(self, started):
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.waits += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def acquire(self, write=False):
+        """Check out the writer or a reader connection, waiting up to the pool timeout"""
+        started = time.monotonic()
+
+        if write:
+            if not self.writer_lock.acquire(timeout=self.timeout):
+                self.timeouts += 1
+                raise PoolTimeout('Timed out waiting for the database writer')
+            if self.writer is None:
+                self.writer = self._connect(read_only=False)
+            conn = self.writer
+        else:
+            try:
+                conn = self.idle_readers.get_nowait()
+            except queue.Empty:
+                conn = None
+                with self.readers_lock:
+                    if self.open_readers < self.size:
+                        self.open_readers += 1
+                        conn = self._connect(read_only=True)
+                if conn is None:
+                    try:
+                        conn = self.idle_readers.get(timeout=self.timeout)
+                    except queue.Empty:
+                        self.timeouts += 1
+                        raise PoolTimeout('Timed out waiting for a database connection')
+
+        self._record_wait(started)
+        self.checkouts['write' if write else 'read'] += 1
+        self.checkout_counter += 1
+        conn.checkout = self.checkout_counter
+        conn.checked_out = True
+        return conn
+
+    def release(self, conn, checkout=None):
+        """Return a connection, rolling back anything left uncommitted.
+
+        Pass the `checkout` number seen at acquire time to make a late
+        release a no-op once the connection was handed to someone else.
+        """
+        if not conn.checked_out or (checkout is not None and checkout != conn.checkout):
+            return
+        conn.checked_out = False
+        if conn.in_transaction:
+            conn.rollback()
+
+        if conn is self.writer:
+            self.writer_lock.release()
+        else:
+            self.idle_readers.put(conn)
+
+    def connect_reader(self):
+        """A read-only connection outside the pool, for a thread that keeps its own"""
+        conn = self._connect(read_only=True)
+        conn.pool = None
+        self.thread_readers += 1
+        return conn
+
+    def stats(self):
+        """Pool size, contention and checkout counters"""
+        return {
+            'size': self.size,
+            'open_readers': self.open_readers,
+            'thread_readers': self.thread_readers,
+            'idle_readers': self.idle_readers.qsize(),
+            'writer_busy': self.writer is not None and self.writer.checked_out,
+            'checkouts': dict(self.checkouts),
+            'waits': self.waits,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'timeouts': self.timeouts,
+        }
+
+
+# Process-wide pool, created by init_app or on first use
+pool = None
+
+def database_path():
+    """SQLite file to use: $CODECOLLAB_DB, a sqlite:/// $DATABASE_URL, or codecollab.db in the working directory."""
+    if 'CODECOLLAB_DB' in os.environ:
+        return os.environ['CODECOLLAB_DB']
+    url = os.environ.get('DATABASE_URL', '')
+    if url.startswith('sqlite:///'):
+        return os.path.join(os.getcwd(), url[len('sqlite:///'):])
+    return os.path.join(os.getcwd(), 'codecollab.db')
+
+def get_pool():
+    """Get the connection pool, creating it with defaults if needed."""
+    global pool
+    if pool is None:
+        pool = ConnectionPool(database_path())
+    return pool
+
+def get_db_connection(write=False):
+    """Get a pooled SQLite connection for the current app context.
+
+    Pass write=True before modifying the database; the writer connection is
+    also used for any reads later in the same context.
+    """
+    if 'db_writer' in g:
+        return g.db_writer
+    if write:
+        g.db_writer = get_pool().acquire(write=True)
+        return g.db_writer
+    if 'db_conn' not in g:
+        g.db_conn = get_pool().acquire()
     return g.db_conn
 
 def close_db_connection(e=None):
-    """Close the SQLite connection."""
-    conn = g.pop('db_conn', None)
-    
-    if conn is not None:
-        conn.close()
+    """Return the context's connections to the pool."""
+    for key in ('db_conn', 'db_writer'):
+        conn = g.pop(key, None)
+
+        if conn is not None:
+            conn.close()
 
 def init_db():
-    """Initialize the database schema."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Bring the database schema up to date by applying pending migrations."""
+    from app.migrations import migrate
+    from app.repository import repository
     
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    conn = get_db_connection(write=True)
+    applied = migrate(conn)
     
-    # Create rooms table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rooms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            owner_id INTEGER NOT NULL,
-            language TEXT DEFAULT 'javascript',
-            code TEXT DEFAULT '',
-            video_enabled INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE
-        )
-    ''')
+    if applied:
+        current_app.logger.info(f"Applied schema migrations: {applied}")
     
-    # Create room_members table for many-to-many relationship
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS room_members (
-            room_id INTEGER,
-            user_id INTEGER,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (room_id, user_id),
-            FOREIGN KEY (room_id) REFERENCES rooms (id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-        )
-    ''')
-    
-    conn.commit()
+    # Users, rooms and memberships may live in PostgreSQL instead
+    repository.init_schema()
 
 def init_app(app):
     """Register database functions with the Flask app."""
-    app.teardown_appcontext(close_db_connection)
\ No newline at end of file
+    global pool
+    if pool is None:
+        pool = ConnectionPool(
+            database_path(),
+            size=app.config.get('DB_POOL_SIZE', 4),
+            timeout=app.config.get('DB_POOL_TIMEOUT', 5.0)
+        )
+    if close_db_connection not in app.teardown_appcontext_funcs:
+        app.teardown_appcontext(close_db_connection)
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""Database work off the eventlet hub.
+
+sqlite3 blocks the OS thread it runs on, and under eventlet that thread is
+the hub, so every query and commit in a handler stalls every socket in the
+process. `db_executor` runs database work in native threads (eventlet's
+tpool) while the calling greenlet waits cooperatively:
+
+    user = db_executor.read(lambda conn: conn.execute(
+        'SELECT id, username FROM users WHERE id = ?', (user_id,)).fetchone())
+
+    db_executor.write(lambda conn: conn.execute(
+        'UPDATE rooms SET language = ? WHERE id = ?', (language, room_id)))
+
+Reads run on tpool's threads, each with a read-only connection of its own,
+so the reader pool is the thread pool and a queued read holds no
+connection while it waits. Writes join a queue. One write at a time leads:
+it takes the pool's single writer connection and every write queued so
+far, runs each in its own savepoint and commits them once, in one trip to
+a native thread, until its own write is done; it then wakes the writes it
+committed and hands the lead to the next queued one. A write whose
+function raises is rolled back to its savepoint without affecting the rest
+of its batch. Write functions must not commit.
+
+Outside eventlet the same code runs on the calling thread.
+"""
+import threading
+import time
+from collections import deque
+
+try:
+    from eventlet.patcher import original
+except ImportError:  # eventlet is only needed for the eventlet async mode
+    original = None
+
+
+def native_lock():
+    """A real OS lock, also under eventlet monkey patching.
+
+    Use it for state touched by executor threads as well as greenlets: a
+    green lock released from a native thread would wake its waiter on the
+    wrong hub. Such locks are held for a few instructions, so a greenlet
+    blocking on one does not stall the hub noticeably.
+    """
+    if original is not None:
+        return original('threading').Lock()
+    return threading.Lock()
+
+
+def native_local():
+    """Per-OS-thread storage, also under eventlet monkey patching"""
+    if original is not None:
+        return original('threading').local()
+    return threading.local()
+
+
+class WriteJob:
+    """A queued write and, once its batch has run, its outcome"""
+
+    __slots__ = ('fn', 'queued_at', 'done', 'wakeup', 'result', 'error')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.queued_at = time.monotonic()
+        self.done = False
+        self.wakeup = threading.Event()  # set when done, or when it is this write's turn to commit
+        self.result = None
+        self.error = None
+
+
+class DatabaseExecutor:
+    """Runs reads on per-thread reader connections and batches writes through one writer"""
+
+    def __init__(self, use_tpool=False, max_batch=64):
+        self.use_tpool = use_tpool
+        self.max_batch = max_batch
+        self.pending = deque()  # WriteJobs waiting for the writer connection
+        self.committing = False  # a write is committing batches; the others wait for it
+        self.local = native_local()
+        self.lock = native_lock()
+        self.queued = {'read': 0, 'write': 0}
+        self.running = {'read': 0, 'write': 0}
+        self.calls = {'read': 0, 'write': 0}
+        self.batches = 0
+        self.largest_batch = 0
+        self.errors = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def configure(self, use_tpool, max_batch=64):
+        """Run work through eventlet's tpool (under eventlet) or on the calling thread"""
+        self.use_tpool = use_tpool
+        self.max_batch = max_batch
+
+    def call(self, fn, *args):
+        """Run `fn(*args)` in a native thread when under eventlet and return its result"""
+        if self.use_tpool:
+            from eventlet import tpool
+            return tpool.execute(fn, *args)
+        return fn(*args)
+
+    def _started(self, kind, *queued_at):
+        """Move work from queued to running and record how long it waited"""
+        now = time.monotonic()
+        waited = [now - at for at in queued_at]
+        with self.lock:
+            self.queued[kind] -= len(waited)
+            self.running[kind] += len(waited)
+            self.wait_seconds += sum(waited)
+            self.max_wait_seconds = max(self.max_wait_seconds, *waited)
+
+    def _finished(self, kind, started, count=1, errors=0):
+        with self.lock:
+            self.running[kind] -= count
+            self.calls[kind] += count
+            self.errors += errors
+            self.run_seconds += time.monotonic() - started
+
+    def read(self, fn):
+        """Run `fn(conn)` with a reader connection"""
+        with self.lock:
+            self.queued['read'] += 1
+        return self.call(self._read, fn, time.monotonic())
+
+    def _read(self, fn, queued_at):
+        from app.db import get_pool
+
+        self._started('read', queued_at)
+        started = time.monotonic()
+        failed = 0
+        if self.use_tpool:
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = get_pool().connect_reader()
+        else:
+            conn = get_pool().acquire()
+        try:
+            return fn(conn)
+        except Exception:
+            failed = 1
+            raise
+        finally:
+            if not self.use_tpool:
+                conn.close()
+            self._finished('read', started, errors=failed)
+
+    def write(self, fn):
+        """Run `fn(conn)` with the writer connection; committed once this returns, rolled back if `fn` raises"""
+        job = WriteJob(fn)
+        with self.lock:
+            self.pending.append(job)
+            self.queued['write'] += 1
+            lead, self.committing = not self.committing, True
+        if not lead:
+            job.wakeup.wait()
+        if not job.done:
+            self._lead(job)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _lead(self, own):
+        """Commit queued writes in batches until `own` is done, then hand over to the next write"""
+        from app.db import get_pool
+
+        try:
+            conn = get_pool().acquire(write=True)
+        except Exception as e:
+            with self.lock:
+                jobs = list(self.pending)
+                self.pending.clear()
+                self.committing = False
+                self.queued['write'] -= len(jobs)
+                self.errors += len(jobs)
+            for job in jobs:
+                job.error = e
+                job.done = True
+                job.wakeup.set()
+            return
+
+        try:
+            while not own.done:
+                with self.lock:
+                    jobs = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch))]
+                self._commit(conn, jobs)
+        finally:
+            conn.close()
+            with self.lock:
+                successor = self.pending[0] if self.pending else None
+                self.committing = successor is not None
+            if successor is not None:
+                successor.wakeup.set()
+
+    def _commit(self, conn, jobs):
+        try:
+            self.call(self._commit_batch, conn, jobs)
+        except BaseException as e:
+            for job in jobs:
+                job.error = job.error or e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            # Also when interrupted, so the writers in this batch do not wait for it forever
+            for job in jobs:
+                job.done = True
+                job.wakeup.set()
+
+    def _commit_batch(self, conn, jobs):
+        self._started('write', *(job.queued_at for job in jobs))
+        started = time.monotonic()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in jobs:
+                conn.execute('SAVEPOINT write_job')
+                try:
+                    job.result = job.fn(conn)
+                    conn.execute('RELEASE write_job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_job')
+                    conn.execute('RELEASE write_job')
+                    job.error = e
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._finished('write', started, len(jobs), errors=sum(job.error is not None for job in jobs))
+            with self.lock:
+                self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(jobs))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tpool': self.use_tpool,
+                'queued_reads': self.queued['read'],
+                'queued_writes': self.queued['write'],
+                'running_reads': self.running['read'],
+                'running_writes': self.running['write'],
+                'reads': self.calls['read'],
+                'writes': self.calls['write'],
+                'write_batches': self.batches,
+                'largest_write_batch': self.largest_batch,
+                'errors': self.errors,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'run_seconds': self.run_seconds,
+            }
+
+
+# Shared executor, configured in create_app
+db_executor = DatabaseExecutor()
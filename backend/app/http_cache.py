@@ -0,0 +1,135 @@
+"""Conditional GETs and response compression for the JSON API.
+
+Views wrap their response in `conditional()` to tag it with a strong
+content-hash ETag; a client that sends the tag back in If-None-Match gets
+an empty 304. `init_app` registers an after_request hook that compresses
+large JSON bodies with brotli (when installed) or gzip, according to the
+request's Accept-Encoding.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Strong ETags must differ per representation, so compressed bodies get a suffix
+ENCODING_SUFFIXES = ('br', 'gzip')
+
+
+def content_etag(body):
+    """Strong ETag value for a response body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def conditional(response, etag=None, private=True):
+    """Tag a JSON response with a strong ETag and answer 304 if the client already has it.
+
+    `etag` defaults to a hash of the body. Private responses (anything that
+    depends on the caller's identity) are kept out of shared caches.
+    """
+    if response.status_code != 200:
+        return response
+
+    if etag is None:
+        etag = content_etag(response.get_data())
+
+    if request.method in ('GET', 'HEAD') and request.if_none_match:
+        for tag in (etag, *(f'{etag}-{suffix}' for suffix in ENCODING_SUFFIXES)):
+            if request.if_none_match.contains(tag):
+                response = current_app.response_class(status=304)
+                etag = tag
+                break
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' if private else 'public, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+class CompressionCache:
+    """Compressed bodies of recent ETagged responses, so an unchanged body is compressed once"""
+
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+compressed_bodies = CompressionCache()
+
+
+def negotiate_encoding():
+    """The best encoding the client accepts, or None"""
+    accepted = request.accept_encodings
+    br, gz = accepted['br'], accepted['gzip']
+    if brotli is not None and br > 0 and br >= gz:
+        return 'br'
+    if gz > 0:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=current_app.config.get('COMPRESS_BROTLI_QUALITY', 5))
+    return gzip.compress(body, compresslevel=current_app.config.get('COMPRESS_LEVEL', 6), mtime=0)
+
+
+def compress_response(response):
+    """Compress a large JSON body if the client accepts it"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < current_app.config.get('COMPRESS_MIN_SIZE', 1024):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        key = (etag, encoding)
+        compressed = compressed_bodies.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            compressed_bodies.put(key, compressed)
+        response.set_etag(f'{etag}-{encoding}')
+    else:
+        compressed = compress(body, encoding)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    """Register the compression hook with the Flask app."""
+    if compress_response not in app.after_request_funcs.get(None, []):
+        app.after_request(compress_response)
@@ -0,0 +1,316 @@
+"""Prometheus metrics for REST routes, Socket.IO events, fan-out and the database.
+
+The collectors are in-process counters and fixed-bucket histograms with a
+native lock each (query timings also arrive from database executor
+threads), cheap enough to stay on under full load. `init_app` hooks them
+into Flask's request cycle, into Socket.IO handler registration and into the
+server's emit and send paths, so route and event handlers carry no
+instrumentation of their own.
+`/api/metrics` serves the Prometheus text format for this process; with
+several workers, scrape each one.
+"""
+import functools
+import re
+import time
+from bisect import bisect_left
+
+from flask import request
+
+from app.executor import native_lock
+
+# Seconds; socket events and queries are mostly sub-millisecond, requests slower
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = native_lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_labels(self.labels, label_values)} {_number(value)}'
+
+
+class Histogram:
+    """Fixed-bucket histogram with optional labels"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.series = {}
+        self.lock = native_lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self.series.items()]
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f'{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {_number(total)}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {cumulative}'
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if value is not None:
+            yield f'{self.name} {_number(value)}'
+
+
+class MetricsRegistry:
+    """Named collectors rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = native_lock()
+
+    def register(self, metric):
+        """Add a collector; registering a name again returns the existing one"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        """Register a gauge, replacing any earlier callback of the same name"""
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, read)
+            return self.metrics[name]
+
+    def gauges_from_stats(self, prefix, help, stats):
+        """Expose every number in a stats() dict as `<prefix>_<key>` gauges"""
+        for key, value in stats().items():
+            if isinstance(value, dict):
+                for sub_key in value:
+                    self.gauge(f'{prefix}_{key}_{sub_key}', help,
+                               lambda key=key, sub_key=sub_key: stats()[key][sub_key])
+            elif isinstance(value, (int, float)):
+                self.gauge(f'{prefix}_{key}', help, lambda key=key: stats()[key])
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry and the collectors the hooks below feed
+registry = MetricsRegistry()
+
+http_request_seconds = registry.histogram(
+    'codecollab_http_request_seconds', 'REST request latency by route', ('method', 'route', 'status'))
+socketio_event_seconds = registry.histogram(
+    'codecollab_socketio_event_seconds', 'Socket.IO handler latency by event', ('event',))
+socketio_event_errors = registry.counter(
+    'codecollab_socketio_event_errors_total', 'Socket.IO handlers that raised, by event', ('event',))
+socketio_emits = registry.counter(
+    'codecollab_socketio_emits_total', 'Events emitted by this process, by event', ('event',))
+socketio_sent_messages = registry.counter(
+    'codecollab_socketio_sent_messages_total', 'Messages written to sockets (fan-out recipients), by event', ('event',))
+socketio_sent_bytes = registry.counter(
+    'codecollab_socketio_sent_bytes_total', 'Encoded bytes written to sockets, by event', ('event',))
+db_query_seconds = registry.histogram(
+    'codecollab_db_query_seconds', 'SQLite statement execution time by statement kind and table', ('statement',))
+
+_statement_labels = {}
+_STATEMENT_TABLE = re.compile(r'\b(?:from|into|update|table(?: if not exists)?)\s+([A-Za-z_][A-Za-z0-9_]*)', re.I)
+
+
+def statement_label(sql):
+    """Low-cardinality label for a statement, e.g. 'select rooms'"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        label = words[0].lower() if words else 'empty'
+        table = _STATEMENT_TABLE.search(sql)
+        if table:
+            label = f'{label} {table.group(1)}'
+        # Statements are constants or built from a few fixed fragments; guard anyway
+        if len(_statement_labels) < 1000:
+            _statement_labels[sql] = label
+    return label
+
+
+def observe_query(sql, started):
+    db_query_seconds.observe(time.perf_counter() - started, statement_label(sql))
+
+
+def _packet_event(data):
+    """Event name of an encoded Socket.IO EVENT packet: JSON such as '2["code-op",{...}]' or MessagePack"""
+    if isinstance(data, str):
+        if data[:1] == '2':
+            start = data.find('["')
+            if start != -1:
+                end = data.find('"', start + 2)
+                if end != -1:
+                    return data[start + 2:end]
+    elif isinstance(data, bytes):
+        # {'type': 2, 'data': [event, ...], ...} as app.serializer packs it; the event is a short str
+        start = data.find(b'\xa4data\x92', 0, 16)
+        if start != -1 and data[1:6] == b'\xa4type' and data[6] == 2:
+            header = data[start + 6]
+            if 0xa0 <= header <= 0xbf:
+                return data[start + 7:start + 7 + header - 0xa0].decode('utf-8', 'replace')
+            if header == 0xd9:
+                return data[start + 8:start + 8 + data[start + 7]].decode('utf-8', 'replace')
+    return '_protocol'
+
+
+def timed_handler(event, handler):
+    """Wrap a Socket.IO handler to record its latency and errors under `event`"""
+    @functools.wraps(handler)
+    def timed(*args):
+        started = time.perf_counter()
+        try:
+            return handler(*args)
+        except Exception:
+            socketio_event_errors.inc(event)
+            raise
+        finally:
+            socketio_event_seconds.observe(time.perf_counter() - started, event)
+    return timed
+
+
+def instrument_transport(server):
+    """Count messages and bytes per event where frames are handed to Engine.IO.
+
+    Install it before anything else wraps `send_packet` (the packet codecs,
+    the outbox), so it sees frames as they are written: MessagePack where a
+    client negotiated it, and only the frames an outbox released.
+    """
+    eio = server.eio
+    if getattr(eio, 'metrics_counted', False):
+        return
+    send_packet = eio.send_packet
+
+    def counted_send_packet(sid, pkt):
+        data = pkt.data
+        event = _packet_event(data)
+        socketio_sent_messages.inc(event)
+        if isinstance(data, (str, bytes)):
+            # Socket.IO JSON is ASCII-escaped, so characters are bytes
+            socketio_sent_bytes.inc(event, amount=len(data))
+        return send_packet(sid, pkt)
+
+    eio.send_packet = counted_send_packet
+    eio.metrics_counted = True
+
+
+def instrument_socketio(socketio):
+    """Time every Socket.IO handler registered from now on and count emits, recipients and bytes per event"""
+    on = socketio.on
+    if not getattr(on, 'metrics_wrapped', False):
+        def timed_on(message, namespace=None):
+            register = on(message, namespace)
+
+            def decorator(handler):
+                register(timed_handler(message, handler))
+                return handler
+            return decorator
+        timed_on.metrics_wrapped = True
+        socketio.on = timed_on
+
+    server = socketio.server
+    emit = server.emit
+    if not getattr(emit, 'metrics_wrapped', False):
+        def counted_emit(event, *args, **kwargs):
+            socketio_emits.inc(event)
+            return emit(event, *args, **kwargs)
+        counted_emit.metrics_wrapped = True
+        server.emit = counted_emit
+
+    # Every frame to a client, broadcast or not, leaves through send_packet
+    instrument_transport(server)
+
+
+def init_app(app, socketio=None):
+    """Time REST requests, instrument Socket.IO and serve /api/metrics."""
+    if 'metrics' in app.view_functions:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        request.environ['codecollab.started'] = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = request.environ.get('codecollab.started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else '<unmatched>'
+            http_request_seconds.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+        return response
+
+    def metrics():
+        return app.response_class(registry.render(), mimetype='text/plain', headers={
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+        })
+
+    app.add_url_rule('/api/metrics', 'metrics', metrics)
+
+    if socketio is not None:
+        instrument_socketio(socketio)
@@ -0,0 +1,249 @@
+"""Versioned schema migrations and query-plan checks.
+
+Migrations are numbered and applied in order, each in its own transaction,
+and recorded in the schema_migrations table. Never edit a migration that
+has shipped; add a new one instead.
+
+    python -m app.migrations upgrade   # apply pending migrations
+    python -m app.migrations status    # show the current version
+    python -m app.migrations check     # fail if a hot query regressed to a scan
+"""
+import sqlite3
+import sys
+
+from app.db import database_path
+
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            owner_id INTEGER NOT NULL,
+            language TEXT DEFAULT 'javascript',
+            code TEXT DEFAULT '',
+            video_enabled INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_members (
+            room_id INTEGER,
+            user_id INTEGER,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (room_id, user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms (id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+    (2, 'room listing and membership indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_rooms_created ON rooms (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_rooms_language_created ON rooms (language, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_rooms_owner_created ON rooms (owner_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members (user_id, room_id)',
+    ]),
+    (3, 'chat history', [
+        '''
+        CREATE TABLE chat_messages (
+            room_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (room_id, seq),
+            FOREIGN KEY (room_id) REFERENCES rooms (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        # Messages kept per room; NULL uses the server default
+        'ALTER TABLE rooms ADD COLUMN chat_retention INTEGER',
+    ]),
+    (4, 'document revision history', [
+        # Revision of rooms.code, so revision numbers continue across restarts
+        'ALTER TABLE rooms ADD COLUMN revision INTEGER NOT NULL DEFAULT 0',
+        '''
+        CREATE TABLE document_revisions (
+            room_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            snapshot INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            compacted INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (room_id, revision),
+            FOREIGN KEY (room_id) REFERENCES rooms (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX idx_document_revisions_uncompacted
+        ON document_revisions (created_at, room_id) WHERE compacted = 0
+        ''',
+    ]),
+]
+
+# Queries on the request and socket hot paths, with representative parameters.
+# Each must be answered by an index SEARCH; a SCAN, even one walking an index
+# in order, means a filter lost its index and the query reads every row.
+HOT_QUERIES = [
+    ('user by id', 'SELECT id, username, email FROM users WHERE id = ?', (1,)),
+    ('user by username', 'SELECT * FROM users WHERE username = ?', ('name',)),
+    ('user by username or email', 'SELECT * FROM users WHERE username = ? OR email = ?', ('name', 'mail')),
+    ('room by id', 'SELECT * FROM rooms WHERE id = ?', (1,)),
+    ('room by name', 'SELECT * FROM rooms WHERE name = ?', ('name',)),
+    ('room state', 'SELECT code, revision, language, video_enabled, chat_retention FROM rooms WHERE id = ?', (1,)),
+    ('recent chat', '''
+        SELECT seq, user_id, username, message, created_at FROM chat_messages
+        WHERE room_id = ? ORDER BY seq DESC LIMIT ?
+    ''', (1, 50)),
+    ('chat history page', '''
+        SELECT seq, user_id, username, message, created_at FROM chat_messages
+        WHERE room_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?
+    ''', (1, 100, 51)),
+    ('nearest snapshot', '''
+        SELECT revision FROM document_revisions WHERE room_id = ? AND revision <= ? AND snapshot = 1
+        ORDER BY revision DESC LIMIT 1
+    ''', (1, 100)),
+    ('revision chain', '''
+        SELECT revision, snapshot, data FROM document_revisions
+        WHERE room_id = ? AND revision >= ? AND revision <= ? ORDER BY revision
+    ''', (1, 50, 100)),
+    ('revision list', '''
+        SELECT revision, snapshot, length, created_at FROM document_revisions
+        WHERE room_id = ? AND revision < ? ORDER BY revision DESC LIMIT ?
+    ''', (1, 100, 51)),
+    ('rooms to compact', '''
+        SELECT room_id FROM document_revisions WHERE compacted = 0 AND created_at < ? LIMIT ?
+    ''', (0.0, 5000)),
+    ('chat retention trim', 'DELETE FROM chat_messages WHERE room_id = ? AND seq <= ?', (1, 10)),
+    ('membership check', 'SELECT * FROM room_members WHERE room_id = ? AND user_id = ?', (1, 1)),
+    ('room roster', '''
+        SELECT u.id, u.username, u.email
+        FROM users u
+        JOIN room_members rm ON u.id = rm.user_id
+        WHERE rm.room_id = ?
+    ''', (1,)),
+    ('room listing page', '''
+        SELECT r.id, r.created_at, r.name FROM rooms r
+        WHERE (r.created_at, r.id) < (?, ?)
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', ('2030-01-01', 1, 51)),
+    ('room listing by language', '''
+        SELECT r.id, r.created_at, r.name FROM rooms r
+        WHERE r.language = ?
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', ('python', 51)),
+    ('room listing by owner', '''
+        SELECT r.id, r.created_at, r.name FROM rooms r
+        WHERE r.owner_id = ?
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', (1, 51)),
+    ('member room listing', '''
+        SELECT r.id, r.created_at, r.name FROM rooms r
+        JOIN room_members rm ON rm.room_id = r.id AND rm.user_id = ?
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+    ''', (1, 51)),
+]
+
+
+class QueryPlanRegression(Exception):
+    """Raised when a hot query is planned as a full scan."""
+
+
+def current_version(conn):
+    """The highest applied migration number (0 for a new database)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn, target=None):
+    """Apply pending migrations up to `target` and return their numbers"""
+    applied = []
+    version = current_version(conn)
+    conn.commit()
+
+    for number, name, statements in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (number, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(number)
+
+    return applied
+
+
+def table_scans(conn):
+    """Hot queries whose plan scans a table or whole index, as (name, plan detail) pairs"""
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall():
+            detail = row[3]
+            if detail.startswith('SCAN'):
+                problems.append((name, detail))
+    return problems
+
+
+def check_query_plans(conn):
+    """Raise QueryPlanRegression if any hot query regressed to a full scan"""
+    problems = table_scans(conn)
+    if problems:
+        raise QueryPlanRegression('; '.join(f'{name}: {detail}' for name, detail in problems))
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'upgrade'
+    conn = sqlite3.connect(database_path())
+
+    try:
+        if command == 'upgrade':
+            applied = migrate(conn)
+            print(f"Applied migrations: {', '.join(map(str, applied)) or 'none'}")
+            print(f"Schema version: {current_version(conn)}")
+        elif command == 'status':
+            version = current_version(conn)
+            latest = MIGRATIONS[-1][0]
+            print(f"Schema version: {version} (latest {latest})")
+            for number, name, _ in MIGRATIONS:
+                print(f"  {'x' if number <= version else ' '} {number:04d} {name}")
+        elif command == 'check':
+            migrate(conn)
+            problems = table_scans(conn)
+            for name, detail in problems:
+                print(f"FULL SCAN  {name}: {detail}")
+            if problems:
+                return 1
+            print(f"All {len(HOT_QUERIES)} hot queries use an index search")
+        else:
+            print(__doc__)
+            return 2
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
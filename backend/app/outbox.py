@@ -0,0 +1,281 @@
+"""Bounded outbound queues for slow Socket.IO consumers.
+
+Engine.IO queues every packet for a socket without limit, so a client on a
+slow link in a busy room makes the server hold more and more frames, most
+of them stale by the time they are sent. Once a socket has `high_water`
+packets waiting in Engine.IO, further packets are held here instead and
+released as the socket catches up. While held:
+
+- `cursor-batch` frames of the same room merge, keeping the latest cursor
+  per user; `cursor-update` frames from the same user replace each other;
+- a `code-resync` replaces an older one for the same room.
+
+A socket holding more than `max_frames` frames or `max_bytes` bytes has
+fallen too far behind to catch up by replaying edits. Its held document
+frames (`code-op` and `code-resync`) are dropped and a single `resync`
+directive takes their place, `{rooms: [{roomId, revision}]}`, naming the
+revision each room was last intact at, or null where a dropped
+`code-resync` means the client needs the whole document. Document frames
+for those rooms that arrive before the directive is sent are dropped too,
+so no operation reaches the client both live and in the catch-up. The
+client answers the directive with `resume`, which returns the missed
+operations (or a full `sync-code`). A socket that is still over the limit
+after that is disconnected; it can reconnect with its resume token.
+"""
+import logging
+import threading
+from collections import deque
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+from app.serializer import NegotiatedPacket
+
+logger = logging.getLogger(__name__)
+
+# Frames that change a client's copy of a room document
+DOCUMENT_EVENTS = ('code-op', 'code-resync')
+
+
+def event_name(pkt):
+    """Event name of an encoded Socket.IO event in the default namespace, or None"""
+    data = pkt.data
+    if pkt.packet_type != eio_packet.MESSAGE or not isinstance(data, str) or not data.startswith('2["'):
+        return None
+    return data[3:data.find('"', 3)]
+
+
+def event_payload(pkt):
+    return NegotiatedPacket(encoded_packet=pkt.data).data[1]
+
+
+def event_packet(event, data):
+    """An Engine.IO message carrying a Socket.IO event, encoded as the server would"""
+    return eio_packet.Packet(eio_packet.MESSAGE, NegotiatedPacket(packet.EVENT, data=[event, data]).encode())
+
+
+def merge_cursor_batches(old, new):
+    cursors = {cursor['userId']: cursor for cursor in old['cursors']}
+    cursors.update((cursor['userId'], cursor) for cursor in new['cursors'])
+    return {**new, 'cursors': list(cursors.values())}
+
+
+class HeldFrame:
+    """A packet waiting in an outbox; `pkt` is None once it has been dropped"""
+
+    __slots__ = ('pkt', 'event', 'key', 'size')
+
+    def __init__(self, pkt, event, key):
+        self.pkt = pkt
+        self.event = event
+        self.key = key
+        self.size = len(pkt.data) if isinstance(pkt.data, (str, bytes)) else 0
+
+
+class Outbox:
+    """Frames held for one socket, oldest first"""
+
+    __slots__ = ('frames', 'keys', 'count', 'bytes', 'lost', 'directive', 'overflowed')
+
+    def __init__(self):
+        self.frames = deque()
+        self.keys = {}  # coalescing key -> HeldFrame
+        self.count = 0
+        self.bytes = 0
+        self.lost = {}  # room_id -> last intact revision (None: resend it all), for the pending resync directive
+        self.directive = None
+        self.overflowed = False
+
+
+class OutboundQueues:
+    """Holds, coalesces and sheds packets for sockets that cannot keep up"""
+
+    def __init__(self, high_water=64, max_frames=512, max_bytes=32 * 1024 * 1024, interval=0.05):
+        self.high_water = high_water
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.boxes = {}  # eio_sid -> Outbox
+        self.lock = threading.Lock()
+        self.server = None
+        self.send_packet = None
+        self.task = None
+
+        self.held = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.disconnects = 0
+
+    def configure(self, high_water, max_frames, max_bytes, interval):
+        """Set the Engine.IO backlog that starts holding (0 disables), the outbox limits and the drain interval"""
+        self.high_water = high_water
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+    @property
+    def enabled(self):
+        return self.high_water > 0
+
+    def install(self, server):
+        """Hook a socketio.Server; install after the packet codecs so held frames are still JSON"""
+        send_packet = server.eio.send_packet
+        if getattr(send_packet, 'outbox_wrapped', False):
+            return
+        self.server = server
+        self.send_packet = send_packet
+
+        def queued_send_packet(eio_sid, pkt):
+            if not self.enabled:
+                return send_packet(eio_sid, pkt)
+            with self.lock:
+                box = self.boxes.get(eio_sid)
+                if box is None:
+                    if self.backlog(eio_sid) < self.high_water:
+                        return send_packet(eio_sid, pkt)
+                    box = self.boxes[eio_sid] = Outbox()
+                self._hold(box, pkt)
+
+        queued_send_packet.outbox_wrapped = True
+        server.eio.send_packet = queued_send_packet
+
+    def start(self, socketio):
+        """Start releasing held frames as sockets catch up"""
+        if self.task is None and self.enabled:
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Outbox drain failed')
+
+    def backlog(self, eio_sid):
+        """Packets waiting in Engine.IO's queue for a socket"""
+        socket = self.server.eio.sockets.get(eio_sid)
+        return socket.queue.qsize() if socket is not None else 0
+
+    def _key(self, event, pkt):
+        if event == 'cursor-batch':
+            return event, event_payload(pkt).get('roomId')
+        if event == 'cursor-update':
+            return event, event_payload(pkt).get('userId')
+        if event == 'code-resync':
+            return event, event_payload(pkt).get('roomId')
+        return None
+
+    def _hold(self, box, pkt):
+        if box.overflowed:
+            self.dropped += 1
+            return
+        event = event_name(pkt)
+        if box.lost and event in DOCUMENT_EVENTS and str(event_payload(pkt).get('roomId')) in box.lost:
+            # The resync directive for this room will catch the client up, this included
+            self.dropped += 1
+            return
+        key = self._key(event, pkt)
+        held = box.keys.get(key) if key is not None else None
+        if held is not None and held.pkt is not None:
+            if event == 'cursor-batch':
+                pkt = event_packet(event, merge_cursor_batches(event_payload(held.pkt), event_payload(pkt)))
+            box.bytes -= held.size
+            held.pkt = pkt
+            held.size = len(pkt.data)
+            box.bytes += held.size
+            self.coalesced += 1
+            return
+
+        frame = HeldFrame(pkt, event, key)
+        box.frames.append(frame)
+        if key is not None:
+            box.keys[key] = frame
+        box.count += 1
+        box.bytes += frame.size
+        self.held += 1
+        if box.count > self.max_frames or box.bytes > self.max_bytes:
+            self._shed(box)
+
+    def _shed(self, box):
+        """Replace held document frames with a resync directive, or give up on the socket"""
+        for frame in box.frames:
+            if frame.event not in DOCUMENT_EVENTS or frame.pkt is None:
+                continue
+            data = event_payload(frame.pkt)
+            room_id = str(data.get('roomId'))
+            # Before a code-resync the client's copy is not usable as a base for operations
+            intact = data.get('revision', 1) - 1 if frame.event == 'code-op' else None
+            known = box.lost.get(room_id, intact)
+            box.lost[room_id] = None if intact is None or known is None else min(known, intact)
+            if frame.key is not None and box.keys.get(frame.key) is frame:
+                del box.keys[frame.key]
+            box.count -= 1
+            box.bytes -= frame.size
+            frame.pkt = None
+            self.dropped += 1
+
+        if box.lost and box.directive is None:
+            box.directive = HeldFrame(eio_packet.Packet(eio_packet.MESSAGE, ''), 'resync', None)
+            box.frames.append(box.directive)
+            box.count += 1
+        if box.count > self.max_frames or box.bytes > self.max_bytes:
+            box.overflowed = True
+
+    def drain(self):
+        """Release held frames to sockets with room in their Engine.IO queue"""
+        with self.lock:
+            for eio_sid, box in list(self.boxes.items()):
+                if eio_sid not in self.server.eio.sockets:
+                    del self.boxes[eio_sid]
+                elif box.overflowed:
+                    del self.boxes[eio_sid]
+                    self.disconnects += 1
+                    self.dropped += box.count
+                    self.server.eio.start_background_task(self.server.eio.disconnect, eio_sid)
+                else:
+                    self._release(eio_sid, box)
+
+    def _release(self, eio_sid, box):
+        space = self.high_water - self.backlog(eio_sid)
+        if space < self.high_water // 2:
+            return
+        while box.frames and space > 0:
+            frame = box.frames.popleft()
+            if frame.key is not None and box.keys.get(frame.key) is frame:
+                del box.keys[frame.key]
+            if frame.pkt is None:
+                continue
+            if frame is box.directive:
+                frame.pkt = event_packet('resync', {
+                    'reason': 'slow-consumer',
+                    'rooms': [{'roomId': room_id, 'revision': revision} for room_id, revision in box.lost.items()]
+                })
+                box.directive = None
+                box.lost = {}
+                self.resyncs += 1
+            box.count -= 1
+            box.bytes -= frame.size
+            space -= 1
+            self.send_packet(eio_sid, frame.pkt)
+        if not box.frames:
+            del self.boxes[eio_sid]
+
+    def stats(self):
+        with self.lock:
+            sockets = len(self.boxes)
+            frames = sum(box.count for box in self.boxes.values())
+        return {
+            'sockets_held': sockets,
+            'frames_held_now': frames,
+            'frames_held': self.held,
+            'frames_coalesced': self.coalesced,
+            'frames_dropped': self.dropped,
+            'resyncs_sent': self.resyncs,
+            'slow_disconnects': self.disconnects,
+        }
+
+
+# Shared outbound queues, installed by create_app
+outbound_queues = OutboundQueues()
@@ -0,0 +1,494 @@
+"""Users, rooms and memberships behind one interface, on SQLite or PostgreSQL.
+
+Routes and socket handlers call `repository` instead of writing SQL:
+
+    user = repository.get_user(user_id)
+    if repository.add_member(room_id, user_id):
+        ...
+
+Each statement is written once, with `?` placeholders, and runs on the
+backend that `DATABASE_URL` selects:
+
+- `sqlite:///path` (or unset): the application's SQLite file, through
+  `db_executor`, so queries run off the event loop and writes are
+  group-committed. sqlite3's per-connection statement cache keeps the
+  statements compiled.
+- `postgresql://...`: a pool of psycopg2 connections. A connection prepares
+  each statement on the server (PREPARE) the first time it runs it and only
+  EXECUTEs it after that, so hot queries are parsed and planned once per
+  connection. Queries run in executor threads too. Documents are stored as
+  plain text; PostgreSQL compresses large values itself.
+
+Chat history and document revisions stay in the SQLite file with either
+backend; they are keyed by room ID and written in batches of their own.
+"""
+import queue
+import threading
+import time
+
+from app.db import PoolTimeout
+from app.executor import db_executor
+from app.metrics import observe_query
+from app.rooms.storage import text_codec
+
+ROOM_COLUMNS = ('id', 'name', 'owner_id', 'language', 'code', 'video_enabled', 'created_at',
+                'chat_retention', 'revision')
+ROOM_SELECT = f"SELECT {', '.join(ROOM_COLUMNS)} FROM rooms WHERE id = ?"
+
+ROSTER_SELECT = '''
+    SELECT u.id, u.username, u.email
+    FROM users u
+    JOIN room_members rm ON u.id = rm.user_id
+    WHERE rm.room_id = ?
+'''
+
+# Timestamps match SQLite's CURRENT_TIMESTAMP text, so both backends return the same format
+POSTGRES_NOW = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+
+POSTGRES_SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TEXT NOT NULL DEFAULT {POSTGRES_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS rooms (
+        id BIGSERIAL PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        owner_id BIGINT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        language TEXT DEFAULT 'javascript',
+        code TEXT DEFAULT '',
+        video_enabled INTEGER DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT {POSTGRES_NOW},
+        chat_retention INTEGER,
+        revision INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS room_members (
+        room_id BIGINT REFERENCES rooms (id) ON DELETE CASCADE,
+        user_id BIGINT REFERENCES users (id) ON DELETE CASCADE,
+        joined_at TEXT NOT NULL DEFAULT {POSTGRES_NOW},
+        PRIMARY KEY (room_id, user_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_rooms_created ON rooms (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_rooms_language_created ON rooms (language, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_rooms_owner_created ON rooms (owner_id, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members (user_id, room_id)',
+]
+
+
+class SQLiteSession:
+    """Runs repository statements on a pooled SQLite connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def one(self, sql, params=()):
+        rows = self.conn.execute(sql, params).fetchall()
+        return dict(rows[0]) if rows else None
+
+    def all(self, sql, params=()):
+        return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def run(self, sql, params=()):
+        """Execute a statement and return the number of rows it changed"""
+        return self.conn.execute(sql, params).rowcount
+
+
+class SQLiteBackend:
+    """The application's SQLite file, via the database executor"""
+
+    name = 'sqlite'
+
+    def read(self, fn):
+        return db_executor.read(lambda conn: fn(SQLiteSession(conn)))
+
+    def write(self, fn):
+        return db_executor.write(lambda conn: fn(SQLiteSession(conn)))
+
+    def encode_document(self, text):
+        return text_codec.encode(text)
+
+    def init_schema(self):
+        """Nothing to do: app.migrations owns the SQLite schema"""
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class PreparedConnection:
+    """A psycopg2 connection and the statements prepared on it so far"""
+
+    def __init__(self, raw, max_statements):
+        from psycopg2.extras import RealDictCursor
+
+        self.raw = raw
+        self.cursor = raw.cursor(cursor_factory=RealDictCursor)
+        self.max_statements = max_statements
+        self.statements = {}  # repository SQL -> EXECUTE statement for it
+        self.uncommitted = []  # SQL prepared in the current transaction
+        self.prepares = 0
+
+    def statement(self, sql):
+        """The EXECUTE statement for `sql`, preparing it on the server the first time"""
+        execute = self.statements.get(sql)
+        if execute is None:
+            if len(self.statements) >= self.max_statements:
+                # Statements are built from a few fixed fragments; this only guards a runaway
+                self.cursor.execute('DEALLOCATE ALL')
+                self.statements.clear()
+            # Names are never reused, so a statement orphaned by a rollback cannot clash
+            name = f'codecollab_{self.prepares}'
+            parts = sql.split('?')
+            numbered = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+            self.cursor.execute(f'PREPARE {name} AS {numbered}')
+            args = ', '.join(['%s'] * (len(parts) - 1))
+            execute = self.statements[sql] = f'EXECUTE {name} ({args})' if args else f'EXECUTE {name}'
+            self.uncommitted.append(sql)
+            self.prepares += 1
+        return execute
+
+    def commit(self):
+        self.raw.commit()
+        self.uncommitted = []
+
+    def rollback(self):
+        """Roll back, preparing again any statement first prepared in the rolled-back transaction"""
+        if not self.raw.closed:
+            self.raw.rollback()
+        for sql in self.uncommitted:
+            self.statements.pop(sql, None)
+        self.uncommitted = []
+
+
+class PostgresSession:
+    """Runs repository statements on a pooled PostgreSQL connection as prepared statements"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _execute(self, sql, params):
+        started = time.perf_counter()
+        try:
+            self.conn.cursor.execute(self.conn.statement(sql), params)
+        finally:
+            observe_query(sql, started)
+        return self.conn.cursor
+
+    def one(self, sql, params=()):
+        cursor = self._execute(sql, params)
+        row = cursor.fetchone() if cursor.description else None
+        return dict(row) if row else None
+
+    def all(self, sql, params=()):
+        return [dict(row) for row in self._execute(sql, params).fetchall()]
+
+    def run(self, sql, params=()):
+        """Execute a statement and return the number of rows it changed"""
+        return self._execute(sql, params).rowcount
+
+
+class PostgresBackend:
+    """PostgreSQL through a pool of connections with server-side prepared statements"""
+
+    name = 'postgresql'
+
+    def __init__(self, dsn, size=4, timeout=5.0, max_statements=256):
+        try:
+            import psycopg2
+        except ImportError:
+            raise RuntimeError('The psycopg2 package is required for a postgresql:// DATABASE_URL')
+
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.max_statements = max_statements
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.broken = 0
+
+    def _connect(self):
+        return PreparedConnection(self.psycopg2.connect(self.dsn), self.max_statements)
+
+    def acquire(self):
+        """Check out a connection, opening one while under `size` and waiting up to `timeout` otherwise"""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                opening = self.opened < self.size
+                if opening:
+                    self.opened += 1
+            if opening:
+                try:
+                    conn = db_executor.call(self._connect)
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                self.waits += 1
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    self.timeouts += 1
+                    raise PoolTimeout('Timed out waiting for a PostgreSQL connection')
+        self.checkouts += 1
+        return conn
+
+    def release(self, conn):
+        """Return a connection, or drop it if the server closed it"""
+        if conn.raw.closed:
+            self.broken += 1
+            with self.lock:
+                self.opened -= 1
+        else:
+            self.idle.put(conn)
+
+    def _transaction(self, conn, fn):
+        try:
+            result = fn(PostgresSession(conn))
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _run(self, fn):
+        conn = self.acquire()
+        try:
+            return db_executor.call(self._transaction, conn, fn)
+        finally:
+            self.release(conn)
+
+    def read(self, fn):
+        return self._run(fn)
+
+    def write(self, fn):
+        return self._run(fn)
+
+    def encode_document(self, text):
+        return text
+
+    def init_schema(self):
+        """Create the tables and indexes if they do not exist yet"""
+        conn = self.acquire()
+        try:
+            def create(conn):
+                for statement in POSTGRES_SCHEMA:
+                    conn.cursor.execute(statement)
+                conn.commit()
+            db_executor.call(create, conn)
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'size': self.size,
+            'open_connections': self.opened,
+            'idle_connections': self.idle.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'broken_connections': self.broken,
+        }
+
+
+def create_backend(url, pool_size=4, timeout=5.0):
+    """Build a repository backend from a DATABASE_URL"""
+    if not url or url.startswith('sqlite:'):
+        return SQLiteBackend()
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(url, pool_size, timeout)
+    raise ValueError(f'Unsupported DATABASE_URL: {url}')
+
+
+def _decode_room(room):
+    if room is not None and 'code' in room:
+        room['code'] = text_codec.decode(room['code'])
+    return room
+
+
+class Repository:
+    """Queries and updates for users, rooms and room memberships"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or SQLiteBackend()
+
+    def configure(self, backend):
+        self.backend = backend
+
+    def init_schema(self):
+        self.backend.init_schema()
+
+    # Users
+
+    def get_user(self, user_id):
+        """A user's id, username and email, or None"""
+        return self.backend.read(lambda s: s.one(
+            'SELECT id, username, email FROM users WHERE id = ?', (int(user_id),)))
+
+    def get_profile(self, user_id):
+        """A user's public fields including created_at, or None"""
+        return self.backend.read(lambda s: s.one(
+            'SELECT id, username, email, created_at FROM users WHERE id = ?', (int(user_id),)))
+
+    def find_user_by_username(self, username):
+        """A user with their password hash, for logging in"""
+        return self.backend.read(lambda s: s.one(
+            'SELECT id, username, email, password_hash FROM users WHERE username = ?', (username,)))
+
+    def create_user(self, username, email, password_hash):
+        """Insert a user and return their ID, or None if the username or email is taken"""
+        def create(s):
+            if s.one('SELECT id FROM users WHERE username = ? OR email = ?', (username, email)):
+                return None
+            return s.one(
+                'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?) RETURNING id',
+                (username, email, password_hash))['id']
+        return self.backend.write(create)
+
+    # Rooms
+
+    def list_rooms(self, columns, limit, member_id=None, language=None, owner_id=None, after=None):
+        """Rooms newest first; `columns` must be room column names, `after` a (created_at, id) keyset position"""
+        query = [f"SELECT {', '.join('r.' + c for c in columns)} FROM rooms r"]
+        conditions = []
+        params = []
+
+        if member_id is not None:
+            query.append('JOIN room_members rm ON rm.room_id = r.id AND rm.user_id = ?')
+            params.append(int(member_id))
+        if language:
+            conditions.append('r.language = ?')
+            params.append(language)
+        if owner_id:
+            conditions.append('r.owner_id = ?')
+            params.append(owner_id)
+        if after is not None:
+            conditions.append('(r.created_at, r.id) < (?, ?)')
+            params.extend(after)
+
+        if conditions:
+            query.append('WHERE ' + ' AND '.join(conditions))
+        query.append('ORDER BY r.created_at DESC, r.id DESC LIMIT ?')
+        params.append(limit)
+
+        rooms = self.backend.read(lambda s: s.all(' '.join(query), params))
+        return [_decode_room(room) for room in rooms]
+
+    def create_room(self, name, owner_id, language):
+        """Create a room with its owner as the first member; None if the name is taken"""
+        def create(s):
+            if s.one('SELECT id FROM rooms WHERE name = ?', (name,)):
+                return None
+            room_id = s.one(
+                'INSERT INTO rooms (name, owner_id, language) VALUES (?, ?, ?) RETURNING id',
+                (name, int(owner_id), language))['id']
+            s.run('INSERT INTO room_members (room_id, user_id) VALUES (?, ?)', (room_id, int(owner_id)))
+            return s.one(ROOM_SELECT, (room_id,))
+        return _decode_room(self.backend.write(create))
+
+    def room_exists(self, room_id):
+        return self.backend.read(lambda s: s.one('SELECT id FROM rooms WHERE id = ?', (room_id,))) is not None
+
+    def get_room(self, room_id):
+        """A room with its document decoded, or None"""
+        return _decode_room(self.backend.read(lambda s: s.one(ROOM_SELECT, (room_id,))))
+
+    def load_room(self, room_id):
+        """A room and its members (id, username, email) read together, or None"""
+        def load(s):
+            room = s.one(ROOM_SELECT, (room_id,))
+            if room is None:
+                return None
+            return _decode_room(room), s.all(ROSTER_SELECT, (room_id,))
+        return self.backend.read(load)
+
+    def room_owner(self, room_id):
+        """The owner's user ID, or None if the room does not exist"""
+        room = self.backend.read(lambda s: s.one('SELECT owner_id FROM rooms WHERE id = ?', (room_id,)))
+        return room['owner_id'] if room else None
+
+    def delete_room(self, room_id):
+        """Delete a room and its memberships"""
+        def delete(s):
+            s.run('DELETE FROM room_members WHERE room_id = ?', (room_id,))
+            return s.run('DELETE FROM rooms WHERE id = ?', (room_id,)) > 0
+        return self.backend.write(delete)
+
+    def toggle_video(self, room_id, owner_id):
+        """Flip video on or off for the owner's room; returns id, name and video_enabled, or None"""
+        return self.backend.write(lambda s: s.one('''
+            UPDATE rooms SET video_enabled = CASE WHEN video_enabled = 0 THEN 1 ELSE 0 END
+            WHERE id = ? AND owner_id = ?
+            RETURNING id, name, video_enabled
+        ''', (room_id, int(owner_id))))
+
+    def set_chat_retention(self, room_id, owner_id, retention):
+        """Set the owner's room chat retention; False if no such room is theirs"""
+        return self.backend.write(lambda s: s.run(
+            'UPDATE rooms SET chat_retention = ? WHERE id = ? AND owner_id = ?',
+            (retention, room_id, int(owner_id)))) > 0
+
+    def set_language(self, room_id, language):
+        self.backend.write(lambda s: s.run(
+            'UPDATE rooms SET language = ? WHERE id = ?', (language, int(room_id))))
+
+    def save_documents(self, documents):
+        """Store (room_id, code, revision) triples in one transaction.
+
+        A revision of None keeps the stored one. A row never goes back to an
+        older revision: rows whose stored revision is newer than the one given
+        (a late flush from a worker that no longer owns the room) are left
+        alone. Returns the IDs of rooms that were not written.
+        """
+        rows = [(room_id, self.backend.encode_document(code), revision) for room_id, code, revision in documents]
+
+        def save(s):
+            return [room_id for room_id, code, revision in rows if not s.run(
+                'UPDATE rooms SET code = ?, revision = COALESCE(?, revision) '
+                'WHERE id = ? AND revision <= COALESCE(?, revision)',
+                (code, revision, int(room_id), revision))]
+        return self.backend.write(save)
+
+    # Memberships
+
+    def is_member(self, room_id, user_id):
+        return self.backend.read(lambda s: s.one(
+            'SELECT 1 AS member FROM room_members WHERE room_id = ? AND user_id = ?',
+            (room_id, int(user_id)))) is not None
+
+    def add_member(self, room_id, user_id):
+        """Add a user to a room; False if they already were a member"""
+        return self.backend.write(lambda s: s.run(
+            'INSERT INTO room_members (room_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING',
+            (int(room_id), int(user_id)))) > 0
+
+    def remove_member(self, room_id, user_id):
+        """Remove a user from a room; False if they were not a member"""
+        return self.backend.write(lambda s: s.run(
+            'DELETE FROM room_members WHERE room_id = ? AND user_id = ?', (room_id, int(user_id)))) > 0
+
+    def list_members(self, room_id):
+        return self.backend.read(lambda s: s.all(ROSTER_SELECT, (room_id,)))
+
+    def stats(self):
+        return self.backend.stats()
+
+
+# Shared repository, configured in create_app from DATABASE_URL
+repository = Repository()
@@ -0,0 +1,198 @@
+"""Admission control for Socket.IO connections and rate limits for socket events.
+
+After a restart every client reconnects at once. Connections are admitted
+through token buckets per client IP and per user, and at most
+`max_handshakes` connections are authenticated at the same time. A
+refused connection gets a retry delay with jitter, so the clients that
+were turned away do not all come back in the same instant.
+
+Events that a single client can send in a tight loop (full-document
+`code-change`, `chat-message`, `cursor-position`) have a bucket per
+socket, so one noisy client cannot monopolise the worker.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token; returns 0 if one was available, else the seconds until there is one"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BucketTable:
+    """Token buckets by key, forgetting the least recently used beyond `max_entries`"""
+
+    def __init__(self, rate, burst, max_entries=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+
+    def take(self, key, now):
+        if self.rate <= 0:
+            return 0
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now)
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+def parse_event_limits(spec):
+    """{event: (rate, burst)} from 'code-change=20/40,chat-message=2/10'"""
+    limits = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        event, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        limits[event.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class AdmissionControl:
+    """Connection buckets, the handshake cap and per-socket event buckets"""
+
+    def __init__(self):
+        self.ips = BucketTable(2, 10)
+        self.users = BucketTable(1, 5)
+        self.max_handshakes = 32
+        self.retry_base = 1.0
+        self.retry_max = 30.0
+        self.trusted_proxies = 0
+        self.event_limits = {}
+        self.event_buckets = {}  # sid -> {event: TokenBucket}
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+        self.handshakes_started = 0
+        self.rejected_ip = 0
+        self.rejected_user = 0
+        self.rejected_busy = 0
+        self.events_rejected = 0
+
+    def configure(self, ip_rate, ip_burst, user_rate, user_burst, max_handshakes, retry_base, retry_max,
+                  trusted_proxies, event_limits):
+        """Set the connection buckets (rate 0 disables one), the handshake cap (0 disables it),
+        the retry delay range, the proxies in front of the app and the per-event limits"""
+        self.ips = BucketTable(ip_rate, ip_burst)
+        self.users = BucketTable(user_rate, user_burst)
+        self.max_handshakes = max_handshakes
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.trusted_proxies = trusted_proxies
+        self.event_limits = event_limits
+
+    def client_ip(self, environ):
+        """The client address, read from X-Forwarded-For as set by the trusted proxies"""
+        if self.trusted_proxies > 0:
+            forwarded = [ip.strip() for ip in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+            if len(forwarded) >= self.trusted_proxies:
+                return forwarded[-self.trusted_proxies]
+        return environ.get('REMOTE_ADDR')
+
+    def retry_after(self, wait=0):
+        """Seconds a refused client should wait: at least `wait`, spread over up to twice that"""
+        delay = min(self.retry_max, max(wait, self.retry_base))
+        return round(random.uniform(delay, min(2 * delay, self.retry_max)), 2)
+
+    def admit_ip(self, ip):
+        """None if a connection from `ip` may proceed, else the retry delay"""
+        with self.lock:
+            wait = self.ips.take(ip, time.monotonic())
+        if wait:
+            self.rejected_ip += 1
+            return self.retry_after(wait)
+        return None
+
+    def admit_user(self, user_id):
+        """None if a connection for `user_id` may proceed, else the retry delay"""
+        with self.lock:
+            wait = self.users.take(user_id, time.monotonic())
+        if wait:
+            self.rejected_user += 1
+            return self.retry_after(wait)
+        return None
+
+    def begin_handshake(self):
+        """None if a handshake slot was taken (release it with end_handshake), else the retry delay"""
+        with self.lock:
+            if self.max_handshakes > 0 and self.handshakes >= self.max_handshakes:
+                self.rejected_busy += 1
+                busy = True
+            else:
+                self.handshakes += 1
+                self.handshakes_started += 1
+                busy = False
+        return self.retry_after() if busy else None
+
+    def end_handshake(self):
+        with self.lock:
+            self.handshakes -= 1
+
+    def admit_event(self, sid, event):
+        """None if `sid` may send `event` now, else the seconds until it may"""
+        limit = self.event_limits.get(event)
+        if limit is None or limit[0] <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.event_buckets.setdefault(sid, {})
+            bucket = buckets.get(event)
+            if bucket is None:
+                bucket = buckets[event] = TokenBucket(limit[0], limit[1], now)
+            wait = bucket.take(now)
+        if wait:
+            self.events_rejected += 1
+            return max(round(wait, 2), 0.01)
+        return None
+
+    def forget(self, sid):
+        """Drop a disconnected socket's event buckets"""
+        with self.lock:
+            self.event_buckets.pop(sid, None)
+
+    def stats(self):
+        with self.lock:
+            handshakes = self.handshakes
+            ips, users, sockets = len(self.ips), len(self.users), len(self.event_buckets)
+        return {
+            'handshakes_in_flight': handshakes,
+            'max_handshakes': self.max_handshakes,
+            'handshakes_started': self.handshakes_started,
+            'rejected_ip': self.rejected_ip,
+            'rejected_user': self.rejected_user,
+            'rejected_busy': self.rejected_busy,
+            'events_rejected': self.events_rejected,
+            'tracked_ips': ips,
+            'tracked_users': users,
+            'tracked_sockets': sockets,
+        }
+
+
+# Shared admission state, configured in init_socket_events
+admission = AdmissionControl()
@@ -0,0 +1,225 @@
+"""Room affinity: every room is served by one owning worker.
+
+With several workers behind a message queue, the editors of a room end up
+spread over all of them, so every edit crosses the queue and each worker
+keeps its own copy of the room's state. With `WORKER_URL` set, each worker
+heartbeats into the socket registry with the URL clients reach it at, and
+all of them map room IDs onto the live workers with the same consistent
+hash ring. A room event for a room owned elsewhere is answered with
+
+    room-redirect {roomId, worker, url}
+
+and the client connects to `url` (with the same JWT) and joins there, so a
+room's document, chat, presence and fan-out stay in one process and
+workers scale with cores instead of with queue throughput.
+
+Workers that stop heartbeating leave the ring after `WORKER_TTL` seconds; a
+worker that shuts down cleanly leaves at once. Each worker has
+`ROOM_RING_REPLICAS` points on the ring, placed by its URL so that a
+restarted worker gets its rooms back, and a worker coming or going moves
+only the rooms on its arcs, about 1/N of them. The previous owner of a
+moved room writes its document and chat, forgets its cached state and
+redirects the room's sockets to the new owner.
+
+Workers see a rebalance at their own next heartbeat, so for a moment two of
+them can both think they own a room. To keep them from both taking edits,
+a worker only serves a room while it holds the room's lease in the
+registry. A new owner that finds the lease still held sends clients to the
+holder, which keeps serving until it has written the room and released the
+lease; the new owner then loads what was written. A lease is only taken
+from a worker that stopped heartbeating, and a worker that finds one of
+its leases taken drops what it held for the room instead of writing it.
+"""
+import atexit
+import hashlib
+import logging
+import time
+from bisect import bisect
+
+from app.rooms.registry import MemoryRegistry, worker_id
+
+logger = logging.getLogger(__name__)
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring of nodes, each placed at `replicas` points"""
+
+    def __init__(self, nodes=(), replicas=160):
+        self.nodes = frozenset(nodes)
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        """The node owning `key`: the first point clockwise from its hash"""
+        if not self.points:
+            return None
+        return self.owners[bisect(self.points, ring_hash(str(key))) % len(self.points)]
+
+
+class RoomAffinity:
+    """Decides which worker owns each room and keeps the ring in step with the live workers"""
+
+    def __init__(self, url=None, heartbeat_interval=5.0, ttl=15.0, replicas=160, worker=None):
+        self.url = url
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self.replicas = replicas
+        self.worker = worker or worker_id()
+        self.urls = {self.worker: url}  # live worker -> URL
+        self.workers = {url: self.worker}  # URL -> worker, for the ring's nodes
+        self.ring = HashRing([url], replicas)
+        self.leases = set()  # rooms this worker holds the lease of
+        self.registry = None
+        self.on_change = None
+        self.on_claim = None
+        self.unreleased = 0  # rooms the last on_change could not hand over
+        self.task = None
+
+        self.redirects = 0
+        self.rebalances = 0
+        self.rooms_moved = 0
+        self.handoff_waits = 0
+        self.leases_lost = 0
+        self.heartbeat_errors = 0
+
+    def configure(self, url, heartbeat_interval, ttl, replicas):
+        """Set this worker's public URL (None disables affinity), the heartbeat timing and ring replicas"""
+        self.url = url
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self.replicas = replicas
+        self.urls = {self.worker: url}
+        self.workers = {url: self.worker}
+        self.ring = HashRing([url], replicas)
+
+    @property
+    def enabled(self):
+        return bool(self.url)
+
+    def start(self, socketio, registry, on_change, on_claim=None):
+        """Join the ring and keep heartbeating.
+
+        `on_change()` runs after a rebalance or a lost lease and returns how
+        many rooms it could not hand over yet; it runs again on the next
+        heartbeat until that is 0. `on_claim(room_id)` runs when this worker
+        takes a room's lease, before it serves the room.
+        """
+        if self.task is not None or not self.enabled:
+            return
+        if isinstance(registry, MemoryRegistry):
+            logger.warning('WORKER_URL is set but the socket registry is per process; every worker will own every room')
+        self.attach(registry, on_change, on_claim)
+        self.refresh()
+        atexit.register(self.retire)
+        self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.heartbeat_interval)
+            try:
+                self.refresh()
+            except Exception:
+                self.heartbeat_errors += 1
+                logger.exception('Worker heartbeat failed')
+
+    def attach(self, registry, on_change, on_claim=None):
+        """Use `registry` for heartbeats and leases, without starting the heartbeat task"""
+        self.registry = registry
+        self.on_change = on_change
+        self.on_claim = on_claim
+
+    def refresh(self, now=None):
+        """Heartbeat, then rebuild the ring if workers joined or left; returns True if it changed"""
+        now = now or time.time()
+        self.registry.heartbeat(self.worker, self.url, now)
+        urls = self.registry.live_workers(self.ttl, now)
+        urls[self.worker] = self.url
+        changed = urls != self.urls
+        if changed:
+            joined = set(urls) - set(self.urls)
+            left = set(self.urls) - set(urls)
+            self.urls = urls
+            self.workers = {url: worker for worker, url in urls.items()}
+            self.workers[self.url] = self.worker
+            self.ring = HashRing(self.workers, self.replicas)
+            self.rebalances += 1
+            logger.info(f'Room ring rebalanced: {len(urls)} workers, joined {sorted(joined)}, left {sorted(left)}')
+
+        # Leases another worker took while this one missed its heartbeats
+        lost = self.leases - set(self.registry.rooms_held(self.worker)) if self.leases else set()
+        if lost:
+            self.leases -= lost
+            self.leases_lost += len(lost)
+            logger.warning(f'Lost the lease of rooms {sorted(lost)} to other workers')
+
+        if (changed or lost or self.unreleased) and self.on_change is not None:
+            try:
+                self.unreleased = self.on_change()
+            except Exception:
+                logger.exception('Handing rooms over after a rebalance failed')
+        return changed
+
+    def retire(self):
+        """Leave the ring so other workers take over this worker's rooms without waiting for the TTL"""
+        if self.registry is not None:
+            try:
+                self.registry.retire(self.worker)
+            except Exception:
+                logger.exception('Could not leave the room ring')
+
+    def elsewhere(self, room_id, now=None):
+        """(worker, url) to send a room's clients to if this worker does not serve it, else None.
+
+        That is the room's owner on the ring, or, while a previous owner still
+        holds the room's lease, that previous owner. The url is None if the
+        holder left before its address could be looked up.
+        """
+        if not self.enabled:
+            return None
+        url = self.ring.owner(room_id)
+        if url is not None and url != self.url:
+            return self.workers[url], url
+
+        room_id = str(room_id)
+        if room_id in self.leases:
+            return None
+        now = now or time.time()
+        holder = self.registry.claim_room(room_id, self.worker, self.ttl, now)
+        if holder == self.worker:
+            self.leases.add(room_id)
+            if self.on_claim is not None:
+                self.on_claim(room_id)
+            return None
+        self.handoff_waits += 1
+        return holder, self.registry.live_workers(self.ttl, now).get(holder)
+
+    def holds(self, room_id):
+        """True if this worker still holds the room's lease in the registry"""
+        return self.registry.room_holder(str(room_id)) == self.worker
+
+    def release(self, room_id):
+        """Give up a room's lease so its new owner can take it"""
+        self.leases.discard(str(room_id))
+        self.registry.release_room(str(room_id), self.worker)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'workers': len(self.urls),
+            'redirects': self.redirects,
+            'rebalances': self.rebalances,
+            'rooms_moved': self.rooms_moved,
+            'leases': len(self.leases),
+            'handoff_waits': self.handoff_waits,
+            'leases_lost': self.leases_lost,
+            'heartbeat_errors': self.heartbeat_errors,
+        }
+
+
+# Shared room affinity, configured in init_socket_events
+affinity = RoomAffinity()
@@ -0,0 +1,88 @@
+"""Coalesced cursor/awareness broadcasting.
+
+Cursor moves only update the latest position per user per room. A
+background task sends one `cursor-batch` frame per room per tick, so
+fan-out is bounded by the tick rate instead of the input rate. Clients
+receive their own cursor in the batch too and should skip it.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CursorBatcher:
+    """Keeps the latest cursor per user per room and flushes them once per tick"""
+
+    def __init__(self, rate=20.0):
+        self.rate = rate
+        self.pending = {}  # room_id -> {user_id: cursor}
+        self.lock = threading.Lock()
+        self.task = None
+
+        self.updates = 0
+        self.superseded = 0
+        self.frames = 0
+
+    def configure(self, rate):
+        """Set the flush rate in frames per second (0 disables batching)"""
+        self.rate = rate
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def start(self, socketio):
+        """Start the flusher on the socketio async backend"""
+        if self.task is None and self.enabled:
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        interval = 1.0 / self.rate
+        while True:
+            socketio.sleep(interval)
+            try:
+                self.flush(socketio)
+            except Exception:
+                logger.exception('Cursor batch flush failed')
+
+    def update(self, room_id, user_id, username, position):
+        """Record a cursor move, replacing any position not yet sent"""
+        with self.lock:
+            room = self.pending.setdefault(str(room_id), {})
+            if user_id in room:
+                self.superseded += 1
+            room[user_id] = {'userId': user_id, 'username': username, 'position': position}
+            self.updates += 1
+
+    def discard(self, room_id, user_id):
+        """Drop a pending cursor, e.g. when its user leaves the room"""
+        with self.lock:
+            room = self.pending.get(str(room_id))
+            if room:
+                room.pop(user_id, None)
+
+    def flush(self, socketio):
+        """Send one cursor-batch frame to every room with pending moves"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for room_id, cursors in pending.items():
+            if cursors:
+                socketio.emit('cursor-batch', {'roomId': room_id, 'cursors': list(cursors.values())}, to=room_id)
+                self.frames += 1
+
+    def stats(self):
+        with self.lock:
+            pending_rooms = len(self.pending)
+        return {
+            'rate_hz': self.rate,
+            'updates': self.updates,
+            'superseded': self.superseded,
+            'frames': self.frames,
+            'pending_rooms': pending_rooms,
+        }
+
+
+# Shared batcher for the application, configured in init_socket_events
+cursor_batcher = CursorBatcher()
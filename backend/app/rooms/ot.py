@@ -0,0 +1,259 @@
+"""Operational transform engine for collaborative code editing.
+
+An operation is a list of components applied in order to a text buffer:
+
+    {'type': 'insert', 'position': 4, 'text': 'abc'}
+    {'type': 'delete', 'position': 10, 'length': 2}
+
+Clients send operations against the revision they last saw. The server
+rebases them over everything applied since that revision, applies them to
+the authoritative document and broadcasts the rebased operation, so the
+payload scales with the size of the edit instead of the size of the file.
+"""
+import threading
+from collections import deque
+
+
+class OperationError(ValueError):
+    """Raised when an operation is malformed or does not fit the document."""
+
+
+class RevisionError(OperationError):
+    """Raised when an operation is based on a revision the server no longer has."""
+
+
+class DocumentTooLarge(OperationError):
+    """Raised when an edit would grow a document past its maximum length."""
+
+
+def insert(position, text):
+    """Build an insert component"""
+    return {'type': 'insert', 'position': position, 'text': text}
+
+
+def delete(position, length):
+    """Build a delete component"""
+    return {'type': 'delete', 'position': position, 'length': length}
+
+
+def normalize_operation(ops):
+    """Validate a client supplied operation and return a clean copy"""
+    if isinstance(ops, dict):
+        ops = [ops]
+    if not isinstance(ops, list):
+        raise OperationError('Operation must be a list of components')
+
+    normalized = []
+    for component in ops:
+        if not isinstance(component, dict):
+            raise OperationError('Operation components must be objects')
+
+        position = component.get('position')
+        if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+            raise OperationError('Component position must be a non-negative integer')
+
+        if component.get('type') == 'insert':
+            text = component.get('text')
+            if not isinstance(text, str):
+                raise OperationError('Insert text must be a string')
+            if text:
+                normalized.append(insert(position, text))
+        elif component.get('type') == 'delete':
+            length = component.get('length')
+            if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+                raise OperationError('Delete length must be a non-negative integer')
+            if length:
+                normalized.append(delete(position, length))
+        else:
+            raise OperationError(f"Unknown component type: {component.get('type')}")
+
+    return normalized
+
+
+def apply_operation(text, ops):
+    """Apply an operation to a string and return the new string"""
+    for component in ops:
+        position = component['position']
+        if component['type'] == 'insert':
+            if position > len(text):
+                raise OperationError('Insert position is past the end of the document')
+            text = text[:position] + component['text'] + text[position:]
+        else:
+            end = position + component['length']
+            if end > len(text):
+                raise OperationError('Delete range is past the end of the document')
+            text = text[:position] + text[end:]
+    return text
+
+
+def operation_size(ops):
+    """Return the number of characters an operation touches"""
+    return sum(len(c['text']) if c['type'] == 'insert' else c['length'] for c in ops)
+
+
+def _transform_component(component, other, wins):
+    """Rebase one component over a concurrent one.
+
+    Returns a list because a delete that spans a concurrent insert has to be
+    split around the inserted text. `wins` breaks ties between inserts at the
+    same position: the winning insert stays in front.
+    """
+    position = component['position']
+
+    if component['type'] == 'insert':
+        if other['type'] == 'insert':
+            if position < other['position'] or (position == other['position'] and wins):
+                return [component]
+            return [insert(position + len(other['text']), component['text'])]
+
+        other_end = other['position'] + other['length']
+        if position <= other['position']:
+            return [component]
+        if position >= other_end:
+            return [insert(position - other['length'], component['text'])]
+        return [insert(other['position'], component['text'])]
+
+    length = component['length']
+    end = position + length
+
+    if other['type'] == 'insert':
+        inserted = len(other['text'])
+        if other['position'] <= position:
+            return [delete(position + inserted, length)]
+        if other['position'] >= end:
+            return [component]
+        # The insert landed inside the deleted range; keep the inserted text
+        before = other['position'] - position
+        return [
+            delete(position, before),
+            delete(position + inserted, length - before),
+        ]
+
+    other_start = other['position']
+    other_end = other_start + other['length']
+    overlap = max(0, min(end, other_end) - max(position, other_start))
+    shift = max(0, min(position, other_end) - other_start)
+    if length - overlap == 0:
+        return []
+    return [delete(position - shift, length - overlap)]
+
+
+def transform(ops, other, wins=False):
+    """Transform two concurrent operations against each other.
+
+    Returns (ops', other') such that applying other then ops' gives the same
+    text as applying ops then other'.
+    """
+    if not ops or not other:
+        return ops, other
+
+    if len(ops) == 1 and len(other) == 1:
+        return (
+            _transform_component(ops[0], other[0], wins),
+            _transform_component(other[0], ops[0], not wins),
+        )
+
+    if len(ops) > 1:
+        head, other = transform(ops[:1], other, wins)
+        tail, other = transform(ops[1:], other, wins)
+        return head + tail, other
+
+    ops, other_head = transform(ops, other[:1], wins)
+    ops, other_tail = transform(ops, other[1:], wins)
+    return ops, other_head + other_tail
+
+
+def diff_operation(old, new):
+    """Build a minimal single-region operation turning `old` into `new`"""
+    if old == new:
+        return []
+
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while (suffix < limit - prefix
+           and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]):
+        suffix += 1
+
+    ops = []
+    removed = len(old) - prefix - suffix
+    if removed:
+        ops.append(delete(prefix, removed))
+    added = new[prefix:len(new) - suffix]
+    if added:
+        ops.append(insert(prefix, added))
+    return ops
+
+
+class Document:
+    """Authoritative revisioned text buffer for one room.
+
+    Keeps a bounded window of recently applied operations so clients that
+    are a few revisions behind can still have their edits rebased. Clients
+    further behind than the window must resync.
+    """
+
+    def __init__(self, text='', revision=0, history_limit=500, max_length=None):
+        self.text = text or ''
+        self.revision = revision
+        self.history = deque(maxlen=history_limit)
+        self.max_length = max_length
+        self.lock = threading.Lock()
+
+    def _check_length(self, length):
+        if self.max_length and length > self.max_length:
+            raise DocumentTooLarge(
+                f'Document would be {length} characters; the maximum is {self.max_length}'
+            )
+
+    def apply(self, ops, base_revision):
+        """Rebase `ops` from `base_revision` onto the head and apply them.
+
+        Returns (applied ops, new revision).
+        """
+        with self.lock:
+            if not isinstance(base_revision, int) or base_revision > self.revision:
+                raise RevisionError(f'Unknown revision {base_revision}')
+
+            behind = self.revision - base_revision
+            if behind > len(self.history):
+                raise RevisionError(f'Revision {base_revision} is too old to rebase')
+
+            if behind:
+                for concurrent in list(self.history)[-behind:]:
+                    ops, _ = transform(ops, concurrent)
+
+            self._check_length(len(self.text) + sum(
+                len(c['text']) if c['type'] == 'insert' else -c['length'] for c in ops
+            ))
+            self.text = apply_operation(self.text, ops)
+            self.history.append(ops)
+            self.revision += 1
+            return ops, self.revision
+
+    def replace(self, text):
+        """Replace the whole buffer, recording the change as a delta.
+
+        Used for clients that still send full documents. An unchanged
+        buffer returns no ops and keeps the current revision.
+        """
+        with self.lock:
+            self._check_length(len(text))
+            ops = diff_operation(self.text, text)
+            if not ops:
+                return ops, self.revision
+            self.text = text
+            self.history.append(ops)
+            self.revision += 1
+            return ops, self.revision
+
+    def operations_since(self, revision):
+        """Return the operations applied after `revision`, or None if they are gone"""
+        with self.lock:
+            behind = self.revision - revision
+            if behind < 0 or behind > len(self.history):
+                return None
+            return list(self.history)[len(self.history) - behind:]
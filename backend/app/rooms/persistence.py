@@ -0,0 +1,156 @@
+"""Write-behind persistence for room documents.
+
+Edits only mark a room dirty in memory. Dirty rooms are written in one
+batched transaction on a fixed interval, when a room goes idle and at
+shutdown, instead of an UPDATE + COMMIT per keystroke. Documents go
+through the repository, so they land in whichever database holds the rooms;
+in SQLite large documents are stored compressed (see app.rooms.storage).
+With a revision store configured, each flushed room also gets a revision in
+its history, which is kept in SQLite. A write the database refuses because it
+already holds a newer revision is dropped, not retried.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from app.executor import db_executor
+from app.repository import repository
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Coalesces document writes per room and flushes them in batches"""
+
+    def __init__(self, interval=2.0, revisions=None):
+        self.interval = interval
+        self.revisions = revisions
+        self.dirty = {}  # room_id -> (code, revision, first dirtied at)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.task = None
+
+        self.flushes = 0
+        self.rooms_flushed = 0
+        self.flush_errors = 0
+        self.stale_writes = 0
+        self.last_flush_at = None
+        self.last_flush_duration = 0.0
+        self.last_flush_lag = 0.0
+
+    def configure(self, interval, revisions=None):
+        """Set the flush interval and optional revision store"""
+        self.interval = interval
+        self.revisions = revisions
+
+    def start(self, socketio):
+        """Start the periodic flusher and make sure dirty rooms are written at exit"""
+        if self.task is not None:
+            return
+        atexit.register(self.flush)
+        if self.interval > 0:
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+
+    def mark_dirty(self, room_id, code, revision=None):
+        """Record the latest code (and its revision) for a room; the first write since the last flush sets its age"""
+        key = str(room_id)
+        with self.lock:
+            entry = self.dirty.get(key)
+            self.dirty[key] = (code, revision, entry[2] if entry else time.monotonic())
+
+        # An interval of 0 means write-through
+        if self.interval <= 0:
+            self.flush([key])
+
+    def is_dirty(self, room_id):
+        """True if the room has code waiting to be written"""
+        with self.lock:
+            return str(room_id) in self.dirty
+
+    def discard(self, room_id):
+        """Forget pending writes for a room, e.g. because it was deleted"""
+        with self.lock:
+            self.dirty.pop(str(room_id), None)
+
+    def flush(self, room_ids=None):
+        """Write dirty rooms (all of them, or just `room_ids`) in a single batch"""
+        with self.lock:
+            if room_ids is None:
+                pending, self.dirty = self.dirty, {}
+            else:
+                pending = {}
+                for room_id in room_ids:
+                    entry = self.dirty.pop(str(room_id), None)
+                    if entry is not None:
+                        pending[str(room_id)] = entry
+
+        if not pending:
+            return 0
+
+        started = time.monotonic()
+        with self.flush_lock:
+            try:
+                stale = repository.save_documents(
+                    [(room_id, code, revision) for room_id, (code, revision, _) in pending.items()])
+                for room_id in stale:
+                    # Another writer already stored a newer revision; this copy is out of date
+                    logger.warning('Dropped stale write of room %s at revision %s', room_id, pending[room_id][1])
+                    del pending[room_id]
+                self.stale_writes += len(stale)
+                if self.revisions is not None:
+                    db_executor.write(lambda conn: self._record(conn, pending))
+            except Exception:
+                self.flush_errors += 1
+                if self.revisions is not None:
+                    self.revisions.forget(pending)
+                # Put the rooms back unless they were edited again in the meantime
+                with self.lock:
+                    for room_id, entry in pending.items():
+                        self.dirty.setdefault(room_id, entry)
+                raise
+
+        finished = time.monotonic()
+        self.flushes += 1
+        self.rooms_flushed += len(pending)
+        self.last_flush_at = time.time()
+        self.last_flush_duration = finished - started
+        self.last_flush_lag = max((finished - dirtied for _, _, dirtied in pending.values()), default=0.0)
+        return len(pending)
+
+    def _record(self, conn, pending):
+        for room_id, (code, revision, _) in pending.items():
+            if revision is not None:
+                self.revisions.record(conn, room_id, revision, code)
+
+    def stats(self):
+        """Dirty-room and flush-lag metrics"""
+        now = time.monotonic()
+        with self.lock:
+            dirty_rooms = len(self.dirty)
+            oldest = min((dirtied for _, _, dirtied in self.dirty.values()), default=None)
+
+        return {
+            'dirty_rooms': dirty_rooms,
+            'flush_lag_seconds': now - oldest if oldest is not None else 0.0,
+            'flush_interval_seconds': self.interval,
+            'flushes': self.flushes,
+            'rooms_flushed': self.rooms_flushed,
+            'flush_errors': self.flush_errors,
+            'stale_writes': self.stale_writes,
+            'last_flush_at': self.last_flush_at,
+            'last_flush_duration_seconds': self.last_flush_duration,
+            'last_flush_lag_seconds': self.last_flush_lag,
+        }
+
+
+# Shared buffer for the application, configured in init_socket_events
+write_behind = WriteBehindBuffer()
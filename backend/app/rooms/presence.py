@@ -0,0 +1,297 @@
+"""Live presence: who is online in each room right now.
+
+Room membership (`room_members`) records everyone who ever joined a room.
+Presence tracks the sockets currently in it, when each was last heard from
+and whether its user is active or idle. Connect, join, leave and disconnect
+maintain it, and so does any event a socket sends: edits, cursor moves and
+chat mark it active, and `presence` heartbeats keep it alive or report it
+idle. A socket with no activity for `idle_after` seconds turns idle. A
+socket not heard from for `expire_after` seconds, which died without a
+disconnect, leaves every room. If it turns out to be alive after all, its
+next event brings it back.
+
+Changes are broadcast as `presence-diff` events holding only what changed,
+per user rather than per socket, so a second tab does not announce its
+user twice. Sockets are kept in order of last contact, which makes the
+periodic sweep cost proportional to the sockets that expire or go idle.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = 'active'
+IDLE = 'idle'
+
+
+class PresenceSocket:
+    """One connected socket: its user, the rooms it is in and when it was last heard from"""
+
+    __slots__ = ('sid', 'user', 'rooms', 'last_seen', 'active')
+
+    def __init__(self, sid, user, now):
+        self.sid = sid
+        self.user = user  # {'id', 'username'}
+        self.rooms = set()
+        self.last_seen = now
+        self.active = True
+
+
+class PresenceTracker:
+    """Online sockets per room, with heartbeat expiry and idle detection"""
+
+    def __init__(self, idle_after=60, expire_after=90, sweep_interval=5):
+        self.idle_after = idle_after
+        self.expire_after = expire_after
+        self.sweep_interval = sweep_interval
+        self.sockets = {}  # sid -> PresenceSocket
+        self.rooms = {}  # room_id -> {user_id: set of sids}
+        self.seen = OrderedDict()  # sid -> last contact, oldest first
+        self.activity = OrderedDict()  # sid -> last activity of active sockets, oldest first
+        self.lock = threading.Lock()
+        self.task = None
+
+        self.diffs_sent = 0
+        self.expired = 0
+        self.idled = 0
+
+    def configure(self, idle_after, expire_after, sweep_interval):
+        """Set the seconds until a quiet socket is idle and until a silent one expires (0 disables each)"""
+        self.idle_after = idle_after
+        self.expire_after = expire_after
+        self.sweep_interval = sweep_interval
+
+    def start(self, socketio):
+        """Start the expiry and idle sweep"""
+        if self.task is None and self.sweep_interval > 0 and (self.idle_after > 0 or self.expire_after > 0):
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.sweep_interval)
+            try:
+                for room_id, diff in self.sweep():
+                    socketio.emit('presence-diff', diff, to=room_id)
+            except Exception:
+                logger.exception('Presence sweep failed')
+
+    # Changes are collected per room as {'joined': {user_id: None}, 'left': set, 'idle': set, 'active': set}
+
+    def _entry(self, sids):
+        user = self.sockets[next(iter(sids))].user
+        return {
+            'id': user['id'],
+            'username': user['username'],
+            'state': self._state(sids),
+            'lastSeen': max(self.sockets[sid].last_seen for sid in sids)
+        }
+
+    def _state(self, sids):
+        return ACTIVE if any(self.sockets[sid].active for sid in sids) else IDLE
+
+    @staticmethod
+    def _change(changes, room_id):
+        return changes.setdefault(room_id, {'joined': {}, 'left': set(), 'idle': set(), 'active': set()})
+
+    def _join(self, changes, socket, room_id):
+        if room_id in socket.rooms:
+            return
+        socket.rooms.add(room_id)
+        users = self.rooms.setdefault(room_id, {})
+        user_id = socket.user['id']
+        sids = users.get(user_id)
+        if sids is None:
+            sids = users[user_id] = set()
+            before = None
+        else:
+            before = self._state(sids)
+        sids.add(socket.sid)
+        change = self._change(changes, room_id)
+        if before is None:
+            change['left'].discard(user_id)
+            change['joined'][user_id] = None
+        elif before != self._state(sids):
+            change[ACTIVE].add(user_id)
+
+    def _leave(self, changes, socket, room_id):
+        if room_id not in socket.rooms:
+            return
+        socket.rooms.discard(room_id)
+        users = self.rooms.get(room_id, {})
+        user_id = socket.user['id']
+        sids = users.get(user_id)
+        if not sids:
+            return
+        before = self._state(sids)
+        sids.discard(socket.sid)
+        change = self._change(changes, room_id)
+        if not sids:
+            del users[user_id]
+            if not users:
+                del self.rooms[room_id]
+            if user_id in change['joined']:
+                del change['joined'][user_id]
+            else:
+                change['left'].add(user_id)
+            change[IDLE].discard(user_id)
+            change[ACTIVE].discard(user_id)
+        elif before != self._state(sids):
+            change[IDLE].add(user_id)
+
+    def _set_active(self, changes, socket, active):
+        if active is None or socket.active == active:
+            return
+        before = {room_id: self._state(self.rooms[room_id][socket.user['id']]) for room_id in socket.rooms}
+        socket.active = active
+        for room_id, state in before.items():
+            after = self._state(self.rooms[room_id][socket.user['id']])
+            if after != state:
+                change = self._change(changes, room_id)
+                change[IDLE if after == IDLE else ACTIVE].add(socket.user['id'])
+                change[ACTIVE if after == IDLE else IDLE].discard(socket.user['id'])
+
+    def _remove(self, changes, sid):
+        socket = self.sockets.get(sid)
+        if socket is None:
+            return
+        for room_id in list(socket.rooms):
+            self._leave(changes, socket, room_id)
+        del self.sockets[sid]
+        self.seen.pop(sid, None)
+        self.activity.pop(sid, None)
+
+    def _diffs(self, changes):
+        """presence-diff payloads for the collected changes, leaving out rooms where nothing changed"""
+        diffs = []
+        for room_id, change in changes.items():
+            diff = {'roomId': room_id}
+            users = self.rooms.get(room_id, {})
+            joined = [self._entry(users[user_id]) for user_id in change['joined'] if user_id in users]
+            if joined:
+                diff['joined'] = joined
+            for key in ('left', IDLE, ACTIVE):
+                if change[key]:
+                    diff[key] = sorted(change[key])
+            if len(diff) > 1:
+                diffs.append((room_id, diff))
+        self.diffs_sent += len(diffs)
+        return diffs
+
+    def _touch(self, socket, now, active):
+        socket.last_seen = now
+        self.seen[socket.sid] = now
+        self.seen.move_to_end(socket.sid)
+        if active:
+            self.activity[socket.sid] = now
+            self.activity.move_to_end(socket.sid)
+        elif active is not None:
+            self.activity.pop(socket.sid, None)
+
+    def connect(self, sid, user):
+        """Start tracking a socket that has not joined a room yet"""
+        now = time.time()
+        with self.lock:
+            if sid not in self.sockets:
+                socket = self.sockets[sid] = PresenceSocket(sid, {'id': user['id'], 'username': user['username']}, now)
+                self._touch(socket, now, True)
+
+    def join(self, sid, room_id):
+        """Put a socket in a room; returns the room's diff, or None if its user was already there"""
+        changes = {}
+        now = time.time()
+        with self.lock:
+            socket = self.sockets.get(sid)
+            if socket is None:
+                return None
+            self._touch(socket, now, True)
+            self._set_active(changes, socket, True)
+            self._join(changes, socket, str(room_id))
+            diffs = self._diffs(changes)
+        return diffs[0][1] if diffs else None
+
+    def leave(self, sid, room_id):
+        """Take a socket out of a room; returns the room's diff, or None if its user is still there"""
+        changes = {}
+        with self.lock:
+            socket = self.sockets.get(sid)
+            if socket is None:
+                return None
+            self._leave(changes, socket, str(room_id))
+            diffs = self._diffs(changes)
+        return diffs[0][1] if diffs else None
+
+    def disconnect(self, sid):
+        """Stop tracking a socket; returns (room_id, diff) for every room it leaves"""
+        changes = {}
+        with self.lock:
+            self._remove(changes, sid)
+            return self._diffs(changes)
+
+    def touch(self, sid, active=True, user=None, rooms=()):
+        """Record contact from a socket; returns (room_id, diff) for state changes.
+
+        `active` reports the user active or idle; None only keeps the
+        socket alive. A socket that expired but is still sending is tracked again with
+        `user` and put back in `rooms`.
+        """
+        changes = {}
+        now = time.time()
+        with self.lock:
+            socket = self.sockets.get(sid)
+            if socket is None:
+                if user is None:
+                    return []
+                socket = self.sockets[sid] = PresenceSocket(sid, {'id': user['id'], 'username': user['username']}, now)
+                for room_id in rooms:
+                    self._join(changes, socket, str(room_id))
+            self._touch(socket, now, active)
+            self._set_active(changes, socket, active)
+            return self._diffs(changes)
+
+    def sweep(self, now=None):
+        """Expire silent sockets and mark quiet ones idle; returns (room_id, diff) for each changed room"""
+        now = now or time.time()
+        changes = {}
+        with self.lock:
+            if self.expire_after > 0:
+                while self.seen:
+                    sid, last_seen = next(iter(self.seen.items()))
+                    if now - last_seen < self.expire_after:
+                        break
+                    self._remove(changes, sid)
+                    self.expired += 1
+            if self.idle_after > 0:
+                while self.activity:
+                    sid, last_active = next(iter(self.activity.items()))
+                    if now - last_active < self.idle_after:
+                        break
+                    del self.activity[sid]
+                    self._set_active(changes, self.sockets[sid], False)
+                    self.idled += 1
+            return self._diffs(changes)
+
+    def online(self, room_id):
+        """Users online in a room, with their state and last contact"""
+        with self.lock:
+            users = self.rooms.get(str(room_id), {})
+            return [self._entry(sids) for sids in users.values()]
+
+    def stats(self):
+        with self.lock:
+            sockets = len(self.sockets)
+            active = len(self.activity)
+            rooms = len(self.rooms)
+        return {
+            'sockets': sockets,
+            'active_sockets': active,
+            'rooms': rooms,
+            'diffs_sent': self.diffs_sent,
+            'sockets_expired': self.expired,
+            'sockets_idled': self.idled,
+        }
+
+
+# Shared presence table, configured in init_socket_events
+presence = PresenceTracker()
@@ -0,0 +1,487 @@
+"""Socket registries shared by every worker serving the same Socket.IO cluster.
+
+A registry records which user each socket belongs to and which rooms it has
+joined, so signaling and room rosters work whichever worker a socket landed
+on. Workers also heartbeat into it with the URL clients reach them at, which
+is how they agree on room owners (see app.rooms.affinity), and hold a lease
+on each room they serve, so a room changes hands only once its previous
+owner let go of it or died. Backends are selected by URL:
+
+    memory://                       single process (default, used in tests)
+    sqlite:////tmp/presence.db      several processes on one host
+    redis://localhost:6379/0        several hosts (needs the `redis` package)
+
+Entries of a worker that died without cleaning up are purged by the others:
+the SQLite registry checks whether the process still exists, and each Redis
+worker refreshes a key that expires `ttl` seconds after its last refresh.
+"""
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from app.executor import db_executor, native_lock
+
+logger = logging.getLogger(__name__)
+
+
+def worker_id():
+    """Identify this worker process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class MemoryRegistry:
+    """Process-local registry"""
+
+    def __init__(self):
+        self.sockets = {}  # sid -> user dict
+        self.rooms = {}  # sid -> set of room IDs
+        self.by_user = {}  # user_id -> set of sids
+        self.by_room = {}  # room_id -> set of sids
+        self.workers = {}  # worker -> (url, last heartbeat)
+        self.leases = {}  # room_id -> worker serving it
+        self.lock = threading.Lock()
+
+    def add(self, sid, user):
+        with self.lock:
+            self.sockets[sid] = user
+            self.rooms[sid] = set()
+            self.by_user.setdefault(user['id'], set()).add(sid)
+
+    def remove(self, sid):
+        with self.lock:
+            user = self.sockets.pop(sid, None)
+            for room_id in self.rooms.pop(sid, ()):
+                self._unindex_room(sid, room_id)
+            if user is None:
+                return
+            sids = self.by_user.get(user['id'])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.by_user[user['id']]
+
+    def _unindex_room(self, sid, room_id):
+        sids = self.by_room.get(room_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.by_room[room_id]
+
+    def join(self, sid, room_id):
+        with self.lock:
+            if sid in self.rooms:
+                self.rooms[sid].add(str(room_id))
+                self.by_room.setdefault(str(room_id), set()).add(sid)
+
+    def leave(self, sid, room_id):
+        with self.lock:
+            if sid in self.rooms:
+                self.rooms[sid].discard(str(room_id))
+                self._unindex_room(sid, str(room_id))
+
+    def sockets_for_user(self, user_id, room_id=None):
+        with self.lock:
+            sids = self.by_user.get(user_id, ())
+            if room_id is None:
+                return list(sids)
+            return [sid for sid in sids if str(room_id) in self.rooms[sid]]
+
+    def room_users(self, room_id):
+        with self.lock:
+            users = {}
+            for sid in self.by_room.get(str(room_id), ()):
+                user = self.sockets[sid]
+                users[user['id']] = user
+            return list(users.values())
+
+    def count(self):
+        return len(self.sockets)
+
+    def heartbeat(self, worker, url, now):
+        with self.lock:
+            self.workers[worker] = (url, now)
+
+    def live_workers(self, ttl, now):
+        """Workers that sent a heartbeat in the last `ttl` seconds, as {worker: url}"""
+        with self.lock:
+            return {worker: url for worker, (url, seen) in self.workers.items() if now - seen <= ttl}
+
+    def retire(self, worker):
+        with self.lock:
+            self.workers.pop(worker, None)
+            self.leases = {room_id: holder for room_id, holder in self.leases.items() if holder != worker}
+
+    def claim_room(self, room_id, worker, ttl, now):
+        """Take a room's lease unless a live worker holds it; returns the holder afterwards"""
+        with self.lock:
+            holder = self.leases.get(str(room_id))
+            seen = self.workers.get(holder, (None, None))[1]
+            if holder is None or seen is None or now - seen > ttl:
+                holder = self.leases[str(room_id)] = worker
+            return holder
+
+    def release_room(self, room_id, worker):
+        with self.lock:
+            if self.leases.get(str(room_id)) == worker:
+                del self.leases[str(room_id)]
+
+    def room_holder(self, room_id):
+        with self.lock:
+            return self.leases.get(str(room_id))
+
+    def rooms_held(self, worker):
+        with self.lock:
+            return {room_id for room_id, holder in self.leases.items() if holder == worker}
+
+    def start(self, socketio, interval):
+        """Nothing to keep alive in a single process"""
+
+
+class SQLiteRegistry:
+    """Registry in a SQLite file shared by worker processes on the same host.
+
+    Stands in for Redis in local multi-process runs. Rows left behind by
+    workers that died are purged when a worker starts. Statements run
+    through the database executor, so under eventlet they do not block the
+    event loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.worker = worker_id()
+        self.lock = native_lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS registry_sockets (
+                sid TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                email TEXT,
+                worker TEXT NOT NULL,
+                connected_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_registry_sockets_user ON registry_sockets (user_id);
+            CREATE TABLE IF NOT EXISTS registry_rooms (
+                sid TEXT NOT NULL,
+                room_id TEXT NOT NULL,
+                PRIMARY KEY (room_id, sid)
+            );
+            CREATE INDEX IF NOT EXISTS idx_registry_rooms_sid ON registry_rooms (sid);
+            CREATE TABLE IF NOT EXISTS registry_workers (
+                worker TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                seen_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS registry_leases (
+                room_id TEXT PRIMARY KEY,
+                worker TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_registry_leases_worker ON registry_leases (worker);
+        ''')
+        self.purge_dead_workers()
+
+    def _execute(self, sql, params=()):
+        return db_executor.call(self._run, sql, params)
+
+    def _run(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def purge_dead_workers(self):
+        """Drop sockets and heartbeats of processes on this host that no longer exist"""
+        host = self.worker.rsplit(':', 1)[0]
+        workers = self._execute('SELECT DISTINCT worker FROM registry_sockets UNION SELECT worker FROM registry_workers')
+        for (worker,) in workers:
+            worker_host, _, pid = worker.rpartition(':')
+            if worker_host != host or worker == self.worker:
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except (OSError, ValueError):
+                self._execute(
+                    'DELETE FROM registry_rooms WHERE sid IN '
+                    '(SELECT sid FROM registry_sockets WHERE worker = ?)', (worker,)
+                )
+                self._execute('DELETE FROM registry_sockets WHERE worker = ?', (worker,))
+                self.retire(worker)
+
+    def add(self, sid, user):
+        self._execute(
+            'INSERT OR REPLACE INTO registry_sockets (sid, user_id, username, email, worker, connected_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (sid, user['id'], user['username'], user.get('email'), self.worker, time.time())
+        )
+
+    def remove(self, sid):
+        self._execute('DELETE FROM registry_rooms WHERE sid = ?', (sid,))
+        self._execute('DELETE FROM registry_sockets WHERE sid = ?', (sid,))
+
+    def join(self, sid, room_id):
+        self._execute('INSERT OR IGNORE INTO registry_rooms (sid, room_id) VALUES (?, ?)', (sid, str(room_id)))
+
+    def leave(self, sid, room_id):
+        self._execute('DELETE FROM registry_rooms WHERE sid = ? AND room_id = ?', (sid, str(room_id)))
+
+    def sockets_for_user(self, user_id, room_id=None):
+        if room_id is None:
+            rows = self._execute('SELECT sid FROM registry_sockets WHERE user_id = ?', (user_id,))
+        else:
+            rows = self._execute('''
+                SELECT s.sid FROM registry_sockets s
+                JOIN registry_rooms r ON r.sid = s.sid
+                WHERE s.user_id = ? AND r.room_id = ?
+            ''', (user_id, str(room_id)))
+        return [row[0] for row in rows]
+
+    def room_users(self, room_id):
+        rows = self._execute('''
+            SELECT DISTINCT s.user_id, s.username, s.email FROM registry_sockets s
+            JOIN registry_rooms r ON r.sid = s.sid
+            WHERE r.room_id = ?
+        ''', (str(room_id),))
+        return [{'id': row[0], 'username': row[1], 'email': row[2]} for row in rows]
+
+    def count(self):
+        return self._execute('SELECT COUNT(*) FROM registry_sockets')[0][0]
+
+    def heartbeat(self, worker, url, now):
+        self._execute('INSERT OR REPLACE INTO registry_workers (worker, url, seen_at) VALUES (?, ?, ?)',
+                      (worker, url, now))
+
+    def live_workers(self, ttl, now):
+        rows = self._execute('SELECT worker, url FROM registry_workers WHERE seen_at >= ?', (now - ttl,))
+        return dict(rows)
+
+    def retire(self, worker):
+        self._execute('DELETE FROM registry_workers WHERE worker = ?', (worker,))
+        self._execute('DELETE FROM registry_leases WHERE worker = ?', (worker,))
+
+    def claim_room(self, room_id, worker, ttl, now):
+        self._execute('''
+            INSERT INTO registry_leases (room_id, worker) VALUES (?, ?)
+            ON CONFLICT (room_id) DO UPDATE SET worker = excluded.worker
+            WHERE registry_leases.worker NOT IN (SELECT worker FROM registry_workers WHERE seen_at >= ?)
+        ''', (str(room_id), worker, now - ttl))
+        return self.room_holder(room_id)
+
+    def release_room(self, room_id, worker):
+        self._execute('DELETE FROM registry_leases WHERE room_id = ? AND worker = ?', (str(room_id), worker))
+
+    def room_holder(self, room_id):
+        rows = self._execute('SELECT worker FROM registry_leases WHERE room_id = ?', (str(room_id),))
+        return rows[0][0] if rows else None
+
+    def rooms_held(self, worker):
+        return {row[0] for row in self._execute('SELECT room_id FROM registry_leases WHERE worker = ?', (worker,))}
+
+    def start(self, socketio, interval):
+        """Nothing to keep alive: dead processes are found by their PID"""
+
+
+# Take a room's lease unless a worker seen since ARGV[2] holds it; returns the holder afterwards
+CLAIM_ROOM_SCRIPT = '''
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    return holder
+end
+if holder then
+    local seen = redis.call('ZSCORE', KEYS[2], holder)
+    if seen and tonumber(seen) >= tonumber(ARGV[2]) then
+        return holder
+    end
+    redis.call('SREM', ARGV[3] .. ':' .. holder .. ':leases', ARGV[4])
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[4])
+return ARGV[1]
+'''
+
+# Drop a room's lease if ARGV[1] still holds it
+RELEASE_ROOM_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SREM', KEYS[2], ARGV[2])
+'''
+
+
+class RedisRegistry:
+    """Registry in Redis, for workers spread over several hosts.
+
+    Each worker keeps the set of its sockets and refreshes a liveness key
+    that expires after `ttl` seconds. Workers purge the sockets of any
+    worker whose key expired, at startup and on every refresh.
+    """
+
+    def __init__(self, url, prefix='codecollab:registry', ttl=15.0):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is required for a redis:// registry')
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.worker = worker_id()
+        self.ttl = ttl
+        self.task = None
+        self.claim_script = self.redis.register_script(CLAIM_ROOM_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_ROOM_SCRIPT)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    def add(self, sid, user):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('socket', sid), mapping={
+            'id': user['id'],
+            'username': user['username'],
+            'email': user.get('email') or '',
+            'worker': self.worker,
+        })
+        pipe.sadd(self._key('worker', self.worker, 'sockets'), sid)
+        pipe.sadd(self._key('user', user['id']), sid)
+        pipe.sadd(self._key('sockets'), sid)
+        pipe.execute()
+
+    def remove(self, sid):
+        pipe = self.redis.pipeline()
+        pipe.hmget(self._key('socket', sid), 'id', 'worker')
+        pipe.smembers(self._key('socket', sid, 'rooms'))
+        (user_id, worker), rooms = pipe.execute()
+        pipe = self.redis.pipeline()
+        for room_id in rooms:
+            pipe.srem(self._key('room', room_id), sid)
+        if user_id is not None:
+            pipe.srem(self._key('user', user_id), sid)
+        if worker is not None:
+            pipe.srem(self._key('worker', worker, 'sockets'), sid)
+        pipe.delete(self._key('socket', sid), self._key('socket', sid, 'rooms'))
+        pipe.srem(self._key('sockets'), sid)
+        pipe.execute()
+
+    def join(self, sid, room_id):
+        pipe = self.redis.pipeline()
+        pipe.sadd(self._key('socket', sid, 'rooms'), str(room_id))
+        pipe.sadd(self._key('room', room_id), sid)
+        pipe.execute()
+
+    def leave(self, sid, room_id):
+        pipe = self.redis.pipeline()
+        pipe.srem(self._key('socket', sid, 'rooms'), str(room_id))
+        pipe.srem(self._key('room', room_id), sid)
+        pipe.execute()
+
+    def sockets_for_user(self, user_id, room_id=None):
+        if room_id is None:
+            return list(self.redis.smembers(self._key('user', user_id)))
+        return list(self.redis.sinter(self._key('user', user_id), self._key('room', room_id)))
+
+    def room_users(self, room_id):
+        pipe = self.redis.pipeline()
+        for sid in self.redis.smembers(self._key('room', room_id)):
+            pipe.hgetall(self._key('socket', sid))
+        users = {}
+        for fields in pipe.execute():
+            if fields:
+                users[int(fields['id'])] = {
+                    'id': int(fields['id']),
+                    'username': fields['username'],
+                    'email': fields['email'] or None,
+                }
+        return list(users.values())
+
+    def count(self):
+        return self.redis.scard(self._key('sockets'))
+
+    def heartbeat(self, worker, url, now):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('workers'), worker, url)
+        pipe.zadd(self._key('workers', 'seen'), {worker: now})
+        pipe.execute()
+
+    def live_workers(self, ttl, now):
+        workers = self.redis.zrangebyscore(self._key('workers', 'seen'), now - ttl, '+inf')
+        if not workers:
+            return {}
+        urls = self.redis.hmget(self._key('workers'), workers)
+        return {worker: url for worker, url in zip(workers, urls) if url is not None}
+
+    def retire(self, worker):
+        pipe = self.redis.pipeline()
+        pipe.hdel(self._key('workers'), worker)
+        pipe.zrem(self._key('workers', 'seen'), worker)
+        pipe.execute()
+        for room_id in self.rooms_held(worker):
+            self.release_room(room_id, worker)
+
+    def claim_room(self, room_id, worker, ttl, now):
+        return self.claim_script(
+            keys=[self._key('lease', room_id), self._key('workers', 'seen'), self._key('worker', worker, 'leases')],
+            args=[worker, now - ttl, self._key('worker'), str(room_id)]
+        )
+
+    def release_room(self, room_id, worker):
+        self.release_script(
+            keys=[self._key('lease', room_id), self._key('worker', worker, 'leases')],
+            args=[worker, str(room_id)]
+        )
+
+    def room_holder(self, room_id):
+        return self.redis.get(self._key('lease', room_id))
+
+    def rooms_held(self, worker):
+        return self.redis.smembers(self._key('worker', worker, 'leases'))
+
+    def start(self, socketio, interval):
+        """Refresh this worker's liveness key every `interval` seconds and purge dead workers"""
+        if self.task is not None:
+            return
+        self.keepalive()
+        self.purge_dead_workers()
+        self.task = socketio.start_background_task(self._run, socketio, interval)
+
+    def _run(self, socketio, interval):
+        while True:
+            socketio.sleep(interval)
+            try:
+                self.keepalive()
+                self.purge_dead_workers()
+            except Exception:
+                logger.exception('Socket registry keepalive failed')
+
+    def keepalive(self):
+        pipe = self.redis.pipeline()
+        pipe.set(self._key('worker', self.worker, 'alive'), 1, ex=max(math.ceil(self.ttl), 1))
+        pipe.sadd(self._key('registry-workers'), self.worker)
+        pipe.execute()
+
+    def purge_dead_workers(self):
+        """Drop the sockets of workers whose liveness key expired, e.g. because they crashed"""
+        for worker in self.redis.smembers(self._key('registry-workers')):
+            if worker == self.worker or self.redis.exists(self._key('worker', worker, 'alive')):
+                continue
+            sids = self.redis.smembers(self._key('worker', worker, 'sockets'))
+            for sid in sids:
+                self.remove(sid)
+            pipe = self.redis.pipeline()
+            pipe.delete(self._key('worker', worker, 'sockets'))
+            pipe.srem(self._key('registry-workers'), worker)
+            pipe.execute()
+            self.retire(worker)
+            logger.info(f'Purged {len(sids)} sockets of dead worker {worker}')
+
+
+def create_registry(url, ttl=15.0):
+    """Build a registry backend from its URL; `ttl` is how long a silent Redis worker counts as alive"""
+    if not url or url.startswith('memory://'):
+        return MemoryRegistry()
+    if url.startswith('sqlite:///'):
+        return SQLiteRegistry(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRegistry(url, ttl=ttl)
+    raise ValueError(f'Unsupported registry URL: {url}')
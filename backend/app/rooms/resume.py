@@ -0,0 +1,133 @@
+"""Resume tokens for reconnecting sockets.
+
+A connected socket can ask for a resume token. When the socket drops, its
+session (user and rooms) is parked under that token for `ttl` seconds. A
+client that reconnects with the token gets the session back without JWT
+verification, a users-table query or the join transaction, then catches
+up with `resume`. The token also works while the old socket still looks
+connected, because the server may notice a dead link only after the
+client has reconnected. Tokens are single use: redeeming one ends it, and
+the client asks for a new one on the new socket. A resumed session keeps
+the expiry of the JWT it was first authenticated with, and no token is
+issued or redeemed after it, so resuming never outlives the JWT.
+
+Tokens live in this worker's memory. A client that reconnects to another
+worker, or after the window, falls back to its JWT.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class ParkedSession:
+    """The session of a disconnected socket, kept until its token expires"""
+
+    __slots__ = ('user', 'rooms', 'expires_at', 'auth_expires_at')
+
+    def __init__(self, user, rooms, expires_at, auth_expires_at=None):
+        self.user = user
+        self.rooms = rooms
+        self.expires_at = expires_at
+        self.auth_expires_at = auth_expires_at
+
+
+class ResumeTokens:
+    """Resume tokens of connected sockets and the sessions of recently disconnected ones"""
+
+    def __init__(self, ttl=120, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.live = {}  # token -> SocketSession of a connected socket
+        self.by_sid = {}  # sid -> token
+        self.parked = OrderedDict()  # token -> ParkedSession, oldest first
+        self.lock = threading.Lock()
+
+        self.issued = 0
+        self.resumed = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def configure(self, ttl):
+        """Set the seconds a disconnected session stays resumable (0 disables resuming)"""
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _expire(self, now):
+        while self.parked:
+            parked = next(iter(self.parked.values()))
+            if parked.expires_at > now and len(self.parked) <= self.max_entries:
+                break
+            self.parked.popitem(last=False)
+            self.expired += 1
+
+    @staticmethod
+    def _auth_expired(auth_expires_at):
+        return auth_expires_at is not None and time.time() >= auth_expires_at
+
+    def issue(self, session):
+        """A new token for a connected socket, replacing the one it had; None once its JWT has expired"""
+        if not self.enabled or self._auth_expired(session.auth_expires_at):
+            return None
+        token = secrets.token_urlsafe(24)
+        with self.lock:
+            old = self.by_sid.pop(session.sid, None)
+            self.live.pop(old, None)
+            self.live[token] = session
+            self.by_sid[session.sid] = token
+        self.issued += 1
+        return token
+
+    def park(self, session):
+        """Keep a disconnected socket's session resumable under its token"""
+        with self.lock:
+            token = self.by_sid.pop(session.sid, None)
+            if token is None:
+                return
+            self.live.pop(token, None)
+            if self.enabled:
+                now = time.monotonic()
+                self.parked[token] = ParkedSession(
+                    session.to_user(), set(session.rooms), now + self.ttl, session.auth_expires_at)
+                self._expire(now)
+
+    def redeem(self, token):
+        """(user, rooms, sid of the old socket if it is still connected, JWT expiry) for a valid token, or None"""
+        with self.lock:
+            self._expire(time.monotonic())
+            parked = self.parked.pop(token, None)
+            if parked is not None:
+                resumed = parked.user, parked.rooms, None, parked.auth_expires_at
+            else:
+                session = self.live.pop(token, None)
+                if session is None:
+                    self.rejected += 1
+                    return None
+                self.by_sid.pop(session.sid, None)
+                resumed = session.to_user(), set(session.rooms), session.sid, session.auth_expires_at
+        if self._auth_expired(resumed[3]):
+            self.expired += 1
+            return None
+        self.resumed += 1
+        return resumed
+
+    def stats(self):
+        with self.lock:
+            live = len(self.live)
+            parked = len(self.parked)
+        return {
+            'ttl_seconds': self.ttl,
+            'live_tokens': live,
+            'parked_sessions': parked,
+            'tokens_issued': self.issued,
+            'sessions_resumed': self.resumed,
+            'tokens_rejected': self.rejected,
+            'tokens_expired': self.expired,
+        }
+
+
+# Shared token table, configured in init_socket_events
+resume_tokens = ResumeTokens()
@@ -0,0 +1,291 @@
+"""Document revision history: periodic snapshots plus deltas between them.
+
+Every write-behind flush stores the room's document as a revision, so
+history grows with flushes rather than keystrokes. A revision is either a
+full snapshot or a delta (an OT operation) from the previous stored
+revision. A snapshot is taken every `snapshot_interval` deltas, or once the
+deltas since the last one outweigh the text, so reading any revision
+replays a bounded chain. A background compactor thins revisions older
+than `compact_age` down to one per `compact_bucket` seconds.
+"""
+import difflib
+import json
+import logging
+import time
+
+from app.executor import db_executor, native_lock
+from app.rooms.ot import apply_operation, diff_operation
+from app.rooms.storage import text_codec
+
+logger = logging.getLogger(__name__)
+
+
+class RevisionNotFound(LookupError):
+    """Raised when a room has no stored revision with the requested number."""
+
+
+class RevisionStore:
+    """Writes, reads and compacts the document_revisions table"""
+
+    def __init__(self, snapshot_interval=50, compact_age=86400, compact_bucket=3600, compact_interval=300):
+        self.snapshot_interval = snapshot_interval
+        self.compact_age = compact_age
+        self.compact_bucket = compact_bucket
+        self.compact_interval = compact_interval
+        # room_id -> (revision, text, deltas since snapshot, delta characters since snapshot)
+        self.heads = {}
+        self.lock = native_lock()  # records arrive from executor threads during flushes
+        self.task = None
+
+        self.snapshots_written = 0
+        self.deltas_written = 0
+        self.compactions = 0
+        self.revisions_compacted = 0
+        self.compaction_errors = 0
+        self.last_compaction_duration = 0.0
+
+    def configure(self, snapshot_interval, compact_age, compact_bucket, compact_interval):
+        """Set the snapshot spacing and compaction policy"""
+        self.snapshot_interval = snapshot_interval
+        self.compact_age = compact_age
+        self.compact_bucket = compact_bucket
+        self.compact_interval = compact_interval
+
+    def start(self, socketio):
+        """Start the periodic compactor"""
+        if self.task is None and self.compact_interval > 0 and self.compact_age > 0:
+            self.task = socketio.start_background_task(self._run, socketio)
+
+    def _run(self, socketio):
+        while True:
+            socketio.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception:
+                logger.exception('Revision compaction failed')
+
+    def forget(self, room_ids):
+        """Drop cached heads, e.g. after a failed flush or a deleted room"""
+        with self.lock:
+            for room_id in room_ids:
+                self.heads.pop(str(room_id), None)
+
+    def _load_head(self, conn, room_id):
+        rows = self._chain(conn, room_id, None)
+        if not rows:
+            return None
+        text = self._replay(rows)
+        deltas = [row for row in rows if not row['snapshot']]
+        return rows[-1]['revision'], text, len(deltas), sum(len(row['data']) for row in deltas)
+
+    def record(self, conn, room_id, revision, text, now=None):
+        """Store `text` as `revision` of a room within the caller's transaction.
+
+        Returns False if the revision is not newer than the last one stored
+        or the text did not change.
+        """
+        key = str(room_id)
+        with self.lock:
+            head = self.heads.get(key)
+        if head is None:
+            head = self._load_head(conn, room_id)
+
+        if head is not None and (revision <= head[0] or text == head[1]):
+            return False
+
+        data = None
+        if head is not None and head[2] + 1 < self.snapshot_interval:
+            data = json.dumps(diff_operation(head[1], text), separators=(',', ':'))
+            if head[3] + len(data) > len(text):
+                data = None
+
+        snapshot = data is None
+        conn.execute(
+            'INSERT INTO document_revisions (room_id, revision, snapshot, data, length, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (int(room_id), revision, int(snapshot), text_codec.encode(text) if snapshot else data, len(text),
+             now or time.time())
+        )
+        if snapshot:
+            self.snapshots_written += 1
+            head = (revision, text, 0, 0)
+        else:
+            self.deltas_written += 1
+            head = (revision, text, head[2] + 1, head[3] + len(data))
+        with self.lock:
+            self.heads[key] = head
+        return True
+
+    def _chain(self, conn, room_id, revision):
+        """Rows from the nearest snapshot at or before `revision` (or the latest) up to it"""
+        cursor = conn.cursor()
+        try:
+            if revision is None:
+                cursor.execute(
+                    'SELECT revision FROM document_revisions WHERE room_id = ? AND snapshot = 1 '
+                    'ORDER BY revision DESC LIMIT 1',
+                    (room_id,)
+                )
+            else:
+                cursor.execute(
+                    'SELECT revision FROM document_revisions WHERE room_id = ? AND revision <= ? AND snapshot = 1 '
+                    'ORDER BY revision DESC LIMIT 1',
+                    (room_id, revision)
+                )
+            snapshot = cursor.fetchone()
+            if snapshot is None:
+                return []
+            cursor.execute(
+                'SELECT revision, snapshot, data FROM document_revisions '
+                'WHERE room_id = ? AND revision >= ? AND revision <= ? ORDER BY revision',
+                (room_id, snapshot['revision'], revision if revision is not None else 2 ** 62)
+            )
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _replay(rows):
+        text = ''
+        for row in rows:
+            text = text_codec.decode(row['data']) if row['snapshot'] else apply_operation(text, json.loads(row['data']))
+        return text
+
+    def document_at(self, conn, room_id, revision):
+        """Text of a room's document at a stored revision"""
+        rows = self._chain(conn, room_id, revision)
+        if not rows or rows[-1]['revision'] != revision:
+            raise RevisionNotFound(f'Revision {revision} not found')
+        return self._replay(rows)
+
+    def list_revisions(self, conn, room_id, before=None, limit=50):
+        """Stored revisions newest first, as (rows, whether older ones exist)"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                'SELECT revision, snapshot, length, created_at FROM document_revisions '
+                'WHERE room_id = ? AND revision < ? ORDER BY revision DESC LIMIT ?',
+                (room_id, before if before is not None else 2 ** 62, limit + 1)
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        return rows[:limit], len(rows) > limit
+
+    def diff(self, conn, room_id, from_revision, to_revision):
+        """Operation and unified diff turning one stored revision into another"""
+        old = self.document_at(conn, room_id, from_revision)
+        new = self.document_at(conn, room_id, to_revision)
+        unified = difflib.unified_diff(
+            old.splitlines(), new.splitlines(),
+            fromfile=f'revision {from_revision}', tofile=f'revision {to_revision}', lineterm=''
+        )
+        return diff_operation(old, new), '\n'.join(unified)
+
+    def delete_room(self, conn, room_id):
+        """Remove a room's history within the caller's transaction"""
+        conn.execute('DELETE FROM document_revisions WHERE room_id = ?', (room_id,))
+        self.forget([room_id])
+
+    def compact(self, now=None, max_rooms=100):
+        """Thin out old revisions in rooms that have uncompacted ones; returns revisions removed"""
+        cutoff = (now or time.time()) - self.compact_age
+        started = time.monotonic()
+        removed = 0
+
+        # Walk the partial index of uncompacted revisions; DISTINCT would scan the table
+        rows = db_executor.read(lambda conn: conn.execute(
+            'SELECT room_id FROM document_revisions WHERE compacted = 0 AND created_at < ? LIMIT ?',
+            (cutoff, max_rooms * self.snapshot_interval)
+        ).fetchall())
+        # One queued write per room, so compaction never holds the writer for long
+        for room_id in list(dict.fromkeys(row['room_id'] for row in rows))[:max_rooms]:
+            try:
+                removed += db_executor.write(lambda conn: self._compact_room(conn, room_id, cutoff))
+            except Exception:
+                self.compaction_errors += 1
+                raise
+
+        self.compactions += 1
+        self.revisions_compacted += removed
+        self.last_compaction_duration = time.monotonic() - started
+        return removed
+
+    def _compact_room(self, conn, room_id, cutoff):
+        """Keep the last revision of each bucket among a room's old uncompacted revisions"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                'SELECT revision, created_at FROM document_revisions '
+                'WHERE room_id = ? AND compacted = 0 AND created_at < ? ORDER BY revision',
+                (room_id, cutoff)
+            )
+            old = cursor.fetchall()
+            if not old:
+                return 0
+            first, last = old[0]['revision'], old[-1]['revision']
+
+            buckets = {}
+            for row in old:
+                buckets[int(row['created_at'] // self.compact_bucket)] = row['revision']
+            keep = set(buckets.values())
+
+            # The stored revision the old ones build on, which compaction leaves alone
+            cursor.execute(
+                'SELECT MAX(revision) AS revision FROM document_revisions WHERE room_id = ? AND revision < ?',
+                (room_id, first)
+            )
+            prior = cursor.fetchone()['revision']
+            cursor.execute(
+                'SELECT revision, snapshot, data, created_at FROM document_revisions '
+                'WHERE room_id = ? AND revision >= ? AND revision <= ? ORDER BY revision',
+                (room_id, first, last)
+            )
+            segment = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        previous = self._replay(self._chain(conn, room_id, prior)) if prior is not None else None
+        text = previous or ''
+        rewritten = []
+        deltas = 0
+        for row in segment:
+            text = text_codec.decode(row['data']) if row['snapshot'] else apply_operation(text, json.loads(row['data']))
+            if row['revision'] not in keep:
+                continue
+            data = json.dumps(diff_operation(previous, text), separators=(',', ':')) if previous is not None else None
+            # The newest kept revision becomes a snapshot so later deltas keep a short chain
+            if (data is None or row['revision'] == last or deltas + 1 >= self.snapshot_interval
+                    or len(data) > len(text)):
+                rewritten.append((room_id, row['revision'], 1, text_codec.encode(text), len(text), row['created_at']))
+                deltas = 0
+            else:
+                rewritten.append((room_id, row['revision'], 0, data, len(text), row['created_at']))
+                deltas += 1
+            previous = text
+
+        conn.execute(
+            'DELETE FROM document_revisions WHERE room_id = ? AND revision >= ? AND revision <= ?',
+            (room_id, first, last)
+        )
+        conn.executemany(
+            'INSERT INTO document_revisions (room_id, revision, snapshot, data, length, created_at, compacted) '
+            'VALUES (?, ?, ?, ?, ?, ?, 1)',
+            rewritten
+        )
+        return len(old) - len(rewritten)
+
+    def stats(self):
+        return {
+            'cached_heads': len(self.heads),
+            'snapshots_written': self.snapshots_written,
+            'deltas_written': self.deltas_written,
+            'compactions': self.compactions,
+            'revisions_compacted': self.revisions_compacted,
+            'compaction_errors': self.compaction_errors,
+            'last_compaction_duration_seconds': self.last_compaction_duration,
+        }
+
+
+# Shared store for the application, configured in init_socket_events
+revisions = RevisionStore()
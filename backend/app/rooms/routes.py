@@ -1,43 +1,100 @@
 from flask import Blueprint, request, jsonify
+import base64
+import json
+from datetime import datetime, timezone
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.db import get_db_connection
+from app.executor import db_executor
+from app.http_cache import conditional
 from flask_socketio import join_room, leave_room as socketio_leave_room, emit
 from flask import current_app
 from app import socketio
+from app.chat.history import chat_history
+from app.repository import repository
+from app.rooms.persistence import write_behind
+from app.rooms.revisions import RevisionNotFound, revisions
+from app.rooms.state import drop_room_state, get_cached_room_state
+from app.rooms.sync import chunked_syncs
 
 rooms_bp = Blueprint('rooms', __name__)
 
+# Columns a room listing may select; `code` is only sent when asked for explicitly
+ROOM_FIELDS = ('id', 'name', 'owner_id', 'language', 'code', 'video_enabled', 'created_at')
+ROOM_SUMMARY_FIELDS = ('id', 'name', 'owner_id', 'language', 'video_enabled', 'created_at')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(room):
+    """Opaque keyset cursor pointing just past a room in listing order"""
+    raw = json.dumps([room['created_at'], room['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    created_at, room_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return created_at, int(room_id)
+
 @rooms_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_rooms():
-    """Get all available rooms or filter by user membership"""
+    """List rooms newest first, one keyset-paginated page at a time.
+    
+    Query parameters: limit, after (the `next` cursor of the previous page),
+    fields (comma separated, defaults to everything but code), language,
+    owner_id and member_only.
+    """
     user_id = get_jwt_identity()
     member_only = request.args.get('member_only', 'false').lower() == 'true'
+    language = request.args.get('language')
+    
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'msg': f'limit must be an integer between 1 and {MAX_PAGE_SIZE}'}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    owner_id = None
+    if request.args.get('owner_id'):
+        try:
+            owner_id = int(request.args['owner_id'])
+        except ValueError:
+            return jsonify({'msg': 'owner_id must be an integer'}), 400
+    
+    if 'fields' in request.args:
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in ROOM_FIELDS]
+        if unknown:
+            return jsonify({'msg': f"Unknown fields: {', '.join(unknown)}"}), 400
+    else:
+        fields = list(ROOM_SUMMARY_FIELDS)
+    
+    # The cursor needs id and created_at, so they are always selected
+    columns = list(dict.fromkeys(['id', 'created_at'] + fields))
+    
+    after = None
+    if request.args.get('after'):
+        try:
+            after = decode_cursor(request.args['after'])
+        except (ValueError, TypeError):
+            return jsonify({'msg': 'Invalid cursor'}), 400
     
     try:
-        if member_only:
-            # Get rooms where the user is a member
-            cursor.execute('''
-                SELECT r.* FROM rooms r
-                JOIN room_members rm ON r.id = rm.room_id
-                WHERE rm.user_id = ?
-                ORDER BY r.created_at DESC
-            ''', (user_id,))
-        else:
-            # Get all rooms
-            cursor.execute('SELECT * FROM rooms ORDER BY created_at DESC')
+        # One extra row tells us whether there is another page
+        rows = repository.list_rooms(
+            columns,
+            limit + 1,
+            member_id=user_id if member_only else None,
+            language=language,
+            owner_id=owner_id,
+            after=after
+        )
         
-        rooms = [dict(row) for row in cursor.fetchall()]
-        return jsonify({'rooms': rooms}), 200
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        rooms = [{field: row[field] for field in fields} for row in rows[:limit]]
+        
+        return conditional(jsonify({'rooms': rooms, 'next': next_cursor}))
     
     except Exception as e:
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @rooms_bp.route('/', methods=['POST'])
 @jwt_required()
@@ -53,42 +110,16 @@ def create_room():
     name = data['name']
     language = data.get('language', 'javascript')
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Check if room name already exists
-        cursor.execute('SELECT * FROM rooms WHERE name = ?', (name,))
-        if cursor.fetchone():
+        # Create the room with its creator as a member, unless the name is taken
+        room = repository.create_room(name, user_id, language)
+        if room is None:
             return jsonify({'msg': 'Room name already exists'}), 409
         
-        # Create new room
-        cursor.execute('''
-            INSERT INTO rooms (name, owner_id, language)
-            VALUES (?, ?, ?)
-        ''', (name, user_id, language))
-        
-        room_id = cursor.lastrowid
-        
-        # Add creator as a member
-        cursor.execute('''
-            INSERT INTO room_members (room_id, user_id)
-            VALUES (?, ?)
-        ''', (room_id, user_id))
-        
-        # Get the newly created room
-        cursor.execute('SELECT * FROM rooms WHERE id = ?', (room_id,))
-        room = dict(cursor.fetchone())
-        
-        conn.commit()
         return jsonify({'msg': 'Room created successfully', 'room': room}), 201
     
     except Exception as e:
-        conn.rollback()
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @rooms_bp.route('/<int:room_id>', methods=['GET'])
 @jwt_required()
@@ -96,45 +127,28 @@ def get_room(room_id):
     """Get a specific room by ID"""
     user_id = get_jwt_identity()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Get room details
-        cursor.execute('SELECT * FROM rooms WHERE id = ?', (room_id,))
-        room_row = cursor.fetchone()
+        # Get room details and members
+        loaded = repository.load_room(room_id)
         
-        if not room_row:
+        if not loaded:
             return jsonify({'msg': 'Room not found'}), 404
         
-        room = dict(room_row)
-        
-        # Check if user is a member
-        cursor.execute('''
-            SELECT * FROM room_members
-            WHERE room_id = ? AND user_id = ?
-        ''', (room_id, user_id))
-        is_member = cursor.fetchone() is not None
+        room, members = loaded
         
-        # Get room members
-        cursor.execute('''
-            SELECT u.id, u.username, u.email
-            FROM users u
-            JOIN room_members rm ON u.id = rm.user_id
-            WHERE rm.room_id = ?
-        ''', (room_id,))
-        members = [dict(row) for row in cursor.fetchall()]
+        # The cached document may be ahead of the last write-behind flush
+        room_state = get_cached_room_state(room_id)
+        if room_state:
+            room['code'] = room_state.document.text
+            room['revision'] = room_state.document.revision
         
         room['members'] = members
-        room['is_member'] = is_member
+        room['is_member'] = any(str(member['id']) == str(user_id) for member in members)
         
-        return jsonify({'room': room}), 200
+        return conditional(jsonify({'room': room}))
     
     except Exception as e:
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @rooms_bp.route('/<int:room_id>/join', methods=['POST'])
 @jwt_required()
@@ -142,41 +156,25 @@ def join_room(room_id):
     """Join a room"""
     user_id = get_jwt_identity()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
         # Check if room exists
-        cursor.execute('SELECT * FROM rooms WHERE id = ?', (room_id,))
-        room = cursor.fetchone()
-        
-        if not room:
+        if not repository.room_exists(room_id):
             return jsonify({'msg': 'Room not found'}), 404
         
-        # Check if user is already a member
-        cursor.execute('''
-            SELECT * FROM room_members
-            WHERE room_id = ? AND user_id = ?
-        ''', (room_id, user_id))
-        
-        if cursor.fetchone():
+        # Add user as a member unless they already are one
+        if not repository.add_member(room_id, user_id):
             return jsonify({'msg': 'Already a member of this room'}), 409
         
-        # Add user as a member
-        cursor.execute('''
-            INSERT INTO room_members (room_id, user_id)
-            VALUES (?, ?)
-        ''', (room_id, user_id))
+        room_state = get_cached_room_state(room_id)
+        if room_state:
+            user = repository.get_user(user_id)
+            if user:
+                room_state.add_member(user)
         
-        conn.commit()
         return jsonify({'msg': 'Joined room successfully'}), 200
     
     except Exception as e:
-        conn.rollback()
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @rooms_bp.route('/<int:room_id>/leave', methods=['POST'])
 @jwt_required()
@@ -184,34 +182,19 @@ def leave_room(room_id):
     """Leave a room"""
     user_id = get_jwt_identity()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Check if user is a member
-        cursor.execute('''
-            SELECT * FROM room_members
-            WHERE room_id = ? AND user_id = ?
-        ''', (room_id, user_id))
-        
-        if not cursor.fetchone():
+        # Remove user from room members
+        if not repository.remove_member(room_id, user_id):
             return jsonify({'msg': 'Not a member of this room'}), 404
         
-        # Remove user from room members
-        cursor.execute('''
-            DELETE FROM room_members
-            WHERE room_id = ? AND user_id = ?
-        ''', (room_id, user_id))
+        room_state = get_cached_room_state(room_id)
+        if room_state:
+            room_state.remove_member(user_id)
         
-        conn.commit()
         return jsonify({'msg': 'Left room successfully'}), 200
     
     except Exception as e:
-        conn.rollback()
         return jsonify({'msg': f'Error: {str(e)}'}), 500
-    
-    finally:
-        cursor.close()
 
 @rooms_bp.route('/<int:room_id>/toggle-video', methods=['POST'])
 @jwt_required()
@@ -219,32 +202,18 @@ def toggle_video(room_id):
     """Toggle video chat for a room"""
     user_id = get_jwt_identity()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Check if room exists and user is the owner
-        cursor.execute('SELECT * FROM rooms WHERE id = ? AND owner_id = ?', (room_id, user_id))
-        room_row = cursor.fetchone()
+        # Toggle video_enabled (0 to 1 or 1 to 0) if the room exists and the user is the owner
+        updated_room = repository.toggle_video(room_id, user_id)
         
-        if not room_row:
+        if not updated_room:
             return jsonify({'msg': 'Room not found or not authorized'}), 404
         
-        room = dict(room_row)
-        
-        # Toggle video_enabled flag (0 to 1 or 1 to 0)
-        new_video_status = 1 if room['video_enabled'] == 0 else 0
-        cursor.execute('''
-            UPDATE rooms
-            SET video_enabled = ?
-            WHERE id = ?
-        ''', (new_video_status, room_id))
-        
-        # Get the updated room
-        cursor.execute('SELECT id, name, video_enabled FROM rooms WHERE id = ?', (room_id,))
-        updated_room = dict(cursor.fetchone())
+        new_video_status = updated_room['video_enabled']
         
-        conn.commit()
+        room_state = get_cached_room_state(room_id)
+        if room_state:
+            room_state.video_enabled = new_video_status
         
         return jsonify({
             'msg': f'Video chat {"enabled" if new_video_status == 1 else "disabled"}',
@@ -252,42 +221,159 @@ def toggle_video(room_id):
         }), 200
     
     except Exception as e:
-        conn.rollback()
         return jsonify({'msg': f'Error: {str(e)}'}), 500
+
+@rooms_bp.route('/<int:room_id>/chat-retention', methods=['PUT'])
+@jwt_required()
+def set_chat_retention(room_id):
+    """Set how many chat messages a room keeps; null restores the server default"""
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    
+    if 'retention' not in data:
+        return jsonify({'msg': 'retention is required'}), 400
+    
+    retention = data['retention']
+    minimum = current_app.config['CHAT_SYNC_LIMIT']
+    # At least the messages sent on join, so the join payload never shows trimmed messages
+    if retention is not None and (type(retention) is not int or retention < minimum):
+        return jsonify({'msg': f'retention must be null or an integer of at least {minimum}'}), 400
     
-    finally:
-        cursor.close()
+    try:
+        if not repository.set_chat_retention(room_id, user_id, retention):
+            return jsonify({'msg': 'Room not found or not authorized'}), 404
+        
+        # Rooms already cached apply the new limit from their next chat message
+        room_state = get_cached_room_state(room_id)
+        if room_state:
+            room_state.chat_retention = retention
+        
+        return jsonify({
+            'msg': 'Chat retention updated',
+            'retention': retention if retention is not None else current_app.config['CHAT_RETENTION']
+        }), 200
+    
+    except Exception as e:
+        return jsonify({'msg': f'Error: {str(e)}'}), 500
+
+def revision_summary(row):
+    return {
+        'revision': row['revision'],
+        'length': row['length'],
+        'snapshot': bool(row['snapshot']),
+        'created_at': datetime.fromtimestamp(row['created_at'], timezone.utc).isoformat()
+    }
+
+@rooms_bp.route('/<int:room_id>/revisions', methods=['GET'])
+@jwt_required()
+def list_revisions(room_id):
+    """List a room's stored revisions newest first; `before` is the `next` value of the previous page"""
+    user_id = get_jwt_identity()
+    
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        before = request.args.get('before')
+        before = int(before) if before is not None else None
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'msg': f'limit must be an integer between 1 and {MAX_PAGE_SIZE} and before an integer'}), 400
+    
+    try:
+        if not repository.is_member(room_id, user_id):
+            return jsonify({'msg': 'Room not found or not a member'}), 404
+        
+        # Store the latest edits first so the newest revision is listed
+        if before is None:
+            write_behind.flush([room_id])
+        
+        rows, has_more = db_executor.read(lambda conn: revisions.list_revisions(conn, room_id, before, limit))
+        return jsonify({
+            'revisions': [revision_summary(row) for row in rows],
+            'next': rows[-1]['revision'] if has_more else None
+        })
+    
+    except Exception as e:
+        return jsonify({'msg': f'Error: {str(e)}'}), 500
+
+@rooms_bp.route('/<int:room_id>/revisions/<int:revision>', methods=['GET'])
+@jwt_required()
+def get_revision(room_id, revision):
+    """Get the document as it was at a stored revision"""
+    user_id = get_jwt_identity()
+    
+    try:
+        if not repository.is_member(room_id, user_id):
+            return jsonify({'msg': 'Room not found or not a member'}), 404
+        
+        code = db_executor.read(lambda conn: revisions.document_at(conn, room_id, revision))
+        return conditional(jsonify({'revision': revision, 'code': code}))
+    
+    except RevisionNotFound as e:
+        return jsonify({'msg': str(e)}), 404
+    
+    except Exception as e:
+        return jsonify({'msg': f'Error: {str(e)}'}), 500
+
+@rooms_bp.route('/<int:room_id>/revisions/<int:from_revision>/diff/<int:to_revision>', methods=['GET'])
+@jwt_required()
+def diff_revisions(room_id, from_revision, to_revision):
+    """Diff two stored revisions as an operation and a unified diff"""
+    user_id = get_jwt_identity()
+    
+    try:
+        if not repository.is_member(room_id, user_id):
+            return jsonify({'msg': 'Room not found or not a member'}), 404
+        
+        ops, unified = db_executor.read(lambda conn: revisions.diff(conn, room_id, from_revision, to_revision))
+        return conditional(jsonify({
+            'from': from_revision,
+            'to': to_revision,
+            'ops': ops,
+            'diff': unified
+        }))
+    
+    except RevisionNotFound as e:
+        return jsonify({'msg': str(e)}), 404
+    
+    except Exception as e:
+        return jsonify({'msg': f'Error: {str(e)}'}), 500
 
 @rooms_bp.route('/<int:room_id>', methods=['DELETE'])
 @jwt_required()
 def delete_room(room_id):
     """Delete a room by ID"""
     user_id = get_jwt_identity()
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
     try:
         # Check if the user is authorized to delete the room
-        cursor.execute("SELECT owner_id FROM rooms WHERE id = ?", (room_id,))
-        room = cursor.fetchone()
+        owner_id = repository.room_owner(room_id)
 
-        if not room:
+        if owner_id is None:
             return jsonify({"error": "Room not found"}), 404
 
-        if room["owner_id"] != user_id:
+        if owner_id != user_id:
             return jsonify({"error": "Unauthorized"}), 403
 
-        # Delete the room
-        cursor.execute("DELETE FROM rooms WHERE id = ?", (room_id,))
-        conn.commit()
+        # Delete the room and its chat and revision history, dropping chat messages not yet written
+        chat_history.discard(room_id)
+        repository.delete_room(room_id)
+
+        def delete_history(conn):
+            conn.execute("DELETE FROM chat_messages WHERE room_id = ?", (room_id,))
+            revisions.delete_room(conn, room_id)
+
+        db_executor.write(delete_history)
+
+        # Drop the cached room so its document is not written back
+        drop_room_state(room_id)
+        write_behind.discard(room_id)
+        chunked_syncs.discard_room(room_id)
 
         return jsonify({"message": "Room deleted successfully"}), 200
     except Exception as e:
         current_app.logger.error(f"Error deleting room: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 @socketio.on('leave')
 def handle_leave(data):
@@ -0,0 +1,84 @@
+"""Per-connection session records for Socket.IO clients."""
+from app.rooms.registry import MemoryRegistry
+
+
+class SocketSession:
+    """The authenticated user behind a socket, cached for the connection's lifetime"""
+
+    __slots__ = ('sid', 'user_id', 'username', 'email', 'rooms', 'auth_expires_at')
+
+    def __init__(self, sid, user_id, username, email, auth_expires_at=None):
+        self.sid = sid
+        self.user_id = user_id
+        self.username = username
+        self.email = email
+        self.rooms = set()
+        self.auth_expires_at = auth_expires_at  # `exp` of the JWT the socket connected with, if any
+
+    def to_user(self):
+        """The user as sent in room payloads"""
+        return {'id': self.user_id, 'username': self.username, 'email': self.email}
+
+
+class SessionIndex:
+    """Sessions of the sockets connected to this worker.
+
+    Every change is mirrored into a registry shared by all workers, which
+    answers the cross-worker questions: which sockets a user has open and
+    who is in a room.
+    """
+
+    def __init__(self, registry=None):
+        self.by_sid = {}
+        self.registry = registry or MemoryRegistry()
+
+    def configure(self, registry):
+        self.registry = registry
+
+    def __len__(self):
+        return len(self.by_sid)
+
+    def __contains__(self, sid):
+        return sid in self.by_sid
+
+    def get(self, sid):
+        return self.by_sid.get(sid)
+
+    def add(self, session):
+        self.by_sid[session.sid] = session
+        self.registry.add(session.sid, session.to_user())
+
+    def remove(self, sid):
+        """Drop a socket from the index and the registry and return its session"""
+        session = self.by_sid.pop(sid, None)
+        if session is not None:
+            self.registry.remove(sid)
+        return session
+
+    def join(self, sid, room_id):
+        session = self.by_sid.get(sid)
+        if session:
+            session.rooms.add(str(room_id))
+            self.registry.join(sid, room_id)
+
+    def leave(self, sid, room_id):
+        session = self.by_sid.get(sid)
+        if session:
+            session.rooms.discard(str(room_id))
+            self.registry.leave(sid, room_id)
+
+    def sockets_for_user(self, user_id, room_id=None):
+        """Socket IDs a user has open on any worker, optionally only those that joined `room_id`"""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return []
+        return self.registry.sockets_for_user(user_id, room_id)
+
+    def room_users(self, room_id):
+        """Users with a socket in the room on any worker"""
+        return self.registry.room_users(room_id)
+
+
+# Sessions of connected sockets
+sessions = SessionIndex()
@@ -1,18 +1,274 @@
 from flask import request, current_app
-from flask_socketio import emit, join_room, leave_room
+from flask_socketio import ConnectionRefusedError, disconnect, emit, join_room, leave_room
 from flask_jwt_extended import decode_token
 from app import socketio
-from app.db import get_db_connection
+from app.chat.history import chat_history, load_messages
+from app.executor import db_executor
+from app.outbox import outbound_queues
+from app.repository import repository
+from app.rooms.admission import admission, parse_event_limits
+from app.rooms.affinity import affinity
+from app.rooms.cursors import cursor_batcher
+from app.rooms.registry import create_registry
+from app.rooms.resume import resume_tokens
+from app.rooms.persistence import write_behind
+from app.rooms.presence import presence
+from app.rooms.revisions import revisions
+from app.rooms.ot import DocumentTooLarge, OperationError, RevisionError, normalize_operation
+from app.rooms.sessions import SocketSession, sessions
+from app.rooms.state import drop_room_state, get_room_state, room_states
+from app.rooms.sync import chunked_syncs
+import functools
 import json
+import logging
 from datetime import datetime
 
-# Store mapping between socket IDs and user IDs
-socket_to_user = {}
+logger = logging.getLogger(__name__)
+
+def get_room_document(room_id):
+    """Get the in-memory document for a room, loading the room on first use"""
+    state = get_room_state(room_id)
+    return state.document if state else None
+
+def send_room_sync(room, chunked=False, encoding=None):
+    """Send sync-code to the current socket, streaming large documents as sync-chunk events"""
+    text, revision = room.document.text, room.document.revision
+    payload = {
+        'code': text,
+        'revision': revision,
+        'language': room.language,
+        'videoEnabled': room.video_enabled,
+        'users': online_users(room.room_id),
+        'members': room.roster(),
+        'chat': list(room.recent_chat)
+    }
+    if not chunked_syncs.wants_chunks(text, chunked):
+        emit('sync-code', payload)
+        return
+    
+    sync = chunked_syncs.start(room.room_id, text, revision)
+    payload['code'] = None
+    payload['sync'] = sync.describe()
+    emit('sync-code', payload)
+    send_chunks(sync, 0, encoding)
+
+def online_users(room_id):
+    """Users online in a room, including those whose sockets are on other workers"""
+    users = presence.online(room_id)
+    known = {user['id'] for user in users}
+    for user in sessions.room_users(room_id):
+        # Sockets on this worker are covered by presence, even once it expired them
+        if user['id'] not in known and any(
+                sid not in sessions for sid in sessions.sockets_for_user(user['id'], room_id)):
+            users.append({'id': user['id'], 'username': user['username'], 'state': 'active', 'lastSeen': None})
+    return users
+
+def broadcast_presence(diffs):
+    """Send presence-diff events to the rooms they describe"""
+    for room_id, diff in diffs:
+        emit('presence-diff', diff, to=room_id)
+
+def mark_active(session):
+    """Count an event from the current socket as activity for presence"""
+    broadcast_presence(presence.touch(request.sid, True, session.to_user(), session.rooms))
+
+def keep_alive():
+    """Count any event from the current socket as contact, without changing its active or idle state"""
+    session = sessions.get(request.sid)
+    if session:
+        broadcast_presence(presence.touch(request.sid, None, session.to_user(), session.rooms))
+
+def socket_event(event):
+    """Register a handler with socketio.on; every event it receives keeps the socket's presence alive"""
+    def register(handler):
+        @functools.wraps(handler)
+        def handle(*args):
+            keep_alive()
+            return handler(*args)
+        return socketio.on(event)(handle)
+    return register
+
+def send_chunks(sync, start, encoding=None):
+    """Stream the chunks of a transfer from `start`, yielding between them so other events interleave"""
+    for index in range(start, sync.chunks):
+        emit('sync-chunk', sync.chunk(index, encoding))
+        chunked_syncs.chunks_sent += 1
+        socketio.sleep(0)
+
+def reject_oversized(room_id, document, error):
+    """Tell the sender its edit was refused and bring it back to the server's document"""
+    emit('error', {
+        'message': str(error),
+        'code': 'document-too-large',
+        'maxSize': document.max_length
+    })
+    emit('code-resync', {
+        'roomId': str(room_id),
+        'code': document.text,
+        'revision': document.revision
+    })
+
+def forget_room(room_id):
+    """Drop what this worker cached for a room, so it is loaded fresh from the database"""
+    drop_room_state(room_id)
+    chunked_syncs.discard_room(room_id)
+
+def flush_idle_rooms(room_ids, leaving_sid):
+    """Write pending code and chat for rooms that no other socket is in any more, then forget their state"""
+    def idle(room_id):
+        return not any(sid != leaving_sid for sid, _ in socketio.server.manager.get_participants('/', str(room_id)))
+    
+    rooms = [room_id for room_id in room_ids if idle(room_id)]
+    if not rooms:
+        return
+    try:
+        write_behind.flush(rooms)
+        chat_history.flush(rooms)
+    except Exception as e:
+        current_app.logger.error(f"Error flushing idle rooms: {str(e)}")
+        return
+    
+    # Someone may have joined or written while the flushes ran; keep those rooms
+    for room_id in rooms:
+        if idle(room_id) and not write_behind.is_dirty(room_id) and not chat_history.is_pending(room_id):
+            forget_room(room_id)
+
+def redirect_elsewhere(room_id):
+    """Point the client at the worker that serves a room; True if the room is not served here"""
+    owner = affinity.elsewhere(room_id)
+    if owner is None:
+        return False
+    worker, url = owner
+    if url is None:
+        # The previous owner is leaving right now; the room is free again within a heartbeat
+        emit('error', {
+            'message': 'Room is being handed over, try again',
+            'code': 'room-handoff',
+            'roomId': str(room_id),
+            'retryAfter': affinity.heartbeat_interval
+        })
+        return True
+    affinity.redirects += 1
+    emit('room-redirect', {'roomId': str(room_id), 'worker': worker, 'url': url})
+    return True
+
+def release_moved_rooms():
+    """Hand rooms this worker no longer serves over; returns how many could not be stored yet.
+
+    Runs in the heartbeat task after a rebalance or a lost lease.
+    """
+    local = set(room_states) | affinity.leases
+    for session in list(sessions.by_sid.values()):
+        local.update(session.rooms)
+    
+    moved = 0
+    unreleased = 0
+    for room_id in local:
+        owner = affinity.elsewhere(room_id)
+        if owner is None:
+            continue
+        worker, url = owner
+        
+        # Stop taking edits first
+        sids = [sid for sid, _ in socketio.server.manager.get_participants('/', room_id)]
+        for sid in sids:
+            socketio.server.leave_room(sid, room_id)
+            sessions.leave(sid, room_id)
+            presence.leave(sid, room_id)
+        
+        if affinity.holds(room_id):
+            # Store the room, then let go of its lease so the new owner loads what was stored
+            try:
+                write_behind.flush([room_id])
+                chat_history.flush([room_id])
+            except Exception:
+                # Keep the lease and the room; the next heartbeat tries again
+                logger.exception(f'Could not store room {room_id} before handing it over')
+                unreleased += 1
+            else:
+                affinity.release(room_id)
+                forget_room(room_id)
+        else:
+            # Another worker took the room over while this one was unreachable; its copy wins
+            write_behind.discard(room_id)
+            try:
+                chat_history.flush([room_id])
+            except Exception:
+                logger.exception(f'Could not store the chat of room {room_id}')
+            forget_room(room_id)
+        
+        if url is not None:
+            for sid in sids:
+                socketio.emit('room-redirect', {'roomId': room_id, 'worker': worker, 'url': url, 'reason': 'rebalance'}, to=sid)
+        moved += 1
+    
+    affinity.rooms_moved += moved
+    if moved:
+        logger.info(f'Handed {moved} rooms over to their new owners')
+    return unreleased
+
+def resume_session(token):
+    """Restore the session and rooms of a dropped socket from its resume token, without JWT or database work"""
+    resumed = resume_tokens.redeem(token)
+    if resumed is None:
+        return False
+    user, rooms, stale_sid, auth_expires_at = resumed
+    
+    session = SocketSession(request.sid, user['id'], user['username'], user['email'], auth_expires_at)
+    sessions.add(session)
+    presence.connect(request.sid, user)
+    for room_id in rooms:
+        # A room that moved while the client was away is redirected when it sends resume
+        if affinity.elsewhere(room_id):
+            continue
+        join_room(room_id)
+        sessions.join(request.sid, room_id)
+        diff = presence.join(request.sid, room_id)
+        if diff:
+            emit('presence-diff', diff, to=room_id, skip_sid=request.sid)
+    
+    # The old socket's link is dead even if the server has not noticed yet
+    if stale_sid and stale_sid in sessions:
+        disconnect(sid=stale_sid, namespace='/')
+    
+    current_app.logger.info(f"User {user['username']} resumed session with socket ID {request.sid}")
+    return True
+
+def refuse_connection(reason, retry_after):
+    """Turn the connection away, telling the client how long to wait before retrying"""
+    raise ConnectionRefusedError(reason, {'retryAfter': retry_after})
+
+def reject_event(event, retry_after):
+    """Tell the sender an event was dropped by its rate limit"""
+    emit('error', {
+        'message': f"Too many {event} events",
+        'code': 'rate-limited',
+        'event': event,
+        'retryAfter': retry_after
+    })
 
 @socketio.on('connect')
-def handle_connect():
-    """Handle client connection with JWT authentication"""
-    token = request.args.get('token')
+def handle_connect(auth=None):
+    """Admit the connection if the client and the worker have room for it, then authenticate it"""
+    retry_after = admission.admit_ip(admission.client_ip(request.environ))
+    if retry_after:
+        refuse_connection('Too many connection attempts', retry_after)
+    
+    retry_after = admission.begin_handshake()
+    if retry_after:
+        refuse_connection('Server busy', retry_after)
+    try:
+        return authenticate_connection(auth)
+    finally:
+        admission.end_handshake()
+
+def authenticate_connection(auth):
+    """Handle client connection with a resume token or JWT authentication"""
+    resume_token = request.args.get('resume') or (auth or {}).get('resumeToken')
+    if resume_token and resume_session(resume_token):
+        return True
+    
+    token = request.args.get('token') or (auth or {}).get('token')
     if not token:
         return False  # Reject connection if no token
     
@@ -21,28 +277,30 @@ def handle_connect():
         decoded_token = decode_token(token)
         user_id = decoded_token['sub']
         
-        # Store user_id in the socket_to_user mapping instead of overriding request.sid
-        socket_to_user[request.sid] = user_id
+        retry_after = admission.admit_user(user_id)
+        if retry_after:
+            refuse_connection('Too many connection attempts', retry_after)
         
-        # Get user details
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Get user details once; the session keeps them for the socket's lifetime
         try:
-            cursor.execute('SELECT username FROM users WHERE id = ?', (int(user_id),))
-            user_row = cursor.fetchone()
+            user_row = repository.get_user(user_id)
             
             if not user_row:
                 return False  # Reject if user not found
-                
+            
+            session = SocketSession(
+                request.sid, user_row['id'], user_row['username'], user_row['email'], decoded_token.get('exp'))
+            sessions.add(session)
+            presence.connect(request.sid, session.to_user())
             current_app.logger.info(f"User {user_row['username']} connected with socket ID {request.sid}")
             return True
             
         except Exception as e:
             current_app.logger.error(f"Error during socket connection: {str(e)}")
             return False
-        finally:
-            cursor.close()
             
+    except ConnectionRefusedError:
+        raise
     except Exception as e:
         current_app.logger.error(f"Invalid token during socket connection: {str(e)}")
         return False  # Reject connection if token is invalid
@@ -51,11 +309,15 @@ def handle_connect():
 def handle_disconnect():
     """Handle client disconnection"""
     current_app.logger.info(f"Client disconnected: {request.sid}")
-    # Clean up the mapping
-    if request.sid in socket_to_user:
-        del socket_to_user[request.sid]
+    # Clean up the session
+    session = sessions.remove(request.sid)
+    broadcast_presence(presence.disconnect(request.sid))
+    admission.forget(request.sid)
+    if session:
+        resume_tokens.park(session)
+        flush_idle_rooms(session.rooms, request.sid)
 
-@socketio.on('join')
+@socket_event('join')
 def handle_join(data):
     """Handle client joining a room"""
     room_id = data.get('roomId')
@@ -63,62 +325,41 @@ def handle_join(data):
         emit('error', {'message': 'Room ID is required'})
         return
     
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    # Each room is served by one worker; the client reconnects there
+    if redirect_elsewhere(room_id):
+        return
+    
     # Join the socket.io room
     join_room(str(room_id))
-    
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    sessions.join(request.sid, room_id)
     
     try:
-        # Get the user_id from our mapping instead of using request.sid
-        user_id = socket_to_user.get(request.sid)
-        if not user_id:
-            emit('error', {'message': 'Not authenticated'})
-            return
-            
-        cursor.execute('SELECT id, username, email FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            emit('error', {'message': 'User not found'})
-            return
-            
-        user = dict(user_row)
+        user = session.to_user()
         
-        # Check if user is a member of this room
-        cursor.execute('''
-            SELECT * FROM room_members 
-            WHERE room_id = ? AND user_id = ?
-        ''', (room_id, int(user_id)))
+        # Room code, language and roster come from the cache after the first join
+        room = get_room_state(room_id)
         
-        if not cursor.fetchone():
-            # Add user to room_members if not already a member
-            cursor.execute('''
-                INSERT OR IGNORE INTO room_members (room_id, user_id)
-                VALUES (?, ?)
-            ''', (room_id, int(user_id)))
-            conn.commit()
-        
-        # Get current room code
-        cursor.execute('SELECT code, language FROM rooms WHERE id = ?', (room_id,))
-        room_row = cursor.fetchone()
-        
-        if not room_row:
+        if not room:
             emit('error', {'message': 'Room not found'})
             return
-            
-        room = dict(room_row)
         
-        # Get all users currently in the room
-        cursor.execute('''
-            SELECT u.id, u.username, u.email 
-            FROM users u
-            JOIN room_members rm ON u.id = rm.user_id
-            WHERE rm.room_id = ?
-        ''', (room_id,))
+        if room.add_member(user):
+            # Add user to room_members if not already a member
+            try:
+                repository.add_member(room_id, session.user_id)
+            except Exception:
+                room.remove_member(session.user_id)
+                raise
         
-        users_in_room = [dict(row) for row in cursor.fetchall()]
+        # Tell the others if the user just came online; the joiner gets the full list in sync-code
+        diff = presence.join(request.sid, room_id)
+        if diff:
+            emit('presence-diff', diff, to=str(room_id), skip_sid=request.sid)
         
         # Notify everyone in the room that a new user joined
         emit('user-joined', {
@@ -128,23 +369,15 @@ def handle_join(data):
         }, to=str(room_id))
         
         # Send current code and room state to the user who just joined
-        emit('sync-code', {
-            'code': room['code'],
-            'language': room['language'],
-            'users': users_in_room
-        })
+        send_room_sync(room, data.get('chunkedSync'), data.get('encoding'))
         
         current_app.logger.info(f"User {user['username']} joined room {room_id}")
         
     except Exception as e:
-        conn.rollback()
         current_app.logger.error(f"Error joining room: {str(e)}")
         emit('error', {'message': f"Error joining room: {str(e)}"})
-    
-    finally:
-        cursor.close()
 
-@socketio.on('leave')
+@socket_event('leave')
 def handle_leave(data):
     """Handle client leaving a room"""
     room_id = data.get('roomId')
@@ -153,70 +386,169 @@ def handle_leave(data):
     
     # Leave the socket.io room
     leave_room(str(room_id))
+    flush_idle_rooms([room_id], request.sid)
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        # Get the user_id from our mapping instead of using request.sid
-        user_id = socket_to_user.get(request.sid)
-        if not user_id:
-            return
-            
-        cursor.execute('SELECT username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if user_row:
-            user = dict(user_row)
-            # Notify everyone in the room that a user left
-            emit('user-left', {
-                'userId': user_id,
-                'username': user['username'],
-                'message': f"{user['username']} left the room",
-                'timestamp': datetime.now().isoformat()
-            }, to=str(room_id))
-            
-            current_app.logger.info(f"User {user['username']} left room {room_id}")
-        
-    except Exception as e:
-        current_app.logger.error(f"Error leaving room: {str(e)}")
-    
-    finally:
-        cursor.close()
+    session = sessions.get(request.sid)
+    if not session:
+        return
+    sessions.leave(request.sid, room_id)
+    cursor_batcher.discard(room_id, session.user_id)
+    diff = presence.leave(request.sid, room_id)
+    if diff:
+        emit('presence-diff', diff, to=str(room_id))
+    
+    # Notify everyone in the room that a user left
+    emit('user-left', {
+        'userId': str(session.user_id),
+        'username': session.username,
+        'message': f"{session.username} left the room",
+        'timestamp': datetime.now().isoformat()
+    }, to=str(room_id))
+    
+    current_app.logger.info(f"User {session.username} left room {room_id}")
 
-@socketio.on('code-change')
+@socket_event('code-change')
 def handle_code_change(data):
-    """Handle code changes and broadcast to all users in the room"""
+    """Handle full-document code changes from clients that do not send operations"""
     room_id = data.get('roomId')
     code = data.get('code')
     
     if not room_id or code is None:
         return
     
-    # Get the user ID from our mapping for the broadcast
-    user_id = socket_to_user.get(request.sid)
+    if not isinstance(code, str):
+        emit('error', {'message': 'Invalid code: expected a string'})
+        return
+    
+    retry_after = admission.admit_event(request.sid, 'code-change')
+    if retry_after:
+        reject_event('code-change', retry_after)
+        return
+    
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    if redirect_elsewhere(room_id):
+        return
+    
+    document = get_room_document(room_id)
+    if document is None:
+        emit('error', {'message': 'Room not found'})
+        return
+    
+    # Turn the full buffer into a delta so peers only receive what changed
+    try:
+        ops, revision = document.replace(code)
+    except DocumentTooLarge as e:
+        reject_oversized(room_id, document, e)
+        return
+    mark_active(session)
+    if not ops:
+        return
     
-    # Broadcast the code change to everyone in the room except sender
-    emit('code-update', {
-        'code': code,
-        'userId': user_id  # Now sending the actual user ID instead of socket.id
+    emit('code-op', {
+        'roomId': str(room_id),
+        'ops': ops,
+        'revision': revision,
+        'userId': str(session.user_id)
     }, to=str(room_id), skip_sid=request.sid)
     
-    # Update code in the database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    write_behind.mark_dirty(room_id, document.text, document.revision)
+
+@socket_event('code-op')
+def handle_code_op(data):
+    """Handle an edit operation, rebase it onto the latest revision and broadcast it"""
+    room_id = data.get('roomId')
+    revision = data.get('revision')
+    
+    if not room_id or revision is None:
+        return
+    
+    retry_after = admission.admit_event(request.sid, 'code-op')
+    if retry_after:
+        reject_event('code-op', retry_after)
+        return
+    
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    if redirect_elsewhere(room_id):
+        return
+    
+    document = get_room_document(room_id)
+    if document is None:
+        emit('error', {'message': 'Room not found'})
+        return
     
     try:
-        cursor.execute('UPDATE rooms SET code = ? WHERE id = ?', (code, room_id))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        current_app.logger.error(f"Error updating code: {str(e)}")
-    finally:
-        cursor.close()
+        ops, revision = document.apply(normalize_operation(data.get('ops')), revision)
+    except RevisionError:
+        # The client is too far behind to rebase; send it the whole document
+        emit('code-resync', {
+            'roomId': str(room_id),
+            'code': document.text,
+            'revision': document.revision
+        })
+        return
+    except DocumentTooLarge as e:
+        reject_oversized(room_id, document, e)
+        return
+    except OperationError as e:
+        emit('error', {'message': f"Invalid operation: {str(e)}"})
+        return
+    
+    mark_active(session)
+    
+    # Acknowledge to the sender, broadcast the rebased operation to everyone else
+    emit('code-ack', {'revision': revision})
+    emit('code-op', {
+        'roomId': str(room_id),
+        'ops': ops,
+        'revision': revision,
+        'userId': str(session.user_id)
+    }, to=str(room_id), skip_sid=request.sid)
+    
+    write_behind.mark_dirty(room_id, document.text, document.revision)
 
-@socketio.on('language-change')
+@socket_event('sync-resume')
+def handle_sync_resume(data):
+    """Continue a chunked document transfer from chunk `index`, or restart it if it expired"""
+    room_id = data.get('roomId')
+    if not room_id:
+        emit('error', {'message': 'Room ID is required'})
+        return
+    
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    if str(room_id) not in session.rooms:
+        emit('error', {'message': 'Join the room before resuming a sync'})
+        return
+    
+    index = data.get('index', 0)
+    if not isinstance(index, int) or isinstance(index, bool) or index < 0:
+        emit('error', {'message': 'index must be a non-negative integer'})
+        return
+    
+    sync = chunked_syncs.get(data.get('syncId'), room_id)
+    if sync is not None:
+        send_chunks(sync, index, data.get('encoding'))
+        return
+    
+    # The transfer is gone; start over at the current revision
+    room = get_room_state(room_id)
+    if not room:
+        emit('error', {'message': 'Room not found'})
+        return
+    send_room_sync(room, True, data.get('encoding'))
+
+@socket_event('language-change')
 def handle_language_change(data):
     """Handle programming language changes"""
     room_id = data.get('roomId')
@@ -225,45 +557,34 @@ def handle_language_change(data):
     if not room_id or not language:
         return
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    session = sessions.get(request.sid)
+    if not session:
+        return
+    
+    if redirect_elsewhere(room_id):
+        return
     
     try:
-        # Get the user_id from our mapping instead of using request.sid
-        user_id = socket_to_user.get(request.sid)
-        if not user_id:
-            return
-            
-        cursor.execute('SELECT username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            return
-            
-        user = dict(user_row)
-        
         # Broadcast the language change to everyone in the room
         emit('language-update', {
             'language': language,
-            'username': user['username'],
-            'message': f"{user['username']} changed language to {language}",
+            'username': session.username,
+            'message': f"{session.username} changed language to {language}",
             'timestamp': datetime.now().isoformat()
         }, to=str(room_id))
         
-        # Update language in the database
-        cursor.execute('UPDATE rooms SET language = ? WHERE id = ?', (language, room_id))
-        conn.commit()
+        # Update language in the cache and the database
+        room = get_room_state(room_id)
+        if room:
+            room.language = language
+        repository.set_language(room_id, language)
         
-        current_app.logger.info(f"Language in room {room_id} changed to {language} by {user['username']}")
+        current_app.logger.info(f"Language in room {room_id} changed to {language} by {session.username}")
         
     except Exception as e:
-        conn.rollback()
         current_app.logger.error(f"Error changing language: {str(e)}")
-    finally:
-        cursor.close()
 
-@socketio.on('chat-message')
+@socket_event('chat-message')
 def handle_chat_message(data):
     """Handle chat messages within a room"""
     room_id = data.get('roomId')
@@ -272,81 +593,116 @@ def handle_chat_message(data):
     if not room_id or not message:
         return
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    retry_after = admission.admit_event(request.sid, 'chat-message')
+    if retry_after:
+        reject_event('chat-message', retry_after)
+        return
+    
+    session = sessions.get(request.sid)
+    if not session:
+        return
+    
+    if redirect_elsewhere(room_id):
+        return
+    
+    room = get_room_state(room_id)
+    if not room:
+        return
+    
+    mark_active(session)
+    
+    # Number the message and broadcast it; the row is written by the chat history flusher
+    entry = room.add_chat(session.user_id, session.username, message, datetime.now().isoformat())
+    emit('chat-message', entry, to=str(room_id))
+    
+    retention = room.chat_retention
+    if retention is None:
+        retention = current_app.config['CHAT_RETENTION']
+    chat_history.append(room_id, entry, retention)
+    
+    current_app.logger.info(f"Chat in room {room_id} from {session.username}: {message[:20]}...")
+
+@socket_event('chat-history')
+def handle_chat_history(data):
+    """Send a page of older chat messages, those before sequence number `before`"""
+    room_id = data.get('roomId')
+    if not room_id:
+        emit('error', {'message': 'Room ID is required'})
+        return
+    
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    if str(room_id) not in session.rooms:
+        emit('error', {'message': 'Join the room before requesting chat history'})
+        return
     
     try:
-        # Get the user_id from our mapping instead of using request.sid
-        user_id = socket_to_user.get(request.sid)
-        if not user_id:
-            return
-            
-        cursor.execute('SELECT id, username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            return
-            
-        user = dict(user_row)
-        
-        # Broadcast the message to everyone in the room
-        emit('chat-message', {
-            'userId': user['id'],
-            'username': user['username'],
-            'message': message,
-            'timestamp': datetime.now().isoformat()
-        }, to=str(room_id))
-        
-        current_app.logger.info(f"Chat in room {room_id} from {user['username']}: {message[:20]}...")
-        
-    except Exception as e:
-        current_app.logger.error(f"Error sending chat message: {str(e)}")
+        before = data.get('before')
+        before = int(before) if before is not None else None
+        limit = int(data.get('limit') or current_app.config['CHAT_HISTORY_PAGE_LIMIT'])
+    except (TypeError, ValueError):
+        emit('error', {'message': 'before and limit must be integers'})
+        return
+    limit = max(1, min(limit, current_app.config['CHAT_HISTORY_PAGE_LIMIT']))
     
-    finally:
-        cursor.close()
+    room = get_room_state(room_id)
+    if not room:
+        emit('error', {'message': 'Room not found'})
+        return
+    
+    # Recent pages come from memory; older ones are a primary key range scan
+    page = room.chat_page(before, limit)
+    if page is None:
+        chat_history.flush([room_id])
+        messages = db_executor.read(lambda conn: load_messages(conn.cursor(), room_id, limit + 1, before))
+        page = messages[-limit:], len(messages) > limit
+    
+    messages, has_more = page
+    emit('chat-history', {
+        'roomId': room_id,
+        'messages': messages,
+        'hasMore': has_more
+    })
 
-@socketio.on('cursor-position')
+@socket_event('cursor-position')
 def handle_cursor_position(data):
     """Handle cursor position updates for collaborative editing"""
     room_id = data.get('roomId')
-    position = data.get('position')  # { line, column }
+    position = data.get('position')  # { line, column }, or compactly [line, column]
     
     if not room_id or not position:
         return
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Dropped quietly: the next move supersedes it anyway
+    if admission.admit_event(request.sid, 'cursor-position'):
+        return
     
-    try:
-        # Get the user_id from our mapping instead of using request.sid
-        user_id = socket_to_user.get(request.sid)
-        if not user_id:
-            return
-            
-        cursor.execute('SELECT id, username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
+    if isinstance(position, list):
+        if len(position) != 2:
             return
-            
-        user = dict(user_row)
-        
-        # Broadcast cursor position to everyone except the sender
-        emit('cursor-update', {
-            'userId': user['id'],
-            'username': user['username'],
-            'position': position
-        }, to=str(room_id), skip_sid=request.sid)
-        
-    except Exception as e:
-        current_app.logger.error(f"Error updating cursor position: {str(e)}")
+        position = {'line': position[0], 'column': position[1]}
     
-    finally:
-        cursor.close()
+    session = sessions.get(request.sid)
+    if not session:
+        return
+    mark_active(session)
+    
+    # Coalesce into the next cursor-batch frame for the room
+    if cursor_batcher.enabled:
+        cursor_batcher.update(room_id, session.user_id, session.username, position)
+        return
+    
+    # Batching disabled: broadcast cursor position to everyone except the sender
+    emit('cursor-update', {
+        'userId': session.user_id,
+        'username': session.username,
+        'position': position
+    }, to=str(room_id), skip_sid=request.sid)
 
-@socketio.on('video-offer')
+@socket_event('video-offer')
 def handle_video_offer(data):
     """Handle WebRTC video call offer"""
     current_app.logger.info(f"Video offer received: {data}")
@@ -357,51 +713,30 @@ def handle_video_offer(data):
     if not room_id or not target_user_id or not offer:
         return
     
-    # Get the user ID of the caller
-    user_id = socket_to_user.get(request.sid)
-    if not user_id:
+    # Get the session of the caller
+    session = sessions.get(request.sid)
+    if not session:
         return
     
-    # Find the socket ID for the target user
-    target_socket_id = None
-    for socket_id, uid in socket_to_user.items():
-        if uid == str(target_user_id):
-            target_socket_id = socket_id
-            break
+    # Find every socket the target user has open in this room
+    target_socket_ids = sessions.sockets_for_user(target_user_id, room_id)
     
-    if not target_socket_id:
+    if not target_socket_ids:
         emit('error', {'message': 'Target user not connected'})
         return
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('SELECT id, username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            return
-            
-        user = dict(user_row)
-        
-        # Forward the offer to the target user
-        emit('video-offer', {
-            'userId': user['id'],
-            'username': user['username'],
-            'offer': offer
-        }, room=target_socket_id)
-        
-        current_app.logger.info(f"Video offer sent from {user['username']} to user {target_user_id}")
-        
-    except Exception as e:
-        current_app.logger.error(f"Error handling video offer: {str(e)}")
+    # Forward the offer to the target user
+    payload = {
+        'userId': session.user_id,
+        'username': session.username,
+        'offer': offer
+    }
+    for target_socket_id in target_socket_ids:
+        emit('video-offer', payload, room=target_socket_id)
     
-    finally:
-        cursor.close()
+    current_app.logger.info(f"Video offer sent from {session.username} to user {target_user_id}")
 
-@socketio.on('video-answer')
+@socket_event('video-answer')
 def handle_video_answer(data):
     """Handle WebRTC video call answer"""
     current_app.logger.info(f"Video answer received: {data}")
@@ -412,51 +747,30 @@ def handle_video_answer(data):
     if not room_id or not target_user_id or not answer:
         return
     
-    # Get the user ID of the answerer
-    user_id = socket_to_user.get(request.sid)
-    if not user_id:
+    # Get the session of the answerer
+    session = sessions.get(request.sid)
+    if not session:
         return
     
-    # Find the socket ID for the target user
-    target_socket_id = None
-    for socket_id, uid in socket_to_user.items():
-        if uid == str(target_user_id):
-            target_socket_id = socket_id
-            break
+    # Find every socket the target user has open in this room
+    target_socket_ids = sessions.sockets_for_user(target_user_id, room_id)
     
-    if not target_socket_id:
+    if not target_socket_ids:
         emit('error', {'message': 'Target user not connected'})
         return
     
-    # Get user details
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Forward the answer to the target user
+    payload = {
+        'userId': session.user_id,
+        'username': session.username,
+        'answer': answer
+    }
+    for target_socket_id in target_socket_ids:
+        emit('video-answer', payload, room=target_socket_id)
     
-    try:
-        cursor.execute('SELECT id, username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            return
-            
-        user = dict(user_row)
-        
-        # Forward the answer to the target user
-        emit('video-answer', {
-            'userId': user['id'],
-            'username': user['username'],
-            'answer': answer
-        }, room=target_socket_id)
-        
-        current_app.logger.info(f"Video answer sent from {user['username']} to user {target_user_id}")
-        
-    except Exception as e:
-        current_app.logger.error(f"Error handling video answer: {str(e)}")
-    
-    finally:
-        cursor.close()
+    current_app.logger.info(f"Video answer sent from {session.username} to user {target_user_id}")
 
-@socketio.on('ice-candidate')
+@socket_event('ice-candidate')
 def handle_ice_candidate(data):
     """Handle ICE candidate exchange for WebRTC"""
     current_app.logger.info(f"ICE candidate received: {data}")
@@ -467,63 +781,115 @@ def handle_ice_candidate(data):
     if not room_id or not target_user_id or not candidate:
         return
     
-    # Get the user ID of the sender
-    user_id = socket_to_user.get(request.sid)
-    if not user_id:
+    # Get the session of the sender
+    session = sessions.get(request.sid)
+    if not session:
         return
     
-    # Find the socket ID for the target user
-    target_socket_id = None
-    for socket_id, uid in socket_to_user.items():
-        if uid == str(target_user_id):
-            target_socket_id = socket_id
-            break
+    # Find every socket the target user has open in this room
+    target_socket_ids = sessions.sockets_for_user(target_user_id, room_id)
     
-    if not target_socket_id:
+    if not target_socket_ids:
         return
     
     # Forward the ICE candidate to the target user
-    emit('ice-candidate', {
-        'userId': user_id,
+    payload = {
+        'userId': str(session.user_id),
         'candidate': candidate
-    }, room=target_socket_id)
+    }
+    for target_socket_id in target_socket_ids:
+        emit('ice-candidate', payload, room=target_socket_id)
+    
+    current_app.logger.debug(f"ICE candidate forwarded from user {session.user_id} to user {target_user_id}")
+
+@socketio.on('presence')
+def handle_presence(data):
+    """Heartbeat keeping the socket online; `state` reports the user 'active' or 'idle'"""
+    session = sessions.get(request.sid)
+    if not session:
+        return
     
-    current_app.logger.debug(f"ICE candidate forwarded from user {user_id} to user {target_user_id}")
+    state = (data or {}).get('state')
+    active = {'active': True, 'idle': False}.get(state)
+    broadcast_presence(presence.touch(request.sid, active, session.to_user(), session.rooms))
+
+@socket_event('resume-token')
+def handle_resume_token():
+    """Issue a token this client can use to resume its session after a dropped connection"""
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    emit('resume-token', {
+        'token': resume_tokens.issue(session),
+        'expiresIn': resume_tokens.ttl
+    })
+
+@socket_event('resume')
+def handle_resume(data):
+    """Catch a resumed socket up on its rooms from the revision and chat message it last saw.
 
-@socketio.on('get-my-user-id')
+    Each room gets a room-resumed event with the missed operations, or a
+    full sync-code if they are no longer in the document's history.
+    """
+    session = sessions.get(request.sid)
+    if not session:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    for entry in (data or {}).get('rooms') or []:
+        room_id = str(entry.get('roomId'))
+        if redirect_elsewhere(room_id):
+            continue
+        if room_id not in session.rooms:
+            emit('error', {'message': f"Not in room {room_id}"})
+            continue
+        
+        room = get_room_state(room_id)
+        if not room:
+            emit('error', {'message': 'Room not found'})
+            continue
+        
+        revision = entry.get('revision')
+        missed = room.document.operations_since(revision) if isinstance(revision, int) else None
+        if missed is None:
+            send_room_sync(room, entry.get('chunkedSync'), entry.get('encoding'))
+            continue
+        
+        chat_seq = entry.get('chatSeq')
+        emit('room-resumed', {
+            'roomId': room_id,
+            'fromRevision': revision,
+            'revision': revision + len(missed),
+            'ops': missed,
+            'language': room.language,
+            'videoEnabled': room.video_enabled,
+            'users': online_users(room_id),
+            'chat': [m for m in room.recent_chat if isinstance(chat_seq, int) and m['seq'] > chat_seq]
+        })
+
+@socket_event('get-my-user-id')
 def handle_get_my_user_id():
     """Send the user their own user ID"""
-    user_id = socket_to_user.get(request.sid)
-    if user_id:
-        emit('your-user-id', {'userId': user_id})
+    session = sessions.get(request.sid)
+    if session:
+        emit('your-user-id', {'userId': str(session.user_id)})
 
-@socketio.on('get-users')
+@socket_event('get-users')
 def handle_get_users(data):
-    """Get all users in a room"""
+    """Get the users online in a room"""
     room_id = data.get('roomId')
     
     if not room_id:
         return
     
-    # Get user ID from socket mapping
-    user_id = socket_to_user.get(request.sid)
-    if not user_id:
+    if request.sid not in sessions:
         emit('error', {'message': 'Not authenticated'})
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Get all users in the room
-        cursor.execute('''
-            SELECT u.id, u.username
-            FROM users u
-            JOIN room_members rm ON u.id = rm.user_id
-            WHERE rm.room_id = ?
-        ''', (room_id,))
-        
-        users = [dict(row) for row in cursor.fetchall()]
+        users = online_users(room_id)
         
         emit('room-users', {
             'users': users
@@ -531,10 +897,8 @@ def handle_get_users(data):
         
     except Exception as e:
         current_app.logger.error(f"Error getting room users: {str(e)}")
-    finally:
-        cursor.close()
 
-@socketio.on('get-username')
+@socket_event('get-username')
 def handle_get_username(data):
     """Get username for a user ID"""
     user_id = data.get('userId')
@@ -542,12 +906,8 @@ def handle_get_username(data):
     if not user_id:
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('SELECT username FROM users WHERE id = ?', (int(user_id),))
-        user_row = cursor.fetchone()
+        user_row = repository.get_user(user_id)
         
         if user_row:
             emit('user-info', {
@@ -556,12 +916,53 @@ def handle_get_username(data):
             })
     except Exception as e:
         current_app.logger.error(f"Error getting username: {str(e)}")
-    finally:
-        cursor.close()
 
 # Register the socket events with the Flask app
 def init_socket_events(app):
     """Initialize socket events with the Flask app"""
-    app.logger.info("Socket events initialized")
-    # Nothing to do here since we're using the socketio instance directly
-    pass
\ No newline at end of file
+    # Handlers are registered on the socketio instance directly; share socket state between workers
+    sessions.configure(create_registry(app.config['SOCKET_REGISTRY_URL'], app.config['WORKER_TTL']))
+    sessions.registry.start(socketio, app.config['WORKER_HEARTBEAT_INTERVAL'])
+    affinity.configure(
+        app.config['WORKER_URL'],
+        app.config['WORKER_HEARTBEAT_INTERVAL'],
+        app.config['WORKER_TTL'],
+        app.config['ROOM_RING_REPLICAS']
+    )
+    affinity.start(socketio, sessions.registry, release_moved_rooms, forget_room)
+    
+    # Start the background flushers
+    revisions.configure(
+        app.config['REVISION_SNAPSHOT_INTERVAL'],
+        app.config['REVISION_COMPACT_AGE'],
+        app.config['REVISION_COMPACT_BUCKET'],
+        app.config['REVISION_COMPACT_INTERVAL']
+    )
+    revisions.start(socketio)
+    write_behind.configure(app.config['WRITE_BEHIND_INTERVAL'], revisions)
+    write_behind.start(socketio)
+    cursor_batcher.configure(app.config['CURSOR_BATCH_RATE'])
+    cursor_batcher.start(socketio)
+    chat_history.configure(app.config['CHAT_FLUSH_INTERVAL'])
+    chunked_syncs.configure(app.config['SYNC_CHUNK_THRESHOLD'], app.config['SYNC_CHUNK_SIZE'], app.config['SYNC_RESUME_TTL'])
+    chat_history.start(socketio)
+    presence.configure(
+        app.config['PRESENCE_IDLE_AFTER'],
+        app.config['PRESENCE_EXPIRE_AFTER'],
+        app.config['PRESENCE_SWEEP_INTERVAL']
+    )
+    presence.start(socketio)
+    outbound_queues.start(socketio)
+    resume_tokens.configure(app.config['SESSION_RESUME_TTL'])
+    admission.configure(
+        app.config['ADMISSION_IP_RATE'],
+        app.config['ADMISSION_IP_BURST'],
+        app.config['ADMISSION_USER_RATE'],
+        app.config['ADMISSION_USER_BURST'],
+        app.config['ADMISSION_MAX_HANDSHAKES'],
+        app.config['ADMISSION_RETRY_BASE'],
+        app.config['ADMISSION_RETRY_MAX'],
+        app.config['TRUSTED_PROXY_COUNT'],
+        parse_event_limits(app.config['SOCKET_EVENT_LIMITS'])
+    )
+    app.logger.info("Socket events initialized")
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""Per-process cache of active room state.
+
+A room is hydrated from the repository (and its recent chat from the chat
+history) the first time a socket touches it and is then kept current in
+place by the socket handlers and REST routes, so joins and syncs are served
+from memory. Once the last socket leaves a room and its code and chat are
+written, the room is dropped again, so the cache holds only rooms in use.
+"""
+from collections import deque
+from flask import current_app
+from app.chat.history import load_messages
+from app.executor import db_executor
+from app.repository import repository
+from app.rooms.ot import Document
+
+
+class RoomState:
+    """Authoritative in-memory state of one room"""
+
+    __slots__ = ('room_id', 'document', 'language', 'video_enabled', 'members',
+                 'chat_seq', 'recent_chat', 'chat_complete', 'chat_retention')
+
+    def __init__(self, room_id, document, language, video_enabled, members,
+                 recent_chat=(), chat_limit=50, chat_retention=None):
+        self.room_id = room_id
+        self.document = document
+        self.language = language
+        self.video_enabled = video_enabled
+        self.members = members  # user_id -> {'id', 'username', 'email'}
+        # Latest chat messages, oldest first; complete while they are the room's whole history
+        self.recent_chat = deque(recent_chat, maxlen=chat_limit)
+        self.chat_complete = len(self.recent_chat) < chat_limit
+        self.chat_seq = self.recent_chat[-1]['seq'] if self.recent_chat else 0
+        self.chat_retention = chat_retention  # None uses CHAT_RETENTION
+
+    def add_member(self, user):
+        """Add a user to the roster; returns False if they were already in it"""
+        if user['id'] in self.members:
+            return False
+        self.members[user['id']] = user
+        return True
+
+    def remove_member(self, user_id):
+        self.members.pop(int(user_id), None)
+
+    def roster(self, fields=('id', 'username', 'email')):
+        """Members of the room as a list of dicts"""
+        return [{field: member[field] for field in fields} for member in self.members.values()]
+
+    def add_chat(self, user_id, username, message, timestamp):
+        """Assign the next sequence number to a chat message and remember it"""
+        self.chat_seq += 1
+        entry = {
+            'seq': self.chat_seq,
+            'userId': user_id,
+            'username': username,
+            'message': message,
+            'timestamp': timestamp
+        }
+        if len(self.recent_chat) == self.recent_chat.maxlen:
+            self.chat_complete = False
+        self.recent_chat.append(entry)
+        return entry
+
+    def chat_page(self, before, limit):
+        """Up to `limit` messages before `before` from memory as (messages, has_more), or None if the DB is needed"""
+        messages = [entry for entry in self.recent_chat if before is None or entry['seq'] < before]
+        if len(messages) > limit:
+            return messages[-limit:], True
+        if self.chat_complete:
+            return messages, False
+        return None
+
+
+# Cached rooms keyed by room ID
+room_states = {}
+
+
+def get_room_state(room_id):
+    """Get the cached state for a room, loading it from the database on first access"""
+    state = room_states.get(str(room_id))
+    if state is not None:
+        return state
+
+    chat_limit = current_app.config.get('CHAT_SYNC_LIMIT', 50)
+
+    loaded = repository.load_room(room_id)
+    if loaded is None:
+        return None
+    room_row, members = loaded
+    recent_chat = db_executor.read(lambda conn: load_messages(conn.cursor(), room_id, chat_limit))
+
+    state = RoomState(
+        str(room_id),
+        Document(
+            room_row['code'] or '',
+            revision=room_row['revision'],
+            history_limit=current_app.config.get('DOCUMENT_HISTORY_LIMIT', 500),
+            max_length=current_app.config.get('MAX_DOCUMENT_SIZE')
+        ),
+        room_row['language'],
+        room_row['video_enabled'],
+        {member['id']: member for member in members},
+        recent_chat=recent_chat,
+        chat_limit=chat_limit,
+        chat_retention=room_row['chat_retention']
+    )
+    return room_states.setdefault(str(room_id), state)
+
+
+def get_cached_room_state(room_id):
+    """Get the state for a room only if it is already cached"""
+    return room_states.get(str(room_id))
+
+
+def drop_room_state(room_id):
+    """Forget a room, e.g. after it was deleted or its last socket left"""
+    room_states.pop(str(room_id), None)
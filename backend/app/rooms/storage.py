@@ -0,0 +1,54 @@
+"""Compressed storage of document text.
+
+Text at or above `min_size` characters is stored as a zlib-compressed BLOB,
+shorter text stays a plain TEXT value. SQLite keeps the storage class per
+value, so `decode` tells the two apart by type and rows written before
+compression was enabled read back unchanged.
+"""
+import zlib
+
+
+class TextCodec:
+    """Encodes document text for the database and decodes it back"""
+
+    def __init__(self, min_size=4096, level=6):
+        self.min_size = min_size
+        self.level = level
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def configure(self, min_size, level):
+        """Set the compression threshold (0 disables compression) and zlib level"""
+        self.min_size = min_size
+        self.level = level
+
+    def encode(self, text):
+        """Value to store for `text`: the text itself, or compressed bytes if it is large"""
+        if not self.min_size or text is None or len(text) < self.min_size:
+            return text
+        raw = text.encode('utf-8')
+        packed = zlib.compress(raw, self.level)
+        self.compressed += 1
+        self.bytes_in += len(raw)
+        self.bytes_out += len(packed)
+        return packed
+
+    @staticmethod
+    def decode(value):
+        """Text of a stored value, compressed or not"""
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+    def stats(self):
+        return {
+            'min_size': self.min_size,
+            'documents_compressed': self.compressed,
+            'bytes_before_compression': self.bytes_in,
+            'bytes_after_compression': self.bytes_out,
+        }
+
+
+# Shared codec, configured in create_app
+text_codec = TextCodec()
@@ -0,0 +1,135 @@
+"""Chunked, resumable document transfer for large rooms.
+
+Clients that join with `chunkedSync` get `sync-code` without the text when
+the document is at least `threshold` characters long. The text then
+follows as numbered `sync-chunk` events, so the client can render as it
+arrives. Each transfer is pinned to the revision the client joined at and
+kept for `ttl` seconds, so a client that lost chunks can ask for the rest
+with `sync-resume`. Edits made meanwhile reach the client as ordinary
+`code-op` events with later revisions, to apply once the transfer is done.
+"""
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+
+class ChunkedSync:
+    """One document transfer: the text at a revision, split into chunks"""
+
+    __slots__ = ('sync_id', 'room_id', 'text', 'revision', 'chunk_size', 'created_at')
+
+    def __init__(self, sync_id, room_id, text, revision, chunk_size):
+        self.sync_id = sync_id
+        self.room_id = room_id
+        self.text = text
+        self.revision = revision
+        self.chunk_size = chunk_size
+        self.created_at = time.monotonic()
+
+    @property
+    def chunks(self):
+        return max(1, -(-len(self.text) // self.chunk_size))
+
+    def describe(self):
+        """The `sync` field of sync-code"""
+        return {
+            'syncId': self.sync_id,
+            'revision': self.revision,
+            'length': len(self.text),
+            'chunkSize': self.chunk_size,
+            'chunks': self.chunks
+        }
+
+    def chunk(self, index, encoding=None):
+        """Payload of chunk `index`; with encoding 'deflate' the data is zlib-compressed UTF-8 bytes"""
+        offset = index * self.chunk_size
+        data = self.text[offset:offset + self.chunk_size]
+        if encoding == 'deflate':
+            data = zlib.compress(data.encode('utf-8'))
+        return {
+            'syncId': self.sync_id,
+            'index': index,
+            'chunks': self.chunks,
+            'offset': offset,
+            'encoding': encoding or 'text',
+            'data': data,
+            'final': index == self.chunks - 1
+        }
+
+
+class ChunkedSyncs:
+    """Recent transfers by ID, expired after `ttl` seconds and capped at `max_entries`"""
+
+    def __init__(self, threshold=262144, chunk_size=65536, ttl=120, max_entries=256):
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+        self.chunks_sent = 0
+
+    def configure(self, threshold, chunk_size, ttl):
+        """Set the size that triggers chunking (0 disables it), the chunk size and the resume window"""
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+
+    def wants_chunks(self, text, requested):
+        return bool(requested) and self.threshold > 0 and len(text) >= self.threshold
+
+    def _expire(self, now):
+        while self.entries:
+            sync = next(iter(self.entries.values()))
+            if now - sync.created_at < self.ttl and len(self.entries) <= self.max_entries:
+                break
+            self.entries.popitem(last=False)
+            self.expired += 1
+
+    def start(self, room_id, text, revision):
+        """Begin a transfer of `text` at `revision`"""
+        sync = ChunkedSync(uuid.uuid4().hex, str(room_id), text, revision, self.chunk_size)
+        with self.lock:
+            self.entries[sync.sync_id] = sync
+            self._expire(sync.created_at)
+        self.started += 1
+        return sync
+
+    def get(self, sync_id, room_id):
+        """A transfer still in its resume window, or None"""
+        with self.lock:
+            self._expire(time.monotonic())
+            sync = self.entries.get(sync_id)
+        if sync is None or sync.room_id != str(room_id):
+            return None
+        self.resumed += 1
+        return sync
+
+    def discard_room(self, room_id):
+        """Forget transfers of a room, e.g. because it was deleted"""
+        with self.lock:
+            for sync_id in [s.sync_id for s in self.entries.values() if s.room_id == str(room_id)]:
+                del self.entries[sync_id]
+
+    def stats(self):
+        with self.lock:
+            active = len(self.entries)
+            held = sum(len(sync.text) for sync in self.entries.values())
+        return {
+            'active_transfers': active,
+            'characters_held': held,
+            'transfers_started': self.started,
+            'transfers_resumed': self.resumed,
+            'transfers_expired': self.expired,
+            'chunks_sent': self.chunks_sent,
+        }
+
+
+# Shared transfer table, configured in init_socket_events
+chunked_syncs = ChunkedSyncs()
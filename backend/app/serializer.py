@@ -0,0 +1,188 @@
+"""Per-connection MessagePack encoding for Socket.IO traffic.
+
+`NegotiatedPacket` is installed as the Socket.IO server's packet class. It
+speaks the default JSON text protocol and also decodes MessagePack binary
+packets, as sent by socket.io-msgpack-parser. A connection whose first
+packet arrives as binary is switched to MessagePack for everything sent to
+it, so JSON clients keep working next to MessagePack ones. Broadcasts are
+still encoded once per packet, not once per recipient: the MessagePack
+form is built on first use and shared by every MessagePack recipient.
+
+MessagePack connections also get cursors in a compact form. Each cursor in
+`cursor-batch` becomes `[userId, line, column]` (the username is in the
+roster), and `cursor-update` carries that array as its argument. Cursors
+with fields other than line and column keep the full object form.
+
+MessagePack support needs `pip install msgpack`; without it every
+connection uses JSON.
+"""
+import threading
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+
+def compact_cursor(cursor):
+    """[userId, line, column] for a plain cursor, or the cursor unchanged"""
+    position = cursor.get('position')
+    if isinstance(position, dict) and len(position) == 2:
+        line, column = position.get('line'), position.get('column')
+        if type(line) is int and type(column) is int:
+            return [cursor.get('userId'), line, column]
+    return cursor
+
+
+def compact_cursor_batch(data):
+    return {**data, 'cursors': [compact_cursor(cursor) for cursor in data.get('cursors', ())]}
+
+
+# Events whose payload has a compact form for MessagePack connections
+COMPACT_EVENTS = {
+    'cursor-batch': compact_cursor_batch,
+    'cursor-update': compact_cursor,
+}
+
+
+class TaggedText(str):
+    """Encoded JSON packet text that remembers the packet it came from"""
+
+
+class NegotiatedPacket(packet.Packet):
+    """Socket.IO packet that can be sent as JSON text or as MessagePack"""
+
+    attachments_sent = 0
+
+    def encode(self):
+        encoded = super().encode()
+        # Only keep a reference to the packet while MessagePack connections exist
+        if packet_codecs.binary_sids:
+            if isinstance(encoded, list):
+                self.attachments_sent = len(encoded) - 1
+                encoded[0] = TaggedText(encoded[0])
+                encoded[0].packet = self
+            else:
+                encoded = TaggedText(encoded)
+                encoded.packet = self
+        return encoded
+
+    def encode_msgpack(self):
+        """MessagePack form of the packet, built once and cached"""
+        encoded = getattr(self, '_msgpack', None)
+        if encoded is None:
+            data = self.data
+            if self.packet_type in (packet.EVENT, packet.BINARY_EVENT) and isinstance(data, list) and len(data) == 2:
+                compact = COMPACT_EVENTS.get(data[0])
+                if compact is not None and isinstance(data[1], dict):
+                    data = [data[0], compact(data[1])]
+            # MessagePack carries bytes natively, so binary packets go out as plain events and acks
+            packet_type = {packet.BINARY_EVENT: packet.EVENT, packet.BINARY_ACK: packet.ACK}.get(
+                self.packet_type, self.packet_type)
+            payload = {'type': packet_type, 'data': data, 'nsp': self.namespace or '/'}
+            if self.id is not None:
+                payload['id'] = self.id
+            encoded = self._msgpack = msgpack.packb(payload)
+        return encoded
+
+    def decode(self, encoded_packet):
+        if isinstance(encoded_packet, bytes):
+            if msgpack is None:
+                raise ValueError('MessagePack packets need the msgpack package')
+            decoded = msgpack.unpackb(encoded_packet)
+            self.packet_type = decoded['type']
+            self.data = decoded.get('data')
+            self.id = decoded.get('id')
+            self.namespace = decoded.get('nsp') or '/'
+            return 0
+        return super().decode(encoded_packet)
+
+
+class PacketCodecs:
+    """Tracks which connections use MessagePack and re-encodes what is sent to them"""
+
+    def __init__(self):
+        self.binary_sids = set()  # Engine.IO sids of MessagePack connections
+        self.skip_attachments = {}  # eio_sid -> JSON binary attachments still to drop
+        self.lock = threading.Lock()
+
+        self.msgpack_packets = 0
+        self.msgpack_bytes = 0
+        self.json_bytes_replaced = 0
+
+    @property
+    def available(self):
+        return msgpack is not None
+
+    def install(self, server):
+        """Hook a socketio.Server using NegotiatedPacket"""
+        send_packet = server.eio.send_packet
+        if getattr(send_packet, 'codec_wrapped', False):
+            return
+        handle_eio_message = server._handle_eio_message
+        handle_eio_disconnect = server._handle_eio_disconnect
+
+        def negotiating_handle_eio_message(eio_sid, data):
+            # A binary packet that is not an attachment means a MessagePack client
+            if (isinstance(data, bytes) and eio_sid not in self.binary_sids
+                    and eio_sid not in server._binary_packet and self.available):
+                with self.lock:
+                    self.binary_sids.add(eio_sid)
+            return handle_eio_message(eio_sid, data)
+
+        def forgetting_handle_eio_disconnect(eio_sid, *args):
+            try:
+                return handle_eio_disconnect(eio_sid, *args)
+            finally:
+                with self.lock:
+                    self.binary_sids.discard(eio_sid)
+                    self.skip_attachments.pop(eio_sid, None)
+
+        def transcoding_send_packet(eio_sid, pkt):
+            if eio_sid in self.binary_sids and pkt.packet_type == eio_packet.MESSAGE:
+                pending = self.skip_attachments.get(eio_sid)
+                if pending:
+                    # Already sent inside the MessagePack packet
+                    if pending == 1:
+                        del self.skip_attachments[eio_sid]
+                    else:
+                        self.skip_attachments[eio_sid] = pending - 1
+                    return
+                source = getattr(pkt.data, 'packet', None)
+                if source is None and isinstance(pkt.data, str):
+                    # Encoded before the first MessagePack client connected
+                    source = NegotiatedPacket(encoded_packet=pkt.data)
+                    if source.attachment_count:
+                        source = None
+                if source is not None:
+                    encoded = source.encode_msgpack()
+                    if source.attachments_sent:
+                        self.skip_attachments[eio_sid] = source.attachments_sent
+                    self.msgpack_packets += 1
+                    self.msgpack_bytes += len(encoded)
+                    self.json_bytes_replaced += len(pkt.data)
+                    pkt = eio_packet.Packet(eio_packet.MESSAGE, encoded)
+            return send_packet(eio_sid, pkt)
+
+        transcoding_send_packet.codec_wrapped = True
+        # The Engine.IO server holds the handlers it was created with, so register them again
+        server._handle_eio_message = negotiating_handle_eio_message
+        server._handle_eio_disconnect = forgetting_handle_eio_disconnect
+        server.eio.on('message', negotiating_handle_eio_message)
+        server.eio.on('disconnect', forgetting_handle_eio_disconnect)
+        server.eio.send_packet = transcoding_send_packet
+
+    def stats(self):
+        return {
+            'msgpack_connections': len(self.binary_sids),
+            'msgpack_packets': self.msgpack_packets,
+            'msgpack_bytes': self.msgpack_bytes,
+            'json_bytes_replaced': self.json_bytes_replaced,
+        }
+
+
+# Shared codec state, installed by create_app
+packet_codecs = PacketCodecs()
@@ -1,3 +1,6 @@
+import json
+import threading
+
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
 from flask_swagger_ui import get_swaggerui_blueprint
@@ -31,9 +34,31 @@ swaggerui_blueprint = get_swaggerui_blueprint(
     }
 )
 
+# The spec is built on first use; registering its paths twice is an error
+_spec_dict = None
+_spec_document = None
+_spec_lock = threading.Lock()
+
 # Define API documentation
 def generate_swagger_spec():
-    """Generate the Swagger specification"""
+    """Generate the Swagger specification (once per process)"""
+    global _spec_dict
+    with _spec_lock:
+        if _spec_dict is None:
+            _spec_dict = _build_swagger_spec()
+    return _spec_dict
+
+def swagger_document():
+    """The serialized spec and its strong ETag, computed once"""
+    global _spec_document
+    if _spec_document is None:
+        from app.http_cache import content_etag
+        body = json.dumps(generate_swagger_spec(), separators=(',', ':'), sort_keys=True).encode('utf-8')
+        _spec_document = (body, content_etag(body))
+    return _spec_document
+
+def _build_swagger_spec():
+    """Register every documented path on the module-level spec"""
     
     # Authentication endpoints
     spec.path(
@@ -159,7 +184,7 @@ def generate_swagger_spec():
         operations={
             "get": {
                 "tags": ["Rooms"],
-                "summary": "Get all available rooms",
+                "summary": "List rooms newest first, one page at a time",
                 "security": [{"bearerAuth": []}],
                 "parameters": [
                     {
@@ -168,11 +193,46 @@ def generate_swagger_spec():
                         "description": "Filter rooms by user membership",
                         "required": False,
                         "schema": {"type": "boolean"}
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "integer"},
+                        "description": "Page size (default 50, max 200)"
+                    },
+                    {
+                        "name": "after",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "string"},
+                        "description": "The next cursor of the previous page"
+                    },
+                    {
+                        "name": "fields",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "string"},
+                        "description": "Comma separated room fields to return (default: all but code)"
+                    },
+                    {
+                        "name": "language",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "string"},
+                        "description": "Only rooms in this language"
+                    },
+                    {
+                        "name": "owner_id",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "integer"},
+                        "description": "Only rooms owned by this user"
                     }
                 ],
                 "responses": {
                     "200": {
-                        "description": "List of rooms",
+                        "description": "A page of rooms",
                         "content": {
                             "application/json": {
                                 "schema": {
@@ -181,12 +241,14 @@ def generate_swagger_spec():
                                         "rooms": {
                                             "type": "array",
                                             "items": {"type": "object"}
-                                        }
+                                        },
+                                        "next": {"type": "string", "nullable": True}
                                     }
                                 }
                             }
                         }
                     },
+                    "400": {"description": "Invalid limit, after, fields or owner_id"},
                     "500": {"description": "Server error"}
                 }
             },
@@ -376,7 +438,209 @@ def generate_swagger_spec():
             }
         }
     )
-    
+
+    spec.path(
+        path="/api/rooms/{room_id}/chat-retention",
+        operations={
+            "put": {
+                "tags": ["Rooms"],
+                "summary": "Set how many chat messages the room keeps (owner only)",
+                "security": [{"bearerAuth": []}],
+                "parameters": [
+                    {
+                        "name": "room_id",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    }
+                ],
+                "requestBody": {
+                    "required": True,
+                    "content": {
+                        "application/json": {
+                            "schema": {
+                                "type": "object",
+                                "properties": {
+                                    "retention": {
+                                        "type": "integer",
+                                        "nullable": True,
+                                        "description": "Messages to keep; null restores the server default"
+                                    }
+                                },
+                                "required": ["retention"]
+                            }
+                        }
+                    }
+                },
+                "responses": {
+                    "200": {
+                        "description": "Retention updated",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "msg": {"type": "string"},
+                                        "retention": {"type": "integer"}
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    "400": {"description": "Invalid retention"},
+                    "404": {"description": "Room not found or not authorized"},
+                    "500": {"description": "Server error"}
+                }
+            }
+        }
+    )
+
+    spec.path(
+        path="/api/rooms/{room_id}/revisions",
+        operations={
+            "get": {
+                "tags": ["Rooms"],
+                "summary": "List stored document revisions, newest first",
+                "security": [{"bearerAuth": []}],
+                "parameters": [
+                    {
+                        "name": "room_id",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "integer"},
+                        "description": "Page size (default 50, max 200)"
+                    },
+                    {
+                        "name": "before",
+                        "in": "query",
+                        "required": False,
+                        "schema": {"type": "integer"},
+                        "description": "The next value of the previous page"
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "A page of revisions",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "revisions": {"type": "array", "items": {"type": "object"}},
+                                        "next": {"type": "integer", "nullable": True}
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    "400": {"description": "Invalid limit or before"},
+                    "404": {"description": "Room not found or not a member"},
+                    "500": {"description": "Server error"}
+                }
+            }
+        }
+    )
+
+    spec.path(
+        path="/api/rooms/{room_id}/revisions/{revision}",
+        operations={
+            "get": {
+                "tags": ["Rooms"],
+                "summary": "Get the document at a stored revision",
+                "security": [{"bearerAuth": []}],
+                "parameters": [
+                    {
+                        "name": "room_id",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    },
+                    {
+                        "name": "revision",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Document text at the revision",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "revision": {"type": "integer"},
+                                        "code": {"type": "string"}
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    "404": {"description": "Room, membership or revision not found"},
+                    "500": {"description": "Server error"}
+                }
+            }
+        }
+    )
+
+    spec.path(
+        path="/api/rooms/{room_id}/revisions/{from_revision}/diff/{to_revision}",
+        operations={
+            "get": {
+                "tags": ["Rooms"],
+                "summary": "Diff two stored revisions",
+                "security": [{"bearerAuth": []}],
+                "parameters": [
+                    {
+                        "name": "room_id",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    },
+                    {
+                        "name": "from_revision",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    },
+                    {
+                        "name": "to_revision",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "integer"}
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Operation and unified diff from one revision to the other",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "from": {"type": "integer"},
+                                        "to": {"type": "integer"},
+                                        "ops": {"type": "array", "items": {"type": "object"}},
+                                        "diff": {"type": "string"}
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    "404": {"description": "Room, membership or revision not found"},
+                    "500": {"description": "Server error"}
+                }
+            }
+        }
+    )
+
     # Add security scheme for JWT
     spec.components.security_scheme("bearerAuth", {
         "type": "http",
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Login storm benchmark: socket event latency while bcrypt logins are running.
+
+Runs the same storm against create_app() twice, once hashing inline on the
+request greenlet (the old behaviour, PASSWORD_HASH_WORKERS=0) and once through
+the bounded hashing pool, while a probe client sends a cursor-position event
+every 10 ms. Late probes mean the eventlet hub was frozen.
+
+    python benchmarks/login_storm.py --logins 40 --concurrency 20 --json storm.json
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.filterwarnings('ignore')
+
+from common import summarize
+
+
+def run_storm(app, socketio, room_id, token, logins, concurrency, interval):
+    """Fire `logins` logins from `concurrency` greenlets and probe event latency meanwhile"""
+    probe = socketio.test_client(app, query_string=f'token={token}')
+    probe.emit('join', {'roomId': room_id})
+    probe.get_received()
+
+    statuses = {}
+    latencies = []
+    done = []
+
+    def login_worker(count):
+        client = app.test_client()
+        for _ in range(count):
+            response = client.post('/api/auth/login', json={'username': 'bench', 'password': 'bench-password'})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    def probe_loop():
+        started = time.perf_counter()
+        tick = 0
+        while not done:
+            tick += 1
+            target = started + tick * interval
+            eventlet.sleep(max(0.0, target - time.perf_counter()))
+            probe.emit('cursor-position', {'roomId': room_id, 'position': {'line': tick, 'column': 0}})
+            latencies.append(time.perf_counter() - target)
+
+    per_worker = [logins // concurrency + (1 if i < logins % concurrency else 0) for i in range(concurrency)]
+    prober = eventlet.spawn(probe_loop)
+    started = time.perf_counter()
+    pool = eventlet.GreenPool(concurrency)
+    for count in per_worker:
+        if count:
+            pool.spawn(login_worker, count)
+    pool.waitall()
+    elapsed = time.perf_counter() - started
+    done.append(True)
+    prober.wait()
+    probe.disconnect()
+
+    result = summarize(latencies)
+    result['logins'] = logins
+    result['login_seconds'] = elapsed
+    result['statuses'] = statuses
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=20, help='total logins in the storm')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent login clients')
+    parser.add_argument('--workers', type=int, default=2, help='hashing pool workers for the pooled run')
+    parser.add_argument('--max-pending', type=int, default=64, help='hashing queue limit for the pooled run')
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between probe events')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    output = os.path.abspath(args.json) if args.json else None
+
+    os.chdir(tempfile.mkdtemp(prefix='codecollab-bench-'))
+    os.environ['CURSOR_BATCH_RATE'] = '0'
+    os.environ['JWT_SECRET_KEY'] = 'benchmark-jwt-secret-key-of-sufficient-length'
+
+    from app import create_app, socketio
+    from app.auth.utils import password_pool
+    from app.db import init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    token = client.post('/api/auth/register', json={
+        'username': 'bench', 'email': 'bench@example.com', 'password': 'bench-password'
+    }).get_json()['access_token']
+    room_id = client.post('/api/rooms/', json={'name': 'bench'}, headers={
+        'Authorization': f'Bearer {token}'
+    }).get_json()['room']['id']
+
+    results = {}
+    for mode, workers in (('inline', 0), ('pooled', args.workers)):
+        password_pool.configure(workers, args.max_pending, use_tpool=True)
+        results[mode] = run_storm(app, socketio, room_id, token, args.logins, args.concurrency, args.interval)
+
+    print(f"{'mode':<8} {'probes':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'logins/s':>9}")
+    for mode, result in results.items():
+        print(f"{mode:<8} {result['count']:>7} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f} {result['max_ms']:>9.1f} {result['logins'] / result['login_seconds']:>9.1f}")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Serializer benchmark: JSON text packets vs MessagePack packets.
+
+Encodes and decodes representative Socket.IO payloads with the server's
+packet class (app.serializer.NegotiatedPacket), once as the default JSON
+text protocol and once as MessagePack with compact cursors, and reports
+bytes on the wire and microseconds per encode and decode for each.
+
+    python benchmarks/serialization.py --json serialization.json
+
+Needs `pip install msgpack`.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common import git_revision
+from app import serializer
+from app.serializer import NegotiatedPacket
+from socketio import packet
+
+
+def cursor(user_id, line):
+    return {'userId': user_id, 'username': f'user{user_id}', 'position': {'line': line, 'column': line % 80}}
+
+
+def sample_document(lines):
+    return ''.join(f'    result_{i} = compute(values[{i}], offset={i * 3})  # step {i}\n' for i in range(lines))
+
+
+def payloads():
+    """(name, event, data) for the traffic a room generates"""
+    users = [{'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com'} for i in range(1, 21)]
+    return [
+        ('cursor-batch x5', 'cursor-batch', {'cursors': [cursor(i, 40 + i) for i in range(1, 6)]}),
+        ('cursor-batch x30', 'cursor-batch', {'cursors': [cursor(i, 100 + i) for i in range(1, 31)]}),
+        ('cursor-update', 'cursor-update', cursor(7, 1234)),
+        ('code-op keystroke', 'code-op', {
+            'ops': [{'type': 'insert', 'position': 18342, 'text': 'x'}], 'revision': 4711, 'userId': '3'
+        }),
+        ('code-op paste 20 KB', 'code-op', {
+            'ops': [{'type': 'insert', 'position': 120, 'text': sample_document(300)}], 'revision': 4712, 'userId': '3'
+        }),
+        ('chat-message', 'chat-message', {
+            'seq': 812, 'userId': 4, 'username': 'user4', 'message': 'does the retry loop need a backoff?',
+            'timestamp': '2026-01-01T12:00:00.000000'
+        }),
+        ('sync-code 200 KB', 'sync-code', {
+            'code': sample_document(3000), 'revision': 9000, 'language': 'python', 'videoEnabled': 0,
+            'users': users, 'chat': []
+        }),
+    ]
+
+
+def per_call_us(function, min_time=0.2):
+    """Microseconds per call, timed over enough calls to take at least `min_time` seconds"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+def measure(event, data):
+    def make_packet():
+        return NegotiatedPacket(packet.EVENT, data=[event, data], namespace='/')
+
+    json_text = make_packet().encode()
+    msgpack_bytes = make_packet().encode_msgpack()
+    assert NegotiatedPacket(encoded_packet=msgpack_bytes).data[0] == event
+
+    return {
+        'json_bytes': len(json_text.encode('utf-8')),
+        'msgpack_bytes': len(msgpack_bytes),
+        'json_encode_us': per_call_us(lambda: make_packet().encode()),
+        'msgpack_encode_us': per_call_us(lambda: make_packet().encode_msgpack()),
+        'json_decode_us': per_call_us(lambda: NegotiatedPacket(encoded_packet=json_text)),
+        'msgpack_decode_us': per_call_us(lambda: NegotiatedPacket(encoded_packet=msgpack_bytes)),
+    }
+
+
+def print_report(results):
+    print(f"{'payload':<22} {'JSON B':>9} {'msgpack B':>10} {'size':>6} "
+          f"{'enc JSON':>9} {'enc mp':>8} {'dec JSON':>9} {'dec mp':>8}  (us)")
+    for name, r in results.items():
+        print(f"{name:<22} {r['json_bytes']:>9} {r['msgpack_bytes']:>10} "
+              f"{r['msgpack_bytes'] / r['json_bytes']:>6.0%} "
+              f"{r['json_encode_us']:>9.1f} {r['msgpack_encode_us']:>8.1f} "
+              f"{r['json_decode_us']:>9.1f} {r['msgpack_decode_us']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    if serializer.msgpack is None:
+        sys.exit('msgpack is not installed: pip install msgpack')
+
+    results = {name: measure(event, data) for name, event, data in payloads()}
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_revision(), 'payloads': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
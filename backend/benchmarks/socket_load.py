@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+"""
+Socket.IO load benchmark: what one backend process sustains.
+
+Starts the backend (create_app() or working_server.app) in a child process
+on a local port, then drives simulated clients over real WebSocket
+connections through connect -> join -> code-op / cursor-position /
+chat-message traffic -> leave, at the rates given in a scenario file:
+
+    {
+        "rooms": 20,              rooms with traffic
+        "room_size": 5,           clients per room
+        "typists_per_room": 1,    clients per room sending code-op inserts
+        "typing_rate": 5,         code-ops per second per typist
+        "cursor_rate": 10,        cursor moves per second per client
+        "chat_rate": 0.1,         chat messages per second per client
+        "connect_rate": 200,      new connections per second during ramp-up
+        "duration": 30            seconds of traffic
+    }
+
+Every event carries an ID whose send time the harness remembers, so each
+delivered broadcast gives an end-to-end latency. The report has events/sec
+sent and delivered, p50/p95/p99 latency per event, server RSS per
+connection and server/harness CPU (from /proc, so Linux only). When the
+harness CPU is near 100% it is the bottleneck, not the server.
+
+    python benchmarks/socket_load.py --scenario classroom --target all --json run.json
+"""
+import os
+# eventlet's green resolver rejects the getaddrinfo(type=...) call simple_websocket makes
+os.environ.setdefault('EVENTLET_NO_GREENDNS', 'yes')
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import collections
+import json
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BACKEND_DIR)
+warnings.filterwarnings('ignore')
+
+from eventlet import wsgi
+from eventlet.event import Event
+
+from common import git_revision, summarize
+
+TARGETS = ('create_app', 'working_server')
+SCENARIO_DEFAULTS = {
+    'rooms': 10,
+    'room_size': 4,
+    'typists_per_room': 1,
+    'typing_rate': 5.0,
+    'cursor_rate': 10.0,
+    'chat_rate': 0.1,
+    'connect_rate': 200.0,
+    'duration': 20.0,
+}
+
+
+def quiet_closed_sockets(args):
+    """Ignore the EOFError simple_websocket's reader thread raises when its socket is closed"""
+    if not issubclass(args.exc_type, EOFError):
+        sys.__excepthook__(args.exc_type, args.exc_value, args.exc_traceback)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def load_scenario(name):
+    """Read a scenario by path or by name from benchmarks/scenarios"""
+    path = name if os.path.isfile(name) else os.path.join(BENCHMARKS_DIR, 'scenarios', f'{name}.json')
+    with open(path) as f:
+        scenario = dict(SCENARIO_DEFAULTS, **json.load(f))
+    scenario['name'] = scenario.get('name', os.path.splitext(os.path.basename(path))[0])
+    return scenario
+
+
+# Server side ---------------------------------------------------------------
+
+def serve(args):
+    """Child process: seed users and rooms, write the ready file, then serve forever"""
+    raise_fd_limit()
+    os.chdir(args.workdir)
+    db_path = os.path.join(args.workdir, 'codecollab.db')
+    os.environ['CODECOLLAB_DB'] = db_path
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-jwt-secret-key-of-sufficient-length')
+
+    if args.target == 'create_app':
+        from flask_jwt_extended import create_access_token
+        from app import create_app
+        from app.db import init_db
+        app = create_app()
+        with app.app_context():
+            init_db()
+    else:
+        import working_server
+        app = working_server.app
+
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+        [(f'bench{i}', f'bench{i}@example.com', 'x') for i in range(args.users)]
+    )
+    conn.executemany(
+        'INSERT INTO rooms (name, owner_id) VALUES (?, ?)',
+        [(f'bench-room-{i}', 1) for i in range(args.rooms)]
+    )
+    conn.commit()
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    room_ids = [row[0] for row in conn.execute('SELECT id FROM rooms ORDER BY id')]
+    conn.close()
+
+    tokens = []
+    if args.target == 'create_app':
+        with app.app_context():
+            tokens = [create_access_token(identity=str(user_id)) for user_id in user_ids]
+
+    listener = eventlet.listen(('127.0.0.1', args.port), backlog=4096)
+    with open(args.ready_file + '.tmp', 'w') as f:
+        json.dump({'rooms': room_ids, 'tokens': tokens}, f)
+    os.rename(args.ready_file + '.tmp', args.ready_file)
+
+    wsgi.server(listener, app, log_output=False, max_size=args.users * 2 + 100)
+
+
+def start_server(target, scenario, workdir):
+    """Launch the server process and wait until it is listening"""
+    with eventlet.listen(('127.0.0.1', 0)) as probe:
+        port = probe.getsockname()[1]
+    ready_file = os.path.join(workdir, 'ready.json')
+    clients = scenario['rooms'] * scenario['room_size']
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+
+    process = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), 'serve',
+        '--target', target, '--port', str(port), '--workdir', workdir,
+        '--users', str(clients), '--rooms', str(scenario['rooms']), '--ready-file', ready_file
+    ], stdout=log, stderr=subprocess.STDOUT, env=dict(
+        os.environ,
+        CURSOR_BATCH_RATE=os.environ.get('CURSOR_BATCH_RATE', '20'),
+        # Every simulated client connects from 127.0.0.1
+        ADMISSION_IP_RATE=os.environ.get('ADMISSION_IP_RATE', '0')
+    ))
+
+    deadline = time.monotonic() + 60
+    while not os.path.exists(ready_file):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError(f'Server failed to start, see {log.name}')
+        eventlet.sleep(0.05)
+    with open(ready_file) as f:
+        seed = json.load(f)
+    return process, port, seed
+
+
+def process_rss(pid):
+    """Resident memory of a process in bytes"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_cpu_seconds(pid):
+    """User plus system CPU time of a process"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except OSError:
+        return None
+
+
+# Client side ---------------------------------------------------------------
+
+class Recorder:
+    """Send times of in-flight events and the latencies of their deliveries"""
+
+    def __init__(self):
+        self.sent_at = {}
+        self.sent = collections.Counter()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.seq = 0
+
+    def new_id(self, event):
+        self.seq += 1
+        event_id = f'{self.seq:x}'
+        self.sent_at[event_id] = time.perf_counter()
+        self.sent[event] += 1
+        return event_id
+
+    def delivered(self, event, event_id, received_at):
+        sent_at = self.sent_at.get(event_id)
+        if sent_at is not None:
+            self.latencies[event].append(received_at - sent_at)
+
+
+class BenchClient:
+    """A Socket.IO client speaking Engine.IO v4 over a raw WebSocket"""
+
+    MAX_CONNECT_ATTEMPTS = 5
+
+    def __init__(self, port, token, room_id, typist, recorder):
+        from simple_websocket import Client
+        self.url = f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket'
+        if token:
+            self.url += f'&token={token}'
+        self.client_class = Client
+        self.room_id = room_id
+        self.typist = typist
+        self.recorder = recorder
+        self.revision = 0
+        self.pending_acks = collections.deque()
+        self.send_lock = threading.Lock()
+        self.connected = Event()
+        self.joined = Event()
+        self.ws = None
+        self.closed = False
+        self.retry_after = None
+
+    def send(self, packet):
+        with self.send_lock:
+            self.ws.send(packet)
+
+    def emit(self, event, data):
+        self.send('42' + json.dumps([event, data], separators=(',', ':')))
+
+    def open(self):
+        """Connect and join; returns (connect seconds, join seconds)"""
+        started = time.perf_counter()
+        for _ in range(self.MAX_CONNECT_ATTEMPTS):
+            self.connected, self.closed, self.retry_after = Event(), False, None
+            self.ws = self.client_class.connect(self.url)
+            # Don't block on the Engine.IO open packet: simple_websocket may hold a frame that
+            # arrived with the handshake until the next read, and the server accepts 40 right away
+            self.send('40')
+            eventlet.spawn(self.receive_loop, self.ws, self.connected)
+            if self.connected.wait():
+                break
+            self.ws.close()
+            # Admission control turned us away; come back when it says, as real clients do
+            if self.retry_after is None:
+                raise ConnectionError('Socket.IO connection refused')
+            eventlet.sleep(self.retry_after)
+        else:
+            raise ConnectionError('Socket.IO connection refused')
+        connected = time.perf_counter()
+        self.emit('join', {'roomId': self.room_id})
+        self.joined.wait()
+        return connected - started, time.perf_counter() - connected
+
+    def receive_loop(self, ws, connected):
+        while True:
+            try:
+                packet = ws.receive()
+            except Exception:
+                break
+            if packet is None:
+                break
+            received_at = time.perf_counter()
+            if packet == '2':
+                self.send('3')
+            elif packet.startswith('40'):
+                connected.send(True)
+            elif packet.startswith('44'):
+                self.retry_after = (json.loads(packet[2:]).get('data') or {}).get('retryAfter')
+                connected.send(False)
+            elif packet.startswith('42'):
+                event, *args = json.loads(packet[2:])
+                self.on_event(event, args[0] if args else None, received_at)
+        if ws is self.ws:
+            self.closed = True
+        if not connected.ready():
+            connected.send(False)
+
+    def on_event(self, event, data, received_at):
+        recorder = self.recorder
+        if event in ('sync-code', 'joined'):
+            self.revision = max(self.revision, (data or {}).get('revision', 0))
+            if not self.joined.ready():
+                self.joined.send(True)
+        elif event == 'code-op':
+            self.revision = max(self.revision, data['revision'])
+            for op in data['ops']:
+                if op.get('type') == 'insert':
+                    recorder.delivered('code-op', op['text'][1:-1], received_at)
+        elif event == 'code-ack':
+            self.revision = max(self.revision, data['revision'])
+            if self.pending_acks:
+                recorder.delivered('code-ack', self.pending_acks.popleft(), received_at)
+        elif event == 'code-resync':
+            self.revision = data['revision']
+            self.pending_acks.clear()
+            recorder.errors['code-resync'] += 1
+        elif event == 'cursor-batch':
+            for cursor in data['cursors']:
+                recorder.delivered('cursor-position', cursor['position'].get('id'), received_at)
+        elif event == 'cursor-update':
+            recorder.delivered('cursor-position', data['position'].get('id'), received_at)
+        elif event == 'chat-message':
+            recorder.delivered('chat-message', data['message'].rsplit(' ', 1)[-1], received_at)
+        elif event == 'error':
+            recorder.errors[(data or {}).get('message', 'error')] += 1
+
+    def run_traffic(self, scenario, until):
+        """Send events at the scenario's rates until the deadline"""
+        rates = {
+            'code-op': scenario['typing_rate'] if self.typist else 0,
+            'cursor-position': scenario['cursor_rate'],
+            'chat-message': scenario['chat_rate'],
+        }
+        now = time.perf_counter()
+        # Random phase so clients do not fire in lockstep
+        due = {event: now + random.uniform(0, 1.0 / rate) for event, rate in rates.items() if rate > 0}
+        line = 0
+
+        while due and not self.closed:
+            event = min(due, key=due.get)
+            if due[event] >= until:
+                break
+            eventlet.sleep(max(0.0, due[event] - time.perf_counter()))
+            due[event] += 1.0 / rates[event]
+            event_id = self.recorder.new_id(event)
+
+            if event == 'code-op':
+                self.pending_acks.append(event_id)
+                self.emit('code-op', {
+                    'roomId': self.room_id,
+                    'revision': self.revision,
+                    'ops': [{'type': 'insert', 'position': 0, 'text': f'[{event_id}]'}]
+                })
+            elif event == 'cursor-position':
+                line += 1
+                self.emit('cursor-position', {
+                    'roomId': self.room_id,
+                    'position': {'line': line, 'column': 0, 'id': event_id}
+                })
+            else:
+                self.emit('chat-message', {'roomId': self.room_id, 'message': f'benchmark message {event_id}'})
+
+    def close(self):
+        try:
+            self.emit('leave', {'roomId': self.room_id})
+            self.send('41')
+            self.ws.close()
+        except Exception:
+            pass
+
+
+def run_target(target, scenario):
+    """Benchmark one server target with a scenario and return the report"""
+    workdir = tempfile.mkdtemp(prefix=f'codecollab-load-{target}-')
+    process, port, seed = start_server(target, scenario, workdir)
+    recorder = Recorder()
+    clients = []
+
+    try:
+        eventlet.sleep(1.0)
+        rss_idle = process_rss(process.pid)
+
+        # Ramp up: connect and join at connect_rate
+        for i in range(scenario['rooms'] * scenario['room_size']):
+            room_index, seat = divmod(i, scenario['room_size'])
+            token = seed['tokens'][i] if seed['tokens'] else None
+            clients.append(BenchClient(
+                port, token, seed['rooms'][room_index], seat < scenario['typists_per_room'], recorder
+            ))
+
+        connect_times, join_times, failures = [], [], 0
+        ramp_started = time.perf_counter()
+        pool = eventlet.GreenPool(len(clients))
+
+        def open_client(index):
+            nonlocal failures
+            eventlet.sleep(max(0.0, ramp_started + index / scenario['connect_rate'] - time.perf_counter()))
+            try:
+                connect_seconds, join_seconds = clients[index].open()
+            except Exception:
+                failures += 1
+                clients[index].closed = True
+                return
+            connect_times.append(connect_seconds)
+            join_times.append(join_seconds)
+
+        for index in range(len(clients)):
+            pool.spawn(open_client, index)
+        pool.waitall()
+        live = [client for client in clients if not client.closed]
+
+        eventlet.sleep(1.0)
+        rss_connected = process_rss(process.pid)
+
+        # Traffic
+        cpu_before = process_cpu_seconds(process.pid)
+        own_cpu_before = sum(os.times()[:2])
+        started = time.perf_counter()
+        until = started + scenario['duration']
+        for client in live:
+            pool.spawn(client.run_traffic, scenario, until)
+        pool.waitall()
+        # Let in-flight broadcasts and the last cursor batch arrive
+        eventlet.sleep(0.5)
+        elapsed = time.perf_counter() - started
+        cpu_after = process_cpu_seconds(process.pid)
+        own_cpu = sum(os.times()[:2]) - own_cpu_before
+
+        for client in clients:
+            if not client.closed:
+                client.close()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    sent = sum(recorder.sent.values())
+    delivered = sum(len(samples) for samples in recorder.latencies.values())
+    # Acks answer code-ops, so they count against the code-ops sent
+    recorder.sent['code-ack'] = recorder.sent['code-op']
+    events = {}
+    for event in sorted(set(recorder.sent) | set(recorder.latencies)):
+        events[event] = dict(summarize(recorder.latencies.get(event, [])), sent=recorder.sent.get(event, 0))
+        events[event]['delivered'] = events[event].pop('count')
+
+    per_connection = None
+    if rss_idle and rss_connected and live:
+        per_connection = (rss_connected - rss_idle) / len(live) / 1024
+
+    return {
+        'target': target,
+        'clients': len(clients),
+        'connected': len(live),
+        'connect_failures': failures,
+        'connect': summarize(connect_times),
+        'join': summarize(join_times),
+        'duration_s': elapsed,
+        'sent_per_s': sent / elapsed,
+        'delivered_per_s': delivered / elapsed,
+        'events': events,
+        'errors': dict(recorder.errors),
+        'server': {
+            'rss_idle_mb': rss_idle / 2 ** 20 if rss_idle else None,
+            'rss_connected_mb': rss_connected / 2 ** 20 if rss_connected else None,
+            'memory_per_connection_kb': per_connection,
+            'cpu_percent': (cpu_after - cpu_before) / elapsed * 100 if cpu_before is not None else None,
+        },
+        'harness_cpu_percent': own_cpu / elapsed * 100,
+    }
+
+
+def print_report(result):
+    server = result['server']
+    print(f"\n{result['target']}: {result['connected']}/{result['clients']} clients connected, "
+          f"{result['sent_per_s']:.0f} events/s sent, {result['delivered_per_s']:.0f} deliveries/s")
+    print(f"  connect p50 {result['connect']['p50_ms']:.1f} ms p99 {result['connect']['p99_ms']:.1f} ms, "
+          f"join p50 {result['join']['p50_ms']:.1f} ms p99 {result['join']['p99_ms']:.1f} ms")
+    if server['memory_per_connection_kb'] is not None:
+        print(f"  server RSS {server['rss_idle_mb']:.1f} -> {server['rss_connected_mb']:.1f} MB "
+              f"({server['memory_per_connection_kb']:.1f} KB per connection), "
+              f"server CPU {server['cpu_percent']:.0f}%, harness CPU {result['harness_cpu_percent']:.0f}%")
+    print(f"  {'event':<16} {'sent':>8} {'delivered':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for event, stats in result['events'].items():
+        print(f"  {event:<16} {stats['sent']:>8} {stats['delivered']:>10} {stats['p50_ms']:>9.1f} "
+              f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+    if result['errors']:
+        print(f"  errors: {result['errors']}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        parser = argparse.ArgumentParser()
+        parser.add_argument('command')
+        parser.add_argument('--target', choices=TARGETS, required=True)
+        parser.add_argument('--port', type=int, required=True)
+        parser.add_argument('--workdir', required=True)
+        parser.add_argument('--users', type=int, required=True)
+        parser.add_argument('--rooms', type=int, required=True)
+        parser.add_argument('--ready-file', required=True)
+        serve(parser.parse_args())
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', default='smoke', help='scenario name in benchmarks/scenarios or a JSON file path')
+    parser.add_argument('--target', choices=TARGETS + ('all',), default='create_app')
+    parser.add_argument('--duration', type=float, help='override the scenario duration in seconds')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    threading.excepthook = quiet_closed_sockets
+    scenario = load_scenario(args.scenario)
+    if args.duration:
+        scenario['duration'] = args.duration
+
+    results = {'commit': git_revision(), 'scenario': scenario, 'targets': {}}
+    for target in (TARGETS if args.target == 'all' else (args.target,)):
+        results['targets'][target] = run_target(target, scenario)
+        print_report(results['targets'][target])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from app import db
+from app.db import ConnectionPool
+from app.migrations import migrate
+from app.repository import PostgresBackend, Repository, SQLiteBackend
+
+
+@pytest.fixture
+def sqlite_pool(tmp_path, monkeypatch):
+    """A migrated SQLite file, installed as the process-wide pool"""
+    pool = ConnectionPool(str(tmp_path / 'codecollab.db'))
+    monkeypatch.setattr(db, 'pool', pool)
+    conn = pool.acquire(write=True)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    return pool
+
+
+def postgres_dsn():
+    return os.environ.get('TEST_DATABASE_URL') or os.environ.get('POSTGRES_DSN')
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def repository(request, sqlite_pool):
+    """The same repository on each backend; PostgreSQL needs TEST_DATABASE_URL (or POSTGRES_DSN)"""
+    if request.param == 'sqlite':
+        yield Repository(SQLiteBackend())
+        return
+
+    dsn = postgres_dsn()
+    if not dsn:
+        pytest.skip('Set TEST_DATABASE_URL to a scratch PostgreSQL database to run the PostgreSQL backend')
+    backend = PostgresBackend(dsn, size=2)
+    backend.init_schema()
+    backend.write(lambda s: s.run('TRUNCATE room_members, rooms, users RESTART IDENTITY CASCADE'))
+    yield Repository(backend)
+    while not backend.idle.empty():
+        backend.idle.get_nowait().raw.close()
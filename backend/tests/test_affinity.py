@@ -0,0 +1,89 @@
+import pytest
+
+from app.rooms.affinity import HashRing, RoomAffinity
+from app.rooms.registry import MemoryRegistry, SQLiteRegistry
+
+A, B = 'http://a', 'http://b'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def registry(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryRegistry()
+    return SQLiteRegistry(str(tmp_path / 'registry.db'))
+
+
+def worker(registry, url, handed_over):
+    """A worker whose rebalance hands moved rooms over the way release_moved_rooms does"""
+    affinity = RoomAffinity(url, ttl=15, replicas=16, worker=url)
+
+    def release_moved_rooms():
+        for room_id in sorted(affinity.leases):
+            if affinity.elsewhere(room_id):
+                handed_over.append((url, room_id, affinity.holds(room_id)))
+                if affinity.holds(room_id):
+                    affinity.release(room_id)
+        return 0
+
+    affinity.attach(registry, release_moved_rooms)
+    return affinity
+
+
+def room_moving_to_b():
+    ring = HashRing([A, B], 16)
+    return next(str(room_id) for room_id in range(100) if ring.owner(room_id) == B)
+
+
+def test_new_owner_waits_for_the_old_owner_to_hand_over(registry):
+    handed_over = []
+    room_id = room_moving_to_b()
+    a = worker(registry, A, handed_over)
+    a.refresh(now=100)
+    assert a.elsewhere(room_id, now=100) is None
+
+    # B joins and sees the new ring first; A still thinks it owns the room
+    b = worker(registry, B, handed_over)
+    b.refresh(now=101)
+    assert b.elsewhere(room_id, now=101) == (A, A)
+    assert a.elsewhere(room_id, now=101) is None
+    assert b.stats()['handoff_waits'] == 1
+
+    # A's heartbeat: it stores the room and lets go, then B takes it
+    a.refresh(now=102)
+    assert handed_over == [(A, room_id, True)]
+    assert a.elsewhere(room_id, now=102) == (B, B)
+    assert b.elsewhere(room_id, now=102) is None
+    assert registry.room_holder(room_id) == B
+
+
+def test_old_owner_that_lost_its_lease_does_not_store(registry):
+    handed_over = []
+    room_id = room_moving_to_b()
+    a = worker(registry, A, handed_over)
+    a.refresh(now=100)
+    assert a.elsewhere(room_id, now=100) is None
+
+    # A stops heartbeating long enough for B to take the room over
+    b = worker(registry, B, handed_over)
+    b.refresh(now=200)
+    assert b.elsewhere(room_id, now=200) is None
+
+    a.refresh(now=201)
+    assert a.stats()['leases_lost'] == 1
+    assert room_id not in a.leases
+    assert handed_over == []
+    assert a.elsewhere(room_id, now=201) == (B, B)
+    assert registry.room_holder(room_id) == B
+
+
+def test_retire_releases_leases(registry):
+    handed_over = []
+    room_id = room_moving_to_b()
+    a = worker(registry, A, handed_over)
+    b = worker(registry, B, handed_over)
+    a.refresh(now=100)
+    a.elsewhere(room_id, now=100)
+
+    a.retire()
+    b.refresh(now=101)
+    assert b.elsewhere(room_id, now=101) is None
@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+from app.migrations import (
+    HOT_QUERIES, MIGRATIONS, QueryPlanRegression, check_query_plans, current_version, migrate, table_scans
+)
+from app.repository import Repository
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, sql, params):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+
+def hot_query(name):
+    return next((sql, params) for query, sql, params in HOT_QUERIES if query == name)
+
+
+class RecordingBackend:
+    """Captures the SQL the repository would run instead of running it"""
+
+    def __init__(self):
+        self.statements = []
+
+    def all(self, sql, params=()):
+        self.statements.append((sql, params))
+        return []
+
+    def read(self, fn):
+        return fn(self)
+
+
+def test_migrate_is_idempotent():
+    conn = sqlite3.connect(':memory:')
+    assert migrate(conn) == [number for number, _, _ in MIGRATIONS]
+    assert migrate(conn) == []
+    assert current_version(conn) == MIGRATIONS[-1][0]
+
+
+def test_hot_queries_use_an_index_search(conn):
+    assert table_scans(conn) == []
+    check_query_plans(conn)
+
+
+@pytest.mark.parametrize('name, index', [
+    ('room listing page', 'idx_rooms_created'),
+    ('room listing by language', 'idx_rooms_language_created'),
+    ('room listing by owner', 'idx_rooms_owner_created'),
+    ('member room listing', 'idx_room_members_user'),
+    ('room by id', 'INTEGER PRIMARY KEY'),
+    ('room by name', 'sqlite_autoindex_rooms_1'),
+    ('membership check', 'sqlite_autoindex_room_members_1'),
+    ('room roster', 'sqlite_autoindex_room_members_1'),
+])
+def test_hot_query_uses_index(conn, name, index):
+    plan = query_plan(conn, *hot_query(name))
+    assert plan[0].startswith('SEARCH'), plan
+    assert index in plan[0], plan
+
+
+@pytest.mark.parametrize('filters, index', [
+    ({'after': ('2030-01-01', 1)}, 'idx_rooms_created'),
+    ({'language': 'python'}, 'idx_rooms_language_created'),
+    ({'owner_id': 1}, 'idx_rooms_owner_created'),
+    ({'member_id': 1}, 'idx_room_members_user'),
+])
+def test_repository_room_listing_uses_index(conn, filters, index):
+    backend = RecordingBackend()
+    Repository(backend).list_rooms(('id', 'name', 'created_at'), 51, **filters)
+    [(sql, params)] = backend.statements
+
+    plan = query_plan(conn, sql, params)
+    assert not any(step.startswith('SCAN') for step in plan), plan
+    assert index in plan[0], plan
+
+
+def test_missing_listing_indexes_are_reported(conn):
+    for statement in MIGRATIONS[1][2]:
+        conn.execute('DROP INDEX ' + statement.split()[5])
+
+    scans = {name for name, _ in table_scans(conn)}
+    assert {'room listing page', 'room listing by language', 'room listing by owner', 'member room listing'} <= scans
+    with pytest.raises(QueryPlanRegression):
+        check_query_plans(conn)
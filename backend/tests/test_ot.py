@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from app.rooms.ot import Document, DocumentTooLarge, RevisionError, apply_operation, delete, insert, transform
+
+
+def test_replace_records_a_delta():
+    document = Document('abc')
+    ops, revision = document.replace('abd')
+    assert revision == 1
+    assert document.text == 'abd'
+    assert document.operations_since(0) == [ops]
+
+
+def test_replace_with_same_text_is_a_no_op():
+    document = Document('abc', revision=4)
+    assert document.replace('abc') == ([], 4)
+    assert document.revision == 4
+    assert len(document.history) == 0
+
+
+def converge(text, a, b):
+    """Apply a and b in both orders and return the two results"""
+    a_prime, b_prime = transform(a, b)
+    return apply_operation(apply_operation(text, b), a_prime), apply_operation(apply_operation(text, a), b_prime)
+
+
+@pytest.mark.parametrize('a, b, expected', [
+    ([insert(1, 'X')], [insert(4, 'Y')], 'aXbcdYef'),
+    ([insert(3, 'X')], [insert(3, 'Y')], 'abcYXdef'),
+    ([insert(3, 'X')], [delete(1, 4)], 'aXf'),
+    ([insert(1, 'X')], [delete(1, 2)], 'aXdef'),
+    ([insert(5, 'X')], [delete(1, 2)], 'adeXf'),
+    ([delete(1, 2)], [delete(1, 2)], 'adef'),
+    ([delete(1, 3)], [delete(2, 3)], 'af'),
+    ([delete(2, 1)], [delete(0, 5)], 'f'),
+    ([delete(0, 2), insert(0, 'Z')], [insert(1, 'X'), delete(4, 1)], 'XZcef'),
+])
+def test_transform_converges(a, b, expected):
+    assert converge('abcdef', a, b) == (expected, expected)
+
+
+def test_transform_tie_break_follows_wins():
+    a_prime, _ = transform([insert(3, 'X')], [insert(3, 'Y')], wins=True)
+    assert apply_operation('abcYdef', a_prime) == 'abcXYdef'
+
+
+def random_operation(rng, length):
+    ops = []
+    for _ in range(rng.randint(1, 3)):
+        if length and rng.random() < 0.5:
+            position = rng.randrange(length)
+            count = rng.randint(1, length - position)
+            ops.append(delete(position, count))
+            length -= count
+        else:
+            text = ''.join(rng.choice('xyz') for _ in range(rng.randint(1, 3)))
+            ops.append(insert(rng.randint(0, length), text))
+            length += len(text)
+    return ops
+
+
+def test_transform_satisfies_tp1_on_random_operations():
+    rng = random.Random(20240601)
+    for _ in range(2000):
+        text = ''.join(rng.choice('abcdefgh') for _ in range(rng.randint(0, 12)))
+        a, b = random_operation(rng, len(text)), random_operation(rng, len(text))
+        left, right = converge(text, a, b)
+        assert left == right, (text, a, b)
+
+
+def test_apply_rebases_over_operations_since_base():
+    document = Document('hello')
+    document.apply([insert(5, ' world')], 0)
+    concurrent = document.operations_since(0)
+
+    ops, revision = document.apply([insert(0, '> ')], 0)
+    assert revision == 2
+    assert document.text == '> hello world'
+    assert concurrent == [[insert(5, ' world')]]
+    assert document.operations_since(1) == [ops]
+
+
+def test_apply_rejects_unknown_and_forgotten_revisions():
+    document = Document('abc', history_limit=2)
+    for _ in range(3):
+        document.apply([insert(0, 'x')], document.revision)
+
+    with pytest.raises(RevisionError):
+        document.apply([insert(0, 'y')], 4)
+    with pytest.raises(RevisionError):
+        document.apply([insert(0, 'y')], 0)
+    assert document.operations_since(0) is None
+
+    # Rebased over the two inserts it did not see, losing the tie at position 0
+    ops, revision = document.apply([insert(0, 'y')], 1)
+    assert revision == 4
+    assert ops == [insert(2, 'y')]
+    assert document.text == 'xxyxabc'
+
+
+def test_apply_and_replace_enforce_max_length():
+    document = Document('abc', max_length=5)
+
+    with pytest.raises(DocumentTooLarge):
+        document.apply([insert(3, 'def')], 0)
+    with pytest.raises(DocumentTooLarge):
+        document.replace('abcdef')
+    assert (document.text, document.revision) == ('abc', 0)
+
+    document.apply([delete(0, 1), insert(2, 'def')], 0)
+    assert document.text == 'bcdef'
@@ -0,0 +1,78 @@
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+from app.outbox import OutboundQueues, event_name, event_packet, event_payload
+
+
+class FakeEngineIO:
+    """Just enough of engineio.Server for the outbox: per-socket queues and send_packet"""
+
+    def __init__(self, backlog):
+        self.sockets = {'eio': SimpleNamespace(queue=queue.Queue())}
+        for _ in range(backlog):
+            self.sockets['eio'].queue.put(None)
+        self.sent = []
+
+    def send_packet(self, eio_sid, pkt):
+        self.sent.append(pkt)
+
+
+@pytest.fixture
+def eio():
+    return FakeEngineIO(backlog=4)
+
+
+@pytest.fixture
+def outbox(eio):
+    queues = OutboundQueues(high_water=4, max_frames=6)
+    queues.install(SimpleNamespace(eio=eio))
+    return queues
+
+
+def sent(eio):
+    return [(event_name(pkt), event_payload(pkt)) for pkt in eio.sent]
+
+
+def drain_all(eio, outbox):
+    while outbox.boxes:
+        eio.sockets['eio'].queue = queue.Queue()
+        outbox.drain()
+
+
+def test_cursor_batches_merge_while_held(eio, outbox):
+    eio.send_packet('eio', event_packet('cursor-batch', {'roomId': '1', 'cursors': [{'userId': 1, 'line': 1}]}))
+    eio.send_packet('eio', event_packet('cursor-batch', {'roomId': '1', 'cursors': [{'userId': 1, 'line': 2}]}))
+    drain_all(eio, outbox)
+
+    assert sent(eio) == [('cursor-batch', {'roomId': '1', 'cursors': [{'userId': 1, 'line': 2}]})]
+
+
+def test_shedding_drops_document_frames_and_sends_one_resync(eio, outbox):
+    eio.send_packet('eio', event_packet('chat-message', {'roomId': '1', 'message': 'hi'}))
+    eio.send_packet('eio', event_packet('code-resync', {'roomId': '2', 'code': 'x', 'revision': 3}))
+    for revision in range(5, 11):
+        eio.send_packet('eio', event_packet('code-op', {'roomId': '1', 'ops': [], 'revision': revision}))
+    # Arrives after the shed but before the directive went out: covered by the resync
+    eio.send_packet('eio', event_packet('code-op', {'roomId': '1', 'ops': [], 'revision': 11}))
+    eio.send_packet('eio', event_packet('code-resync', {'roomId': '2', 'code': 'y', 'revision': 4}))
+    drain_all(eio, outbox)
+
+    assert sent(eio) == [
+        ('chat-message', {'roomId': '1', 'message': 'hi'}),
+        ('resync', {'reason': 'slow-consumer', 'rooms': [
+            {'roomId': '2', 'revision': None},
+            {'roomId': '1', 'revision': 4},
+        ]}),
+    ]
+    assert outbox.stats()['resyncs_sent'] == 1
+
+
+def test_document_frames_flow_again_after_the_resync(eio, outbox):
+    for revision in range(1, 8):
+        eio.send_packet('eio', event_packet('code-op', {'roomId': '1', 'ops': [], 'revision': revision}))
+    drain_all(eio, outbox)
+
+    eio.send_packet('eio', event_packet('code-op', {'roomId': '1', 'ops': [], 'revision': 8}))
+    assert [event for event, _ in sent(eio)] == ['resync', 'code-op']
@@ -0,0 +1,34 @@
+import pytest
+
+from app.repository import Repository, SQLiteBackend
+from app.rooms import persistence
+from app.rooms.persistence import WriteBehindBuffer
+
+
+@pytest.fixture
+def repository(sqlite_pool, monkeypatch):
+    repository = Repository(SQLiteBackend())
+    monkeypatch.setattr(persistence, 'repository', repository)
+    owner = repository.create_user('alice', 'alice@example.com', 'hash')
+    repository.create_room('pairing', owner, 'python')
+    return repository
+
+
+def test_flush_writes_dirty_rooms(repository):
+    buffer = WriteBehindBuffer(interval=60)
+    buffer.mark_dirty(1, 'x = 1', 2)
+
+    assert buffer.flush() == 1
+    assert not buffer.is_dirty(1)
+    assert repository.get_room(1)['code'] == 'x = 1'
+
+
+def test_stale_write_is_dropped_not_requeued(repository):
+    repository.save_documents([(1, 'newer', 9)])
+    buffer = WriteBehindBuffer(interval=60)
+    buffer.mark_dirty(1, 'older', 8)
+
+    assert buffer.flush() == 0
+    assert not buffer.is_dirty(1)
+    assert buffer.stats()['stale_writes'] == 1
+    assert repository.get_room(1)['code'] == 'newer'
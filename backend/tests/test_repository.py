@@ -0,0 +1,194 @@
+"""Repository contract: every backend must behave the same way.
+
+Each test runs against SQLite and, when TEST_DATABASE_URL is set, against
+PostgreSQL (see conftest.py).
+"""
+import pytest
+
+
+@pytest.fixture
+def alice(repository):
+    return repository.create_user('alice', 'alice@example.com', 'hash-a')
+
+
+@pytest.fixture
+def bob(repository):
+    return repository.create_user('bob', 'bob@example.com', 'hash-b')
+
+
+# Users
+
+def test_create_user_returns_id(repository, alice):
+    user = repository.get_user(alice)
+    assert user == {'id': alice, 'username': 'alice', 'email': 'alice@example.com'}
+
+
+def test_create_user_rejects_taken_username_or_email(repository, alice):
+    assert repository.create_user('alice', 'other@example.com', 'x') is None
+    assert repository.create_user('other', 'alice@example.com', 'x') is None
+
+
+def test_missing_user(repository):
+    assert repository.get_user(12345) is None
+    assert repository.get_profile(12345) is None
+    assert repository.find_user_by_username('nobody') is None
+
+
+def test_profile_and_login_lookup(repository, alice):
+    profile = repository.get_profile(alice)
+    assert profile['username'] == 'alice'
+    assert isinstance(profile['created_at'], str)
+
+    user = repository.find_user_by_username('alice')
+    assert user['id'] == alice
+    assert user['password_hash'] == 'hash-a'
+
+
+# Rooms
+
+def test_create_room(repository, alice):
+    room = repository.create_room('pairing', alice, 'python')
+    assert room['name'] == 'pairing'
+    assert room['owner_id'] == alice
+    assert room['language'] == 'python'
+    assert room['code'] == ''
+    assert room['video_enabled'] == 0
+    assert repository.room_exists(room['id'])
+    assert repository.room_owner(room['id']) == alice
+    assert repository.is_member(room['id'], alice)
+
+
+def test_create_room_rejects_taken_name(repository, alice, bob):
+    repository.create_room('pairing', alice, 'python')
+    assert repository.create_room('pairing', bob, 'javascript') is None
+
+
+def test_missing_room(repository):
+    assert not repository.room_exists(12345)
+    assert repository.get_room(12345) is None
+    assert repository.load_room(12345) is None
+    assert repository.room_owner(12345) is None
+    assert not repository.delete_room(12345)
+
+
+def test_load_room_with_members(repository, alice, bob):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+    repository.add_member(room_id, bob)
+
+    room, members = repository.load_room(room_id)
+    assert room['id'] == room_id
+    assert sorted(member['username'] for member in members) == ['alice', 'bob']
+
+
+def test_save_documents(repository, alice):
+    small = repository.create_room('small', alice, 'python')['id']
+    large = repository.create_room('large', alice, 'python')['id']
+    code = 'print("hello")\n' * 2000
+
+    repository.save_documents([(small, 'x = 1', 3), (large, code, None)])
+    assert repository.get_room(small)['code'] == 'x = 1'
+    assert repository.get_room(small)['revision'] == 3
+    assert repository.get_room(large)['code'] == code
+
+    # No revision keeps the stored one
+    repository.save_documents([(small, 'x = 2', None)])
+    assert repository.get_room(small)['code'] == 'x = 2'
+    assert repository.get_room(small)['revision'] == 3
+
+
+def test_save_documents_never_goes_back_a_revision(repository, alice):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+    other = repository.create_room('other', alice, 'python')['id']
+    repository.save_documents([(room_id, 'new', 5)])
+
+    # A late flush at an older revision is skipped and reported; the rest of the batch lands
+    assert repository.save_documents([(room_id, 'old', 4), (other, 'x', 1)]) == [room_id]
+    assert repository.get_room(room_id)['code'] == 'new'
+    assert repository.get_room(room_id)['revision'] == 5
+    assert repository.get_room(other)['code'] == 'x'
+
+    assert repository.save_documents([(room_id, 'same', 5), (room_id, 'newer', 6)]) == []
+    assert repository.get_room(room_id)['code'] == 'newer'
+    assert repository.save_documents([(12345, 'gone', 1)]) == [12345]
+
+
+def test_list_rooms_newest_first_with_keyset(repository, alice):
+    ids = [repository.create_room(f'room-{i}', alice, 'python')['id'] for i in range(5)]
+
+    first = repository.list_rooms(('id', 'created_at'), 2)
+    assert [room['id'] for room in first] == ids[:-3:-1]
+
+    after = (first[-1]['created_at'], first[-1]['id'])
+    rest = repository.list_rooms(('id', 'created_at'), 10, after=after)
+    assert [room['id'] for room in rest] == ids[-3::-1]
+
+
+def test_list_rooms_filters(repository, alice, bob):
+    mine = repository.create_room('mine', alice, 'python')['id']
+    theirs = repository.create_room('theirs', bob, 'javascript')['id']
+    shared = repository.create_room('shared', bob, 'python')['id']
+    repository.add_member(shared, alice)
+
+    def ids(**filters):
+        return {room['id'] for room in repository.list_rooms(('id',), 10, **filters)}
+
+    assert ids() == {mine, theirs, shared}
+    assert ids(member_id=alice) == {mine, shared}
+    assert ids(language='python') == {mine, shared}
+    assert ids(owner_id=bob) == {theirs, shared}
+    assert ids(member_id=alice, owner_id=bob, language='python') == {shared}
+
+
+def test_list_rooms_decodes_code(repository, alice):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+    code = 'def f():\n    return 1\n' * 1000
+    repository.save_documents([(room_id, code, 1)])
+    assert repository.list_rooms(('id', 'code'), 1)[0]['code'] == code
+
+
+def test_toggle_video_only_for_owner(repository, alice, bob):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+
+    assert repository.toggle_video(room_id, bob) is None
+    assert repository.toggle_video(room_id, alice) == {'id': room_id, 'name': 'pairing', 'video_enabled': 1}
+    assert repository.toggle_video(room_id, alice)['video_enabled'] == 0
+
+
+def test_set_chat_retention_only_for_owner(repository, alice, bob):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+
+    assert not repository.set_chat_retention(room_id, bob, 10)
+    assert repository.set_chat_retention(room_id, alice, 10)
+    assert repository.get_room(room_id)['chat_retention'] == 10
+
+
+def test_set_language(repository, alice):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+    repository.set_language(room_id, 'go')
+    assert repository.get_room(room_id)['language'] == 'go'
+
+
+def test_delete_room_removes_memberships(repository, alice, bob):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+    repository.add_member(room_id, bob)
+
+    assert repository.delete_room(room_id)
+    assert not repository.room_exists(room_id)
+    assert repository.list_members(room_id) == []
+    assert repository.list_rooms(('id',), 10, member_id=bob) == []
+
+
+# Memberships
+
+def test_memberships(repository, alice, bob):
+    room_id = repository.create_room('pairing', alice, 'python')['id']
+
+    assert not repository.is_member(room_id, bob)
+    assert repository.add_member(room_id, bob)
+    assert not repository.add_member(room_id, bob)
+    assert repository.is_member(room_id, bob)
+    assert {member['id'] for member in repository.list_members(room_id)} == {alice, bob}
+
+    assert repository.remove_member(room_id, bob)
+    assert not repository.remove_member(room_id, bob)
+    assert not repository.is_member(room_id, bob)
@@ -0,0 +1,40 @@
+import time
+
+from app.rooms.resume import ResumeTokens
+from app.rooms.sessions import SocketSession
+
+
+def session(auth_expires_at=None):
+    session = SocketSession('sid-1', 1, 'alice', 'alice@example.com', auth_expires_at)
+    session.rooms.add('7')
+    return session
+
+
+def test_parked_session_resumes_once():
+    tokens = ResumeTokens(ttl=60)
+    live = session(time.time() + 3600)
+    token = tokens.issue(live)
+    tokens.park(live)
+
+    user, rooms, stale_sid, auth_expires_at = tokens.redeem(token)
+    assert user['id'] == 1
+    assert rooms == {'7'}
+    assert stale_sid is None
+    assert auth_expires_at == live.auth_expires_at
+    assert tokens.redeem(token) is None
+
+
+def test_no_token_is_issued_after_the_jwt_expired():
+    tokens = ResumeTokens(ttl=60)
+    assert tokens.issue(session(time.time() - 1)) is None
+
+
+def test_token_is_refused_once_the_jwt_expired():
+    tokens = ResumeTokens(ttl=60)
+    live = session(time.time() + 0.05)
+    token = tokens.issue(live)
+    tokens.park(live)
+    time.sleep(0.1)
+
+    assert tokens.redeem(token) is None
+    assert tokens.stats()['tokens_expired'] == 1
@@ -3,11 +3,20 @@
 import os
 import sys
 import sqlite3
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_app_context
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
-import bcrypt
 from flask_jwt_extended import JWTManager, create_access_token
+from app.auth.utils import HashingPoolBusy, check_password, hash_password, password_pool
+from app import db as app_db
+from app.db import ConnectionPool
+from app.executor import db_executor
+from app.metrics import init_app as init_metrics, registry as metrics_registry
+from app.migrations import migrate
+from app.repository import create_backend, repository
+from app.rooms.ot import Document, OperationError, RevisionError, normalize_operation
+from app.rooms.persistence import WriteBehindBuffer
+from app.rooms.storage import text_codec
 
 # Complete working server with Socket.IO
 app = Flask(__name__)
@@ -19,32 +28,86 @@ CORS(app, origins=["http://localhost:5173"])
 
 # Initialize extensions
 jwt = JWTManager(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode='threading',
+    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+)
 
-def get_db():
-    db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'codecollab.db')
-    return sqlite3.connect(db_path)
+# In-memory documents for rooms being edited, keyed by room ID
+documents = {}
+
+# Long-lived WAL connections shared by every request and socket event
+pool = ConnectionPool(
+    os.environ.get('CODECOLLAB_DB', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'codecollab.db')),
+    size=int(os.environ.get('DB_POOL_SIZE', 4)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5.0))
+)
+# The write-behind flusher and the repository check connections out of the process-wide pool
+app_db.pool = pool
+
+def get_db(write=False):
+    # close() hands the connection back to the pool
+    conn = pool.acquire(write=write)
+    if has_app_context():
+        # Make sure it goes back even if the handler fails before close()
+        g.setdefault('db_checkouts', []).append((conn, conn.checkout))
+    return conn
+
+@app.teardown_appcontext
+def release_db(e=None):
+    for conn, checkout in g.pop('db_checkouts', []):
+        pool.release(conn, checkout)
+
+# bcrypt runs in native threads; under gunicorn's eventlet worker that means eventlet's tpool
+try:
+    from eventlet.patcher import is_monkey_patched
+    eventlet_patched = is_monkey_patched('thread')
+except ImportError:
+    eventlet_patched = False
+password_pool.configure(
+    int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+    int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32)),
+    use_tpool=eventlet_patched
+)
+db_executor.configure(use_tpool=eventlet_patched)
+repository.configure(create_backend(
+    os.environ.get('DATABASE_URL', ''),
+    pool.size,
+    pool.timeout
+))
+
+# Batches document writes instead of committing on every keystroke
+write_behind = WriteBehindBuffer(float(os.environ.get('WRITE_BEHIND_INTERVAL', 2.0)))
+write_behind.start(socketio)
+
+# Prometheus metrics on /api/metrics
+init_metrics(app, socketio)
+metrics_registry.gauges_from_stats('codecollab_db_pool', 'SQLite connection pool', pool.stats)
+metrics_registry.gauges_from_stats('codecollab_password_hashing', 'bcrypt worker pool', password_pool.stats)
+metrics_registry.gauges_from_stats('codecollab_write_behind', 'Batched document writes', write_behind.stats)
+metrics_registry.gauge('codecollab_documents', 'Room documents held in memory', lambda: len(documents))
 
 def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
+    # Same versioned schema as create_app(); safe to run on every start
+    conn = get_db(write=True)
+    applied = migrate(conn)
     conn.close()
+    repository.init_schema()
+    return applied
+
+# Gunicorn imports this module without running __main__, so migrate here
+init_db()
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return {'status': 'healthy', 'message': 'Working server is running!'}
+    return {
+        'status': 'healthy',
+        'message': 'Working server is running!',
+        'database': pool.stats(),
+        'persistence': write_behind.stats()
+    }
 
 @app.route('/api/auth/register', methods=['POST', 'OPTIONS'])
 def register():
@@ -61,10 +124,10 @@ def register():
         email = data['email'] 
         password = data['password']
         
-        # Hash password
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        # Hash password off the request greenlet
+        password_hash = hash_password(password)
         
-        conn = get_db()
+        conn = get_db(write=True)
         cursor = conn.cursor()
         
         # Check if user exists
@@ -89,6 +152,8 @@ def register():
             'access_token': access_token
         }), 201
         
+    except HashingPoolBusy:
+        return jsonify({'msg': 'Server is busy, please try again shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'msg': f'Error: {str(e)}'}), 500
 
@@ -113,7 +178,7 @@ def login():
         user = cursor.fetchone()
         conn.close()
         
-        if not user or not bcrypt.checkpw(password.encode('utf-8'), user[3].encode('utf-8')):
+        if not user or not check_password(password, user[3]):
             return jsonify({'msg': 'Invalid credentials'}), 401
         
         access_token = create_access_token(identity=str(user[0]))
@@ -124,6 +189,8 @@ def login():
             'access_token': access_token
         }), 200
         
+    except HashingPoolBusy:
+        return jsonify({'msg': 'Server is busy, please try again shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'msg': f'Error: {str(e)}'}), 500
 
@@ -150,23 +217,9 @@ def get_rooms():
         return '', 200
     
     try:
-        # Initialize rooms table if it doesn't exist
         conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS rooms (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                owner_id INTEGER NOT NULL,
-                language TEXT DEFAULT 'javascript',
-                code TEXT DEFAULT '',
-                video_enabled INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        
         cursor.execute("SELECT * FROM rooms")
         rooms = cursor.fetchall()
         conn.close()
@@ -179,7 +232,7 @@ def get_rooms():
                 'name': room[1], 
                 'owner_id': room[2],
                 'language': room[3],
-                'code': room[4],
+                'code': text_codec.decode(room[4]),
                 'video_enabled': room[5],
                 'created_at': room[6]
             })
@@ -200,7 +253,7 @@ def create_room():
         name = data['name']
         language = data.get('language', 'javascript')
         
-        conn = get_db()
+        conn = get_db(write=True)
         cursor = conn.cursor()
         
         # Check if room name exists
@@ -252,7 +305,7 @@ def get_room(room_id):
             'name': room[1],
             'owner_id': room[2], 
             'language': room[3],
-            'code': room[4],
+            'code': text_codec.decode(room[4]),
             'video_enabled': room[5],
             'created_at': room[6]
         }), 200
@@ -285,24 +338,72 @@ def handle_leave(data):
         leave_room(str(room_id))
         print(f'Client {request.sid} left room {room_id}')
 
+def get_document(room_id):
+    document = documents.get(str(room_id))
+    if document is None:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT code, revision FROM rooms WHERE id = ?", (room_id,))
+        row = cursor.fetchone()
+        conn.close()
+        # Carry on from the stored revision so clients' revisions stay valid across restarts
+        document = documents.setdefault(
+            str(room_id),
+            Document(text_codec.decode(row[0]), row[1] or 0) if row else Document()
+        )
+    return document
+
 @socketio.on('code-change')
 def handle_code_change(data):
     room_id = data.get('roomId')
     code = data.get('code', '')
     
+    if not isinstance(code, str):
+        emit('error', {'message': 'Invalid code: expected a string'})
+        return
+    
     if room_id:
-        # Update database
-        try:
-            conn = get_db()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE rooms SET code = ? WHERE id = ?", (code, room_id))
-            conn.commit()
-            conn.close()
-        except:
-            pass
+        # Send peers only the changed region
+        document = get_document(room_id)
+        ops, revision = document.replace(code)
+        if not ops:
+            return
+        write_behind.mark_dirty(room_id, document.text, document.revision)
         
         # Broadcast to room
-        emit('code-update', {'code': code}, room=str(room_id), include_self=False)
+        emit('code-op', {
+            'roomId': str(room_id),
+            'ops': ops,
+            'revision': revision
+        }, room=str(room_id), include_self=False)
+
+@socketio.on('code-op')
+def handle_code_op(data):
+    room_id = data.get('roomId')
+    revision = data.get('revision')
+    
+    if room_id and revision is not None:
+        document = get_document(room_id)
+        try:
+            ops, revision = document.apply(normalize_operation(data.get('ops')), revision)
+        except RevisionError:
+            emit('code-resync', {
+                'roomId': str(room_id),
+                'code': document.text,
+                'revision': document.revision
+            })
+            return
+        except OperationError as e:
+            emit('error', {'message': f'Invalid operation: {str(e)}'})
+            return
+        write_behind.mark_dirty(room_id, document.text, document.revision)
+        
+        emit('code-ack', {'revision': revision})
+        emit('code-op', {
+            'roomId': str(room_id),
+            'ops': ops,
+            'revision': revision
+        }, room=str(room_id), include_self=False)
 
 @socketio.on('language-change')
 def handle_language_change(data):
@@ -312,7 +413,7 @@ def handle_language_change(data):
     if room_id:
         # Update database
         try:
-            conn = get_db()
+            conn = get_db(write=True)
             cursor = conn.cursor()
             cursor.execute("UPDATE rooms SET language = ? WHERE id = ?", (language, room_id))
             conn.commit()
@@ -337,9 +438,6 @@ def handle_chat_message(data):
         }, room=str(room_id))
 
 if __name__ == '__main__':
-    print("Initializing database...")
-    init_db()
-    
     # Get port from environment (Render sets PORT env var)
     port = int(os.environ.get('PORT', 5000))
     print(f"Starting COMPLETE server on http://localhost:{port}")
@@ -5,6 +5,8 @@ class SocketService {
     this.socket = null;
     this.roomId = null;
     this.listeners = {};
+    this.presenceTimer = null;
+    this.onVisibilityChange = this.onVisibilityChange.bind(this);
   }
   
   // Connect to the Socket.IO server
@@ -30,6 +32,12 @@ class SocketService {
       console.log('Socket.IO disconnected:', reason);
     });
     
+    // Presence heartbeat, well inside the server's PRESENCE_EXPIRE_AFTER (90s by default)
+    this.presenceTimer = setInterval(() => {
+      this.sendPresence(document.hidden ? 'idle' : null);
+    }, 30000);
+    document.addEventListener('visibilitychange', this.onVisibilityChange);
+    
     // Re-register all listeners after reconnect
     this.socket.on('reconnect', () => {
       console.log('Socket.IO reconnected');
@@ -45,6 +53,10 @@ class SocketService {
   
   // Disconnect from the Socket.IO server
   disconnect() {
+    clearInterval(this.presenceTimer);
+    this.presenceTimer = null;
+    document.removeEventListener('visibilitychange', this.onVisibilityChange);
+    
     if (this.socket) {
       this.socket.disconnect();
       this.socket = null;
@@ -52,6 +64,18 @@ class SocketService {
     }
   }
   
+  // Keep this socket online; state 'idle' or 'active' also reports the user's state
+  sendPresence(state) {
+    if (!this.socket || !this.socket.connected) return;
+    
+    this.socket.emit('presence', state ? { state } : {});
+  }
+  
+  // A hidden tab shows as idle, a visible one as active again
+  onVisibilityChange() {
+    this.sendPresence(document.hidden ? 'idle' : 'active');
+  }
+  
   // Join a room
   joinRoom(roomId) {
     if (!this.socket) {